@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# connections.py - stress test of the libvirt connection handling
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Runs thousands of libvirt operations through LibvirtHandle the way the daemon
+serving many jobs does and fails if the number of open file descriptors or
+libvirt connections grows.
+
+Every --restart-every operations the connection is closed behind the handle's
+back, simulating a restart of the libvirt daemon, the following operation has
+to reconnect transparently.
+
+Usage:
+    benchmarks/connections.py [--uri URI] [--operations N]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+from pathlib import Path
+
+CONFIG = """
+state_dir: {workdir}/state
+libvirt:
+  uri: {uri}
+"""
+
+
+def count_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def get_operations(poolname):
+    """Returns the operations to cycle through as (name, callback) tuples."""
+
+    return [
+        ("list_domain_names", lambda h: h.list_domain_names()),
+        ("get_host_capacity", lambda h: h.get_host_capacity()),
+        ("list_volume_names", lambda h: h.list_volume_names(
+            poolname=poolname)),
+        ("has_volume", lambda h: h.has_volume("libvirt-gci-none", poolname)),
+        ("get_pool_path", lambda h: h.get_pool_path(poolname)),
+        ("refresh_pool", lambda h: h.refresh_pool(poolname)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", default="test:///default",
+                        help="libvirt connection URI to stress")
+    parser.add_argument("--pool", default=None,
+                        help="storage pool to query (default: 'default-pool' "
+                             "for test:///default, 'default' otherwise)")
+    parser.add_argument("--operations", type=int, default=10000,
+                        help="number of operations to run")
+    parser.add_argument("--restart-every", type=int, default=1000,
+                        help="operations between simulated daemon restarts, "
+                             "0 disables them")
+    args = parser.parse_args()
+
+    try:
+        import libvirt  # noqa: F401
+    except ImportError:
+        print("skipped, dependencies not installed")
+        return 0
+
+    poolname = args.pool
+    if poolname is None:
+        poolname = "default"
+        if args.uri == "test:///default":
+            poolname = "default-pool"
+
+    with tempfile.TemporaryDirectory(prefix="libvirt-gci-bench") as workdir:
+        config_path = Path(workdir, "config.yml")
+        with open(config_path, "w") as fd:
+            fd.write(CONFIG.format(workdir=workdir, uri=args.uri))
+
+        from provisioner.configmap import ConfigMap
+        from provisioner.libvirt_handle import LibvirtHandle
+        from provisioner.singleton import Singleton
+
+        operations = get_operations(poolname)
+
+        with Singleton.scope():
+            ConfigMap(config_file=config_path)["served"] = True
+
+            # the first connection and the event loop may open descriptors
+            for _, operation in operations:
+                operation(LibvirtHandle())
+            fds = count_fds()
+            conn = LibvirtHandle().conn
+            opened = 1
+            restarts = 0
+
+            print(f"{'OPERATIONS':>10} {'FDS':>6} {'HANDLES':>8} "
+                  f"{'CONNECTIONS':>12}")
+            checkpoint = max(args.operations // 10, 1)
+            for i in range(1, args.operations + 1):
+                if args.restart_every and i % args.restart_every == 0:
+                    LibvirtHandle().conn.close()
+                    restarts += 1
+
+                name, operation = operations[i % len(operations)]
+                try:
+                    operation(LibvirtHandle())
+                except Exception as ex:
+                    print(f"operation {i} ({name}) failed: {ex}")
+                    return 1
+                if LibvirtHandle().conn is not conn:
+                    conn = LibvirtHandle().conn
+                    opened += 1
+
+                if i % checkpoint == 0:
+                    print(f"{i:>10} {count_fds():>6} "
+                          f"{len(LibvirtHandle._LibvirtHandle__instances):>8} "
+                          f"{opened:>12}")
+
+            failed = False
+            if count_fds() > fds:
+                print(f"file descriptors leaked: {fds} -> {count_fds()}")
+                failed = True
+            if len(LibvirtHandle._LibvirtHandle__instances) != 1:
+                print("more than one handle per connection URI")
+                failed = True
+            if opened != restarts + 1:
+                print(f"{opened} connections opened, expected "
+                      f"{restarts + 1} ({restarts} restarts)")
+                failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+# e2e.py - offline end-to-end benchmark of GitLab job stages
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Runs the prepare/run/cleanup stages of GitLab jobs end to end without any
+real machines and compares the results against the baseline recorded in
+e2e_baseline.json.
+
+Machines are created through libvirt's test driver (test:///default) and an
+in-process SSH server (see fakeguest.py) stands in for all of the guests, so
+only libvirt-gci's own overhead is measured. The stages are run in-process
+the same way the daemon serves them. The benchmark measures:
+    - the latency of every stage of a job
+    - how the throughput of whole jobs scales with the number of parallel
+      jobs, doubling from 1 up to --jobs
+    - the throughput of remote command output
+    - the startup time of every subcommand (see startup.py)
+
+The test driver can't receive volume uploads, so the cloud-init seed volume
+is created empty instead and if no ISO mastering tool is installed, the seed
+image isn't mastered either.
+
+Usage:
+    benchmarks/e2e.py            # compare against the recorded baseline
+    benchmarks/e2e.py --record   # record a new baseline
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+BASELINE_FILE = Path(Path(__file__).parent, "e2e_baseline.json")
+
+# how much worse than the baseline a result may be before it's reported
+TOLERANCE = 1.25
+
+DISTRO = "bench"
+
+CONFIG = """
+state_dir: {workdir}/state
+libvirt:
+  uri: test:///default
+admission:
+  max_boots: {jobs}
+profiles:
+  definitions:
+    bench: {{vcpus: 1, memory: 32, disk: 1}}
+  distros:
+    {distro}: bench
+  reserved_memory: 0
+  cpu_overcommit: 8
+  when_full: reject
+readiness:
+  strategy: tcp
+  timeout: 30
+"""
+
+
+class NullSink:
+    """Binary stream discarding everything written to it."""
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def setup_environment(workdir, jobs):
+    """
+    Isolates the benchmark from the user's configuration and state.
+
+    Needs to be called before importing any provisioner module.
+
+    :return: tuple of (configuration file path, SSH private key path)
+    """
+
+    import paramiko
+
+    os.environ["HOME"] = str(workdir)
+    os.environ["XDG_CACHE_HOME"] = str(Path(workdir, "cache"))
+    os.environ["XDG_STATE_HOME"] = str(Path(workdir, "state"))
+
+    ssh_dir = Path(workdir, ".ssh")
+    ssh_dir.mkdir()
+    key = paramiko.RSAKey.generate(2048)
+    key_path = Path(ssh_dir, "id_rsa")
+    key.write_private_key_file(str(key_path))
+    with open(Path(ssh_dir, "id_rsa.pub"), "w") as fd:
+        fd.write(f"{key.get_name()} {key.get_base64()} bench\n")
+
+    config_path = Path(workdir, "config.yml")
+    with open(config_path, "w") as fd:
+        fd.write(CONFIG.format(workdir=workdir, jobs=jobs, distro=DISTRO))
+
+    return config_path, key_path
+
+
+def setup_libvirt(config_path):
+    """Prepares the test driver's storage and works around its limits."""
+
+    import shutil
+
+    from provisioner import cloud_init
+    from provisioner.configmap import ConfigMap
+    from provisioner.libvirt_handle import LibvirtHandle
+    from provisioner.singleton import Singleton
+
+    with Singleton.scope():
+        ConfigMap(config_file=config_path)
+        conn = LibvirtHandle().conn
+
+    pool = conn.storagePoolCreateXML("""
+        <pool type='dir'>
+          <name>default</name>
+          <target><path>/var/lib/libvirt/images</path></target>
+        </pool>
+    """, 0)
+    pool.createXML(f"""
+        <volume>
+          <name>{DISTRO}.qcow2</name>
+          <capacity unit='G'>1</capacity>
+          <target><format type='qcow2'/></target>
+        </volume>
+    """, 0)
+
+    def upload_volume(self, volname, path, poolname="default"):
+        pool = self.conn.storagePoolLookupByName(poolname)
+        pool.createXML(f"""
+            <volume>
+              <name>{volname}</name>
+              <capacity unit='B'>{os.path.getsize(path)}</capacity>
+              <target><format type='raw'/></target>
+            </volume>
+        """, 0)
+
+    LibvirtHandle.upload_volume = upload_volume
+
+    tools = ["xorrisofs", "genisoimage", "mkisofs"]
+    if all(shutil.which(tool) is None for tool in tools):
+        cloud_init.make_seed_iso = lambda path, *args: Path(path).touch()
+
+
+def route_guests(port):
+    """Makes all machine names resolve to the fake guest."""
+
+    getaddrinfo = socket.getaddrinfo
+
+    def route(host, service, *args, **kwargs):
+        if isinstance(host, str) and host.startswith("gitlab-"):
+            return getaddrinfo("127.0.0.1", port, *args, **kwargs)
+        return getaddrinfo(host, service, *args, **kwargs)
+
+    socket.getaddrinfo = route
+
+
+def run_stage(config_path, key_path, job_id, argv):
+    """
+    Runs a single stage of a job the way the daemon would.
+
+    :return: duration of the stage in seconds
+    """
+
+    from provisioner.application import Application
+    from provisioner.cmdline import CmdLine
+    from provisioner.singleton import Singleton
+
+    environ = {
+        "CUSTOM_ENV_CI_PROJECT_NAME": f"project{job_id % 4}",
+        "CUSTOM_ENV_CI_JOB_ID": str(job_id),
+        "CUSTOM_ENV_DISTRO": DISTRO,
+    }
+
+    argv = ["--config", str(config_path)] + argv[:1] + [
+        "--ssh-key-file", str(key_path)] + argv[1:]
+
+    with Singleton.scope():
+        cli_args = vars(CmdLine().parse(argv))
+        cli_args["served"] = True
+
+        start = time.perf_counter()
+        if Application(cli_args, environ).run() < 0:
+            raise Exception(f"Job {job_id}: '{' '.join(argv)}' failed")
+        return time.perf_counter() - start
+
+
+def run_job(config_path, key_path, job_id):
+    """
+    Runs all stages of a job.
+
+    :return: dictionary of stage name -> duration in seconds
+    """
+
+    timings = {}
+    for stage in [["prepare"], ["run", "true"], ["cleanup"]]:
+        timings[stage[0]] = run_stage(config_path, key_path, job_id, stage)
+    return timings
+
+
+def measure_latency(config_path, key_path, repeat):
+    """Returns the median duration of every stage in milliseconds."""
+
+    samples = {}
+    for job_id in range(repeat):
+        for stage, duration in run_job(config_path, key_path,
+                                       job_id).items():
+            samples.setdefault(stage, []).append(duration)
+
+    return {stage: statistics.median(durations) * 1000
+            for stage, durations in samples.items()}
+
+
+def measure_scaling(config_path, key_path, max_jobs):
+    """Returns the number of jobs finished per second by parallelism."""
+
+    results = {}
+    jobs = 1
+    while jobs <= max_jobs:
+        errors = []
+
+        def job(job_id):
+            try:
+                run_job(config_path, key_path, job_id)
+            except Exception as ex:
+                errors.append(ex)
+
+        # distinct job ids, so that the machine names don't collide
+        threads = [threading.Thread(target=job, args=(1000 * jobs + i,))
+                   for i in range(jobs)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            raise errors[0]
+
+        results[str(jobs)] = jobs / elapsed
+        jobs *= 2
+
+    return results
+
+
+def measure_throughput(config_path, key_path, size):
+    """Returns the throughput of remote command output in MB/s."""
+
+    from provisioner.configmap import ConfigMap
+    from provisioner.machine import Machine
+    from provisioner.singleton import Singleton
+
+    job_id = 999999
+    run_stage(config_path, key_path, job_id, ["prepare"])
+    try:
+        with Singleton.scope():
+            ConfigMap(config_file=config_path, served=True)
+
+            machine = Machine(f"gitlab-project{job_id % 4}-{DISTRO}-{job_id}")
+            machine.connect(key_path)
+
+            start = time.perf_counter()
+            machine.conn.exec(f"head -c {size} /dev/zero", out=NullSink())
+            return size / (time.perf_counter() - start) / 1e6
+    finally:
+        run_stage(config_path, key_path, job_id, ["cleanup"])
+
+
+def measure_startup(repeat):
+    """Returns the startup time of every subcommand in milliseconds."""
+
+    import startup
+
+    results = {}
+    for action in startup.ACTIONS:
+        result = startup.measure(action, repeat)
+        if result is not None:
+            results[action] = result[0] / 1000
+    return results
+
+
+def compare(name, value, baseline, higher_is_better=False):
+    """
+    Reports a result along with its baseline.
+
+    :return: True if the result is a regression against the baseline
+    """
+
+    regressed = False
+    if baseline is not None:
+        if higher_is_better:
+            regressed = value * TOLERANCE < baseline
+        else:
+            regressed = value > baseline * TOLERANCE
+
+    print(f"{name:>24}: {value:10.1f} "
+          f"(baseline: {'-' if baseline is None else f'{baseline:.1f}'})"
+          f"{'  REGRESSION' if regressed else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--record", action="store_true",
+                        help="record the measured values as the new baseline")
+    parser.add_argument("--jobs", type=int, default=64,
+                        help="maximum number of parallel jobs")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of jobs to measure stage latency with")
+    parser.add_argument("--size", type=int, default=256,
+                        help="amount of command output to stream in MB")
+    args = parser.parse_args()
+
+    try:
+        import libvirt  # noqa: F401
+        import paramiko  # noqa: F401
+    except ImportError:
+        print("skipped, dependencies not installed")
+        return 0
+
+    baseline = {}
+    if BASELINE_FILE.exists():
+        with open(BASELINE_FILE, "r") as fd:
+            baseline = json.load(fd)
+
+    with tempfile.TemporaryDirectory(prefix="libvirt-gci-bench") as workdir:
+        config_path, key_path = setup_environment(workdir, args.jobs)
+
+        from fakeguest import FakeGuest
+
+        guest = FakeGuest()
+        guest.start()
+        route_guests(guest.port)
+        setup_libvirt(config_path)
+
+        results = {
+            "latency": measure_latency(config_path, key_path, args.repeat),
+            "scaling": measure_scaling(config_path, key_path, args.jobs),
+            "throughput": measure_throughput(config_path, key_path,
+                                             args.size * 1000 * 1000),
+            "startup": measure_startup(args.repeat),
+        }
+        guest.stop()
+
+    failed = False
+    print("stage latency (ms)")
+    for stage, value in results["latency"].items():
+        failed |= compare(stage, value,
+                          baseline.get("latency", {}).get(stage))
+
+    print("parallel jobs (jobs/s)")
+    for jobs, value in results["scaling"].items():
+        failed |= compare(jobs, value,
+                          baseline.get("scaling", {}).get(jobs), True)
+
+    print("command output (MB/s)")
+    failed |= compare("exec", results["throughput"],
+                      baseline.get("throughput"), True)
+
+    print("startup (ms)")
+    for action, value in results["startup"].items():
+        failed |= compare(action, value,
+                          baseline.get("startup", {}).get(action))
+
+    if args.record:
+        with open(BASELINE_FILE, "w") as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+
+    return 1 if failed and not args.record else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
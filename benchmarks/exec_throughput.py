@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# exec_throughput.py - SSHConn.exec output streaming benchmark
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Measures how many MB/s of remote command output SSHConn can forward to the
+local stdout.
+
+The remote side is simulated by a fake Paramiko channel which hands out data
+as fast as it's asked for, so the benchmark only measures the local part of
+the output path. Run it with stdout redirected, e.g. to /dev/null.
+
+Usage:
+    benchmarks/exec_throughput.py [--size MB] > /dev/null
+"""
+
+import argparse
+import sys
+import time
+
+from provisioner.ssh import SSHConn
+
+
+class FakeChannel:
+    """Paramiko channel look-alike producing @size bytes of log output."""
+
+    def __init__(self, size):
+        line = "[ 42%] Building C object src/util/virfile.c.o — ünïcödé\n"
+
+        # a block larger than the biggest read SSHConn ever asks for
+        self.block = (line * (2 * 1024 * 1024 // len(line))).encode()
+        self.remaining = size
+        self.eof_received = False
+
+    def recv(self, nbytes):
+        nbytes = min(nbytes, self.remaining, len(self.block))
+        self.remaining -= nbytes
+        if self.remaining == 0:
+            self.eof_received = True
+        return self.block[:nbytes]
+
+    def recv_ready(self):
+        return self.remaining > 0
+
+    def recv_stderr_ready(self):
+        return False
+
+    def recv_stderr(self, nbytes):
+        return b""
+
+
+def legacy_pump(channel, out, err=None):
+    """The original SSHConn.exec() output loop."""
+
+    data = channel.recv(1024)
+    while data:
+        print(data.decode(errors="replace"), end="", flush=True)
+        data = channel.recv(1024)
+
+
+def measure(pump, size):
+    start = time.perf_counter()
+    pump(FakeChannel(size), sys.stdout.buffer)
+    sys.stdout.flush()
+    return size / (time.perf_counter() - start) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=256,
+                        help="amount of output to stream in MB")
+    args = parser.parse_args()
+
+    size = args.size * 1000 * 1000
+    for name, pump in [("legacy", legacy_pump), ("SSHConn", SSHConn._pump)]:
+        print(f"{name:>8}: {measure(pump, size):8.1f} MB/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# fakeguest.py - in-process SSH server standing in for the guests
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+A paramiko based SSH server accepting any public key and executing commands
+on the local host, used by the benchmarks in place of real guests.
+
+The server supports everything SSHConn needs: command execution with stdin,
+stdout and a separate stderr, exit statuses and SFTP uploads.
+"""
+
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer
+from paramiko import SFTPServerInterface, SFTP_OK
+
+BUFSIZE = 64 * 1024
+
+
+class _SFTPInterface(SFTPServerInterface):
+    def open(self, path, flags, attr):
+        fd = os.open(path, flags, 0o644)
+        mode = "wb" if flags & (os.O_WRONLY | os.O_RDWR) else "rb"
+
+        handle = SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(path))
+
+    lstat = stat
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_execute, args=(channel, command),
+                         daemon=True).start()
+        return True
+
+
+def _execute(channel, command):
+    proc = subprocess.Popen(command.decode(), shell=True,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    def feed_stdin():
+        data = channel.recv(BUFSIZE)
+        while data:
+            try:
+                proc.stdin.write(data)
+            except BrokenPipeError:
+                break
+            data = channel.recv(BUFSIZE)
+        proc.stdin.close()
+
+    def forward_stderr():
+        data = proc.stderr.read1(BUFSIZE)
+        while data:
+            channel.sendall_stderr(data)
+            data = proc.stderr.read1(BUFSIZE)
+
+    threading.Thread(target=feed_stdin, daemon=True).start()
+    stderr_thread = threading.Thread(target=forward_stderr, daemon=True)
+    stderr_thread.start()
+
+    data = proc.stdout.read1(BUFSIZE)
+    while data:
+        channel.sendall(data)
+        data = proc.stdout.read1(BUFSIZE)
+
+    stderr_thread.join()
+    channel.send_exit_status(proc.wait())
+    channel.close()
+
+
+class FakeGuest:
+    """
+    SSH server listening on a random local port.
+
+    The usual flow of actions is as follows:
+        guest = FakeGuest()
+        guest.start()
+        ... connect to 127.0.0.1:guest.port ...
+        guest.stop()
+    """
+
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", 0))
+        self.port = self._sock.getsockname()[1]
+
+    def _serve_client(self, client):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", SFTPServer, _SFTPInterface)
+        transport.start_server(server=_ServerInterface())
+
+        # channels are served by the exec request callback, accepting them
+        # just keeps the transport's queue from growing
+        while transport.is_active():
+            transport.accept(1)
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                # the listening socket was closed
+                return
+
+            threading.Thread(target=self._serve_client, args=(client,),
+                             daemon=True).start()
+
+    def start(self):
+        self._sock.listen(128)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def stop(self):
+        self._sock.close()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# placement.py - checks of the hypervisor selection
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Spreads machines across several test:/// hypervisors with different loads and
+templates and fails if any scheduler picks the wrong one.
+
+Every hypervisor is backed by its own libvirt test driver node definition, so
+no daemon or real machine is needed. Hypervisors which lack the distro's
+template or whose capacity can't fit the machine have to be passed over.
+
+Usage:
+    benchmarks/placement.py
+"""
+
+import argparse
+import sys
+import tempfile
+
+from pathlib import Path
+
+CONFIG = """
+state_dir: {workdir}/state
+libvirt:
+  hosts: {hosts}
+profiles:
+  reserved_memory: 0
+  cpu_overcommit: 1.0
+  definitions:
+    small: {{vcpus: 1, memory: 512}}
+    large: {{vcpus: 4, memory: 512}}
+"""
+
+NODE = """
+<node>
+  <cpu>
+    <mhz>2000</mhz>
+    <model>x86_64</model>
+    <active>{cpus}</active>
+    <nodes>1</nodes>
+    <sockets>1</sockets>
+    <cores>{cpus}</cores>
+    <threads>1</threads>
+  </cpu>
+  <memory>{memory}</memory>
+  {domains}
+  <pool type='dir'>
+    <name>default</name>
+    <target>
+      <path>/{name}-pool</path>
+    </target>
+    {volumes}
+  </pool>
+</node>
+"""
+
+DOMAIN = """
+  <domain type='test'>
+    <name>{name}</name>
+    <memory>1048576</memory>
+    <vcpu>1</vcpu>
+    <os>
+      <type>hvm</type>
+    </os>
+  </domain>
+"""
+
+VOLUME = """
+    <volume type='file'>
+      <name>{distro}.qcow2</name>
+      <capacity unit='G'>10</capacity>
+      <target>
+        <format type='qcow2'/>
+      </target>
+    </volume>
+"""
+
+# name -> (host CPUs, running single vCPU domains, templates)
+HOSTS = {
+    # lightly loaded
+    "light": (8, 2, ["fedora", "debian"]),
+    # heavily loaded, but still room for a small machine
+    "heavy": (8, 6, ["fedora", "debian"]),
+    # idle, but without the fedora template
+    "debian": (8, 0, ["debian"]),
+    # full, its load must not make bin-pack choose it
+    "full": (2, 2, ["fedora"]),
+}
+
+# machines recorded on the hypervisors for the affinity scheduler
+RECORDS = {
+    "light": 1,
+    "heavy": 3,
+    "full": 5,
+}
+
+# (scheduler, distro, profile, expected host or None if none can take it)
+CASES = [
+    ("least-loaded", "fedora", "small", "light"),
+    ("least-loaded", "debian", "small", "debian"),
+    ("bin-pack", "fedora", "small", "heavy"),
+    ("bin-pack", "fedora", "large", "light"),
+    ("bin-pack", "debian", "small", "heavy"),
+    ("affinity", "fedora", "small", "heavy"),
+    ("affinity", "fedora", "large", "light"),
+    ("affinity", "debian", "small", "debian"),
+    ("least-loaded", "centos", "small", None),
+]
+
+
+def write_node(workdir, name, cpus, domains, distros):
+    path = Path(workdir, f"{name}.xml")
+    with open(path, "w") as fd:
+        fd.write(NODE.format(
+            name=name,
+            cpus=cpus,
+            memory=16 * 1024 ** 2,
+            domains="".join(DOMAIN.format(name=f"{name}-{i}")
+                            for i in range(domains)),
+            volumes="".join(VOLUME.format(distro=distro)
+                            for distro in distros)))
+    return f"test://{path}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.parse_args()
+
+    try:
+        import libvirt  # noqa: F401
+    except ImportError:
+        print("skipped, dependencies not installed")
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix="libvirt-gci-bench") as workdir:
+        uris = {name: write_node(workdir, name, *node)
+                for name, node in HOSTS.items()}
+        names = {uri: name for name, uri in uris.items()}
+
+        config_path = Path(workdir, "config.yml")
+        with open(config_path, "w") as fd:
+            fd.write(CONFIG.format(workdir=workdir,
+                                   hosts=list(uris.values())))
+
+        from provisioner import hosts
+        from provisioner import profiles
+        from provisioner import state
+        from provisioner.configmap import ConfigMap
+        from provisioner.singleton import Singleton
+
+        failed = False
+        with Singleton.scope():
+            configmap = ConfigMap(config_file=config_path)
+
+            for name, count in RECORDS.items():
+                for i in range(count):
+                    state.set_machine_record(f"{name}-fedora-{i}", {
+                        "domain": f"{name}-fedora-{i}",
+                        "distro": "fedora",
+                        "host": uris[name],
+                    })
+
+            print(f"{'SCHEDULER':<14} {'DISTRO':<8} {'PROFILE':<8} "
+                  f"{'EXPECTED':<10} SELECTED")
+            for scheduler, distro, profile, expected in CASES:
+                configmap["libvirt"]["scheduler"] = scheduler
+                try:
+                    selected = names[hosts.select(
+                        distro, profiles.select(distro, requested=profile))]
+                except Exception as ex:
+                    selected = None
+                    if expected is not None:
+                        print(f"selection failed: {ex}")
+
+                print(f"{scheduler:<14} {distro:<8} {profile:<8} "
+                      f"{str(expected):<10} {selected}")
+                if selected != expected:
+                    failed = True
+
+    if failed:
+        print("wrong hosts selected")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+# startup.py - libvirt-gci startup time benchmark
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Measures the import cost of every libvirt-gci subcommand using the
+interpreter's -X importtime facility and compares it against the budget
+recorded in startup_budget.json.
+
+Every subcommand is represented by the modules its code path imports, which
+are found by following the calls and function-level imports from the
+subcommand's entry point in the provisioner sources. Besides the timing, the
+benchmark also verifies that the subcommands don't pull in heavy dependencies
+they have no use for. A subcommand which can't be measured, e.g. because
+libvirt-python isn't installed, or which has no budget recorded fails the
+benchmark.
+
+Usage:
+    benchmarks/startup.py            # compare against the recorded budget
+    benchmarks/startup.py --record   # record a new budget
+    benchmarks/startup.py --list     # list the modules of the subcommands
+"""
+
+import argparse
+import ast
+import importlib.util
+import json
+import statistics
+import subprocess
+import sys
+
+from pathlib import Path
+
+BUDGET_FILE = Path(Path(__file__).parent, "startup_budget.json")
+
+# headroom added on top of the measured value when recording the budget,
+# import times vary a lot between otherwise similar hosts
+HEADROOM = 1.5
+
+# modules every subcommand not forwarded to a daemon imports before the
+# entry point of the subcommand runs, see provisioner/__main__.py
+BASE = [
+    "provisioner.__main__",
+    "provisioner.application",
+    "provisioner.cmdline",
+    "provisioner.logger",
+]
+
+# subcommand -> (module, function or method its code path starts at,
+#                modules it must not import)
+ACTIONS = {
+    # a daemon is running, the binary only forwards the command line
+    "client": ("provisioner.client", "forward",
+               ["provisioner.application", "libvirt", "paramiko", "yaml"]),
+    "cleanup": ("provisioner.application", "Application._action_cleanup",
+                ["paramiko", "yaml"]),
+    "run": ("provisioner.application", "Application._action_run",
+            ["libvirt", "yaml"]),
+    "prepare": ("provisioner.application", "Application._action_prepare",
+                []),
+}
+
+# The forbidden modules are checked right after importing our own modules,
+# third-party libraries are free to import whatever they need
+SNIPPET = """
+import importlib, json, sys
+modules = {modules!r}
+own = [m for m in modules if m.startswith("provisioner")]
+for module in own:
+    importlib.import_module(module)
+forbidden = [m for m in {forbidden!r} if m in sys.modules]
+for module in modules:
+    importlib.import_module(module)
+print(json.dumps(forbidden))
+"""
+
+
+FUNCTION = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+class Sources:
+    """
+    Follows the code paths through the provisioner sources.
+
+    References to functions and classes are resolved through the imports of
+    the module and function they appear in, methods of 'self' through the
+    class. Methods called on any other object are matched by name against
+    the classes of the modules imported so far, which may include a few
+    methods the code path never actually calls, but never misses a module
+    imported lazily by a callee.
+    """
+
+    def __init__(self):
+        spec = importlib.util.find_spec("provisioner")
+        self.package = Path(spec.submodule_search_locations[0])
+        self.scopes = {}
+        # imports guarded by 'except ImportError' are optional dependencies
+        self.optional = set()
+
+    def _path(self, module):
+        return Path(self.package,
+                    *module.split(".")[1:]).with_suffix(".py")
+
+    def is_own(self, module):
+        return ((module == "provisioner" or
+                 module.startswith("provisioner.")) and
+                self._path(module).exists())
+
+    def _bind(self, nodes, names):
+        """
+        Records the names bound by the imports among @nodes.
+
+        :return: set of imported modules
+        """
+
+        modules = set()
+        for node in nodes:
+            if node in self.optional:
+                continue
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    modules.add(alias.name)
+                    names[alias.asname or alias.name] = (alias.name, None)
+            elif isinstance(node, ast.ImportFrom):
+                for alias in node.names:
+                    name = alias.asname or alias.name
+                    # 'from provisioner import hosts' imports a module
+                    submodule = f"{node.module}.{alias.name}"
+                    if self.is_own(submodule):
+                        modules.add(submodule)
+                        names[name] = (submodule, None)
+                    else:
+                        modules.add(node.module)
+                        names[name] = (node.module, alias.name)
+        return modules
+
+    def scope(self, module):
+        """
+        Returns the top-level definitions of one of our modules.
+
+        :return: dictionary with the 'imports' (modules imported along with
+                 the module), 'names' (name -> (module, attribute or None)),
+                 'functions' (qualified name -> node) and 'classes' (name ->
+                 list of method names) keys
+        """
+
+        if module in self.scopes:
+            return self.scopes[module]
+
+        tree = ast.parse(self._path(module).read_text())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Try) and any(
+                    isinstance(handler.type, ast.Name) and handler.type.id in
+                    ["ImportError", "ModuleNotFoundError"]
+                    for handler in node.handlers):
+                for child in node.body:
+                    self.optional.update(ast.walk(child))
+        scope = {"names": {}, "functions": {}, "classes": {}}
+
+        nodes = []
+        pending = list(tree.body)
+        while pending:
+            node = pending.pop()
+            if isinstance(node, FUNCTION):
+                scope["functions"][node.name] = node
+            elif isinstance(node, ast.ClassDef):
+                methods = [child for child in node.body
+                           if isinstance(child, FUNCTION)]
+                scope["classes"][node.name] = [m.name for m in methods]
+                for method in methods:
+                    scope["functions"][f"{node.name}.{method.name}"] = method
+            else:
+                nodes.append(node)
+                pending.extend(ast.iter_child_nodes(node))
+        scope["imports"] = self._bind(nodes, scope["names"])
+
+        self.scopes[module] = scope
+        return scope
+
+    def _resolve(self, module, attribute):
+        """Returns the functions @attribute of @module stands for."""
+
+        if not self.is_own(module):
+            return []
+
+        scope = self.scope(module)
+        if attribute in scope["functions"]:
+            return [(module, attribute)]
+        if attribute in scope["classes"]:
+            return [(module, f"{attribute}.{method}")
+                    for method in ["__init__", "__call__"]
+                    if method in scope["classes"][attribute]]
+        if attribute in scope["names"]:
+            return self._resolve(*scope["names"][attribute])
+        return []
+
+    def references(self, module, qualname):
+        """
+        Returns what a function refers to.
+
+        :return: tuple of (set of imported modules, set of resolved (module,
+                 function) references, set of unresolved method names)
+        """
+
+        scope = self.scope(module)
+        function = scope["functions"][qualname]
+        cls = qualname.split(".")[0] if "." in qualname else None
+
+        names = dict(scope["names"])
+        modules = self._bind(ast.walk(function), names)
+
+        def is_foreign(node):
+            # e.g. 'socket.socket()', whose methods aren't ours
+            while isinstance(node, (ast.Call, ast.Attribute)):
+                node = node.func if isinstance(node, ast.Call) else node.value
+            return (isinstance(node, ast.Name) and node.id in names and
+                    not self.is_own(names[node.id][0]))
+
+        foreign = set()
+        for node in ast.walk(function):
+            if isinstance(node, ast.Assign) and is_foreign(node.value):
+                foreign.update(target.id for target in node.targets
+                               if isinstance(target, ast.Name))
+            elif isinstance(node, ast.withitem) and is_foreign(
+                    node.context_expr) and isinstance(node.optional_vars,
+                                                      ast.Name):
+                foreign.add(node.optional_vars.id)
+
+        resolved = set()
+        methods = set()
+        for node in ast.walk(function):
+            if isinstance(node, ast.Name):
+                target = names.get(node.id)
+                if target is not None:
+                    resolved.update(self._resolve(*target))
+                else:
+                    resolved.update(self._resolve(module, node.id))
+            elif isinstance(node, ast.Attribute):
+                value = node.value
+                if (isinstance(value, ast.Name) and
+                        value.id in ["self", "cls", cls] and cls is not None):
+                    resolved.update(self._resolve(module,
+                                                  f"{cls}.{node.attr}"))
+                elif (isinstance(value, ast.Name) and value.id in names and
+                      names[value.id][1] is None):
+                    resolved.update(self._resolve(names[value.id][0],
+                                                  node.attr))
+                elif not (isinstance(value, ast.Name) and
+                          value.id in foreign):
+                    methods.add(node.attr)
+        return modules, resolved, methods
+
+    def trace(self, module, entry):
+        """Returns the modules the code path starting at @entry imports."""
+
+        modules = set()
+        methods = set()
+        visited = set()
+
+        def add_module(name):
+            if name in modules:
+                return
+            modules.add(name)
+            if self.is_own(name):
+                for imported in self.scope(name)["imports"]:
+                    add_module(imported)
+
+        add_module(module)
+        pending = {(module, entry)}
+        while pending:
+            while pending:
+                function = pending.pop()
+                visited.add(function)
+
+                imported, resolved, names = self.references(*function)
+                for name in imported:
+                    add_module(name)
+                methods.update(names)
+                pending.update(resolved - visited)
+
+            # methods of objects of classes imported meanwhile
+            for own in sorted(filter(self.is_own, modules)):
+                for cls, names in self.scope(own)["classes"].items():
+                    for name in set(names) & methods:
+                        if (own, f"{cls}.{name}") not in visited:
+                            pending.add((own, f"{cls}.{name}"))
+        return modules
+
+
+def get_modules(action):
+    module, entry, _ = ACTIONS[action]
+    modules = Sources().trace(module, entry)
+    if action != "client":
+        modules.update(BASE)
+    else:
+        modules.add("provisioner.__main__")
+
+    # our own modules first so the forbidden ones can be told apart
+    return sorted(modules, key=lambda m: (not m.startswith("provisioner"), m))
+
+
+def measure(action, repeat):
+    """
+    Measures the import time of @action in microseconds.
+
+    :return: tuple of (median import time, list of forbidden modules loaded)
+    """
+
+    snippet = SNIPPET.format(modules=get_modules(action),
+                             forbidden=ACTIONS[action][2])
+
+    samples = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime",
+                               "-c", snippet],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise Exception(proc.stderr.strip().splitlines()[-1])
+
+        total = 0
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            self_us = line.split(":", 1)[1].split("|")[0].strip()
+            if self_us.isdigit():
+                total += int(self_us)
+        samples.append(total)
+
+    return statistics.median(samples), json.loads(proc.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--record", action="store_true",
+                        help="record the measured values as the new budget")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of samples per subcommand")
+    parser.add_argument("--list", action="store_true",
+                        help="only list the modules of every subcommand")
+    args = parser.parse_args()
+
+    if args.list:
+        for action in ACTIONS:
+            print(f"{action}: {' '.join(get_modules(action))}")
+        return 0
+
+    budget = {}
+    if BUDGET_FILE.exists():
+        with open(BUDGET_FILE, "r") as fd:
+            budget = json.load(fd)
+
+    failed = False
+    for action in ACTIONS:
+        try:
+            elapsed, forbidden = measure(action, args.repeat)
+        except Exception as ex:
+            print(f"{action:>8}: can't be measured: {ex}")
+            failed = True
+            continue
+
+        limit = budget.get(action)
+        print(f"{action:>8}: {elapsed / 1000:7.1f} ms "
+              f"(budget: {limit / 1000 if limit else '-'} ms)")
+
+        if forbidden:
+            print(f"{action:>8}: imports unneeded modules: {forbidden}")
+            failed = True
+
+        if args.record:
+            budget[action] = int(elapsed * HEADROOM)
+        elif limit is None:
+            print(f"{action:>8}: no budget recorded, run with --record")
+            failed = True
+        elif elapsed > limit:
+            print(f"{action:>8}: startup budget exceeded")
+            failed = True
+
+    # a partial budget would leave the missing subcommands unchecked
+    if args.record and not failed:
+        with open(BUDGET_FILE, "w") as fd:
+            json.dump(budget, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+    elif args.record:
+        print("budget not recorded, not every subcommand could be measured")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
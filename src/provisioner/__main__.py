@@ -1,13 +1,12 @@
-import logging
 import os
 import sys
 
-from provisioner.application import Application
-from provisioner.cmdline import CmdLine
-from provisioner.logger import LevelFormatter
-
 
 def logInit():
+    import logging
+
+    from provisioner.logger import LevelFormatter
+
     log_level_formats = {
         logging.DEBUG: "[%(levelname)s] %(module)s:%(funcName)s:%(lineno)d: %(message)s",
         logging.ERROR: "[%(levelname)s]: %(message)s",
@@ -27,7 +26,37 @@ def err_code():
     return os.environ.get("BUILD_FAILURE_EXIT_CODE", 1)
 
 
+def get_action(argv):
+    """Returns the subcommand of a command line without parsing it fully."""
+
+    args = iter(argv)
+    for arg in args:
+        if arg == "--config":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
 def main():
+    # If a daemon is running, it does all the work, so forward the command
+    # line to it without importing anything heavy
+    from provisioner.ipc import socket_path
+
+    argv = sys.argv[1:]
+    path = socket_path()
+    if get_action(argv) != "daemon" and os.path.exists(path):
+        from provisioner.client import forward
+
+        ret = forward(path, argv, os.environ, err_code())
+        if ret is not None:
+            sys.exit(ret)
+
+    import logging
+
+    from provisioner.application import Application
+    from provisioner.cmdline import CmdLine
+
     log = logInit()
     args = CmdLine().parse()
 
@@ -48,3 +77,7 @@ def main():
         else:
             log.error(ex)
     sys.exit(ret)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+# admission.py - module containing the host-wide boot admission control
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from provisioner import metrics
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Bounds of the delay between two attempts of a queued provision to get
+# admitted, the delay grows with the position in the queue
+POLL_DELAY_MIN = 0.25
+POLL_DELAY_MAX = 5.0
+
+# Bounds of the delay between two attempts to create a domain, the delay
+# grows with the number of boots in progress
+RETRY_DELAY_MIN = 0.5
+RETRY_DELAY_MAX = 10.0
+
+
+def _admission_path(*parts):
+    return state.state_path("admission", *parts)
+
+
+def _try_lock(path):
+    """
+    Tries to take an exclusive lock on @path without waiting.
+
+    flock() locks belong to the open file description, so a lock taken this
+    way conflicts with any other holder, even a thread of the same process.
+
+    :return: file object holding the lock or None if somebody else holds it
+    """
+
+    fd = open(path, "a")
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fd.close()
+        return None
+    return fd
+
+
+def _probe_slots(max_boots):
+    """Returns the indices of the boot slots nobody holds."""
+
+    free = []
+    for index in range(max_boots):
+        fd = _try_lock(_admission_path(f"boot-{index}.lock"))
+        if fd is not None:
+            fd.close()
+            free.append(index)
+    return free
+
+
+def _count_machines():
+    """
+    Counts the machines which exist or are being provisioned.
+
+    Machines admitted to boot only get their state record once they're
+    provisioned, until then they're counted through their boot file (see
+    boot_slot()). Boot files of processes which died while booting are
+    removed. The queue lock needs to be held.
+    """
+
+    from provisioner import reaper
+
+    names = {path.stem
+             for path in state.state_path("machines", "").glob("*.json")}
+    for path in _admission_path("booting", "").glob("*.boot"):
+        fd = _try_lock(path)
+        if fd is not None:
+            log.debug(f"Removing stale boot file '{path.name}'")
+            path.unlink()
+            fd.close()
+            continue
+
+        names.add(path.stem)
+
+    members = len(list(state.state_path("pool", "").glob("*/*.json")))
+    return len(names) + members + len(reaper.markers())
+
+
+def _get_tickets():
+    """
+    Returns the tickets of provisions waiting to be admitted.
+
+    Tickets of processes which died while waiting are removed. The queue lock
+    needs to be held.
+
+    :return: list of (ticket name, project) tuples, oldest first
+    """
+
+    tickets = []
+    for path in sorted(_admission_path("queue", "").glob("*.ticket")):
+        fd = _try_lock(path)
+        if fd is not None:
+            log.debug(f"Removing stale admission ticket '{path.name}'")
+            path.unlink()
+            fd.close()
+            continue
+
+        tickets.append((path.stem, path.read_text()))
+    return tickets
+
+
+def _fair_order(tickets, served):
+    """
+    Orders waiting tickets fairly between projects.
+
+    Projects take turns, starting with the one which got a machine booted
+    least recently, so a project queueing many jobs at once can't starve the
+    others. Within a project, tickets are served in the order they came in.
+
+    :param tickets: list of (ticket name, project) tuples, oldest first
+    :param served: dictionary of project -> time its last boot was admitted
+    :return: list of ticket names
+    """
+
+    queues = {}
+    for ticket, project in tickets:
+        queues.setdefault(project, []).append(ticket)
+
+    projects = sorted(queues, key=lambda p: (served.get(p, 0), queues[p][0]))
+
+    order = []
+    while projects:
+        for project in list(projects):
+            order.append(queues[project].pop(0))
+            if not queues[project]:
+                projects.remove(project)
+    return order
+
+
+def status():
+    """
+    Returns the state of the admission queue.
+
+    :return: dictionary with 'boots', 'max_boots' and 'queued' keys
+    """
+
+    max_boots = ConfigMap()["admission"]["max_boots"]
+    with state.locked(_admission_path("queue.lock")):
+        free = _probe_slots(max_boots)
+        queued = len(_get_tickets())
+
+    return {
+        "boots": max_boots - len(free),
+        "max_boots": max_boots,
+        "queued": queued,
+    }
+
+
+def retry_delay():
+    """Returns how long to wait before retrying a failed domain creation."""
+
+    boots = status()["boots"]
+    return min(RETRY_DELAY_MIN * (1 + boots), RETRY_DELAY_MAX)
+
+
+@contextmanager
+def boot_slot(project, name):
+    """
+    Context manager admitting a machine boot onto the host.
+
+    At most 'admission.max_boots' machines are booted at a time and at most
+    'admission.max_machines' machines exist at a time. Provisions exceeding
+    those limits are queued, taking turns between projects. Waiting provisions
+    hold a locked ticket file, the boot slot is a locked file too, so neither
+    outlives a crashed process. An admitted machine holds a locked boot file
+    named after it while booting, so it counts as existing before it has a
+    state record.
+
+    :param project: name of the GitLab project the machine is for as string
+    :param name: name of the machine as string
+    """
+
+    settings = ConfigMap()["admission"]
+    project = project or ""
+
+    ticket = f"{time.time_ns():020d}-{os.getpid()}-{threading.get_ident()}"
+    ticket_path = _admission_path("queue", f"{ticket}.ticket")
+    served_path = _admission_path("served.json")
+    boot_path = _admission_path("booting", f"{name}.boot")
+
+    with state.locked(_admission_path("queue.lock")):
+        ticket_path.write_text(project)
+        ticket_fd = _try_lock(ticket_path)
+
+    slot_fd = None
+    boot_fd = None
+    begin = time.monotonic()
+    try:
+        while slot_fd is None:
+            with state.locked(_admission_path("queue.lock")):
+                served = state.read_json(served_path, {})
+                order = _fair_order(_get_tickets(), served)
+                position = order.index(ticket)
+
+                free = _probe_slots(settings["max_boots"])
+                admissible = len(free)
+                if settings["max_machines"] is not None:
+                    admissible = min(admissible, settings["max_machines"] -
+                                     _count_machines())
+
+                if position < admissible:
+                    slot_fd = _try_lock(_admission_path(f"boot-{free[0]}.lock"))
+
+                    # counted by _count_machines() until the machine has a
+                    # record
+                    boot_path.write_text(project)
+                    boot_fd = _try_lock(boot_path)
+
+                    served[project] = time.time()
+                    state.write_json(served_path, served)
+
+                    ticket_path.unlink()
+                    break
+
+            log.debug(f"Waiting for a boot slot, {position} provisions ahead "
+                      f"and {admissible} admissible")
+            time.sleep(min(POLL_DELAY_MIN * (position - max(admissible, 0) + 1),
+                           POLL_DELAY_MAX))
+    finally:
+        ticket_path.unlink(missing_ok=True)
+        ticket_fd.close()
+        metrics.record("admission_wait", time.monotonic() - begin,
+                       "ok" if slot_fd is not None else "error")
+
+    try:
+        yield
+    finally:
+        boot_path.unlink(missing_ok=True)
+        boot_fd.close()
+        slot_fd.close()
@@ -4,33 +4,45 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import getpass
 import logging
 import os
+import sys
 
 from pathlib import Path
 
 from provisioner.configmap import ConfigMap
 from provisioner.machine import Machine
+from provisioner.pool import WarmPool
 from provisioner.singleton import Singleton
 
 log = logging.getLogger(__name__)
 
 
 class Application(metaclass=Singleton):
-    def __init__(self, cli_args):
+    def __init__(self, cli_args, environ=os.environ):
         # initialize the global configuration map singleton object
         configmap = ConfigMap(**cli_args)
 
         # GitLab will set these with every job
-        project = os.environ.get("CUSTOM_ENV_CI_PROJECT_NAME")
-        job_id = os.environ.get("CUSTOM_ENV_CI_JOB_ID")
-        distro = os.environ.get("CUSTOM_ENV_DISTRO")
+        project = environ.get("CUSTOM_ENV_CI_PROJECT_NAME")
+        project_id = environ.get("CUSTOM_ENV_CI_PROJECT_ID")
+        job_id = environ.get("CUSTOM_ENV_CI_JOB_ID")
+        distro = environ.get("CUSTOM_ENV_DISTRO")
+        profile = environ.get("CUSTOM_ENV_PROFILE")
+        repository_url = environ.get("CUSTOM_ENV_CI_REPOSITORY_URL")
+        project_dir = environ.get("CUSTOM_ENV_CI_PROJECT_DIR")
 
         if distro is not None:
             configmap["distro"] = distro
+        if profile is not None:
+            configmap["profile"] = profile
 
         configmap["project"] = project
+        configmap["project_id"] = project_id
         configmap["job_id"] = job_id
+        configmap["repository_url"] = repository_url
+        configmap["project_dir"] = project_dir
 
     @staticmethod
     def _get_ssh_key_path(configmap):
@@ -75,6 +87,9 @@ class Application(metaclass=Singleton):
     def _action_prepare(self):
         """Provisions a new VM using libvirt."""
 
+        from provisioner import mirrors
+        from provisioner import profiles
+
         configmap = ConfigMap()
 
         machine_name = self._get_machine_name()
@@ -85,7 +100,33 @@ class Application(metaclass=Singleton):
             if ssh_key_path is None:
                 raise Exception("No SSH key available")
 
-            machine.provision(configmap["distro"], ssh_key_path)
+            distro = configmap["distro"]
+            profile = profiles.select(distro, configmap["project"],
+                                      configmap["profile"])
+
+            # pool members are provisioned with the distro's profile and
+            # without knowing which project's cache and mirror they would
+            # share
+            pool = WarmPool(distro)
+            if (pool.target > 0 and
+                    profile["name"] == profiles.select(distro)["name"] and
+                    configmap["shared_dirs"]["cache"] is None and
+                    not mirrors.enabled()):
+                claimed = pool.claim(machine_name, ssh_key_path)
+                pool.refill_async()
+                if claimed is not None:
+                    return 0
+
+            # the mirror is fetched while the machine boots
+            mirror_refresh = None
+            if mirrors.enabled():
+                mirror_refresh = mirrors.refresh_async(
+                    configmap["project_id"], configmap["repository_url"])
+
+            machine.provision(distro, ssh_key_path, profile)
+
+            if mirror_refresh is not None:
+                mirror_refresh.join()
             return 0
         except Exception as ex:
             raise Exception(f"Failed to prepare machine '{machine_name}': {ex}")
@@ -96,8 +137,6 @@ class Application(metaclass=Singleton):
         configmap = ConfigMap()
 
         machine_name = self._get_machine_name()
-        cmd_str = configmap["executable"]
-        cmd_args = configmap["exec_args"]
         machine = Machine(machine_name)
         try:
             ssh_key_path = self._get_ssh_key_path(configmap)
@@ -106,35 +145,368 @@ class Application(metaclass=Singleton):
 
             machine.connect(ssh_key_path)
 
-            if configmap["script"]:
-                basename = Path(configmap["executable"]).name
+            for transfer in configmap["push"] or []:
+                src, dst = self._parse_transfer(transfer)
+                machine.conn.push(src, dst, configmap["compress"])
 
-                with open(configmap["executable"], "r"):
-                    # NADA - check that the file exists and we can read it
-                    pass
+            ret = 0
+            if configmap["executable"] is not None:
+                ret = self._run_executable(machine)
 
-                dest = f"/tmp/{basename}"
-                machine.conn.upload(configmap["executable"], dest)
-                cmd_str = "/bin/bash"
-                cmd_args = [dest] + configmap["exec_args"]
+            # pull even if the workload failed, its output might tell why
+            for transfer in configmap["pull"] or []:
+                src, dst = self._parse_transfer(transfer)
+                machine.conn.pull(src, dst, configmap["compress"])
 
-            cmdlinestr = f"{cmd_str} {' '.join(cmd_args)}"
-            return machine.conn.exec(cmdlinestr)
+            return ret
 
         except Exception as ex:
             raise Exception(
                 f"Failed to execute workload on '{machine_name}': {ex}")
 
+    @staticmethod
+    def _parse_transfer(transfer):
+        try:
+            src, dst = transfer.split(":", 1)
+        except ValueError:
+            raise Exception(f"Invalid transfer '{transfer}', "
+                            "expected SRC:DST")
+        return src, dst
+
+    @staticmethod
+    def _run_executable(machine):
+        from provisioner import joblog
+        from provisioner import mirrors
+        from provisioner import shared_dirs
+
+        configmap = ConfigMap()
+
+        cmd_str = configmap["executable"]
+        cmd_args = configmap["exec_args"]
+
+        if configmap["script"]:
+            basename = Path(configmap["executable"]).name
+
+            with open(configmap["executable"], "r"):
+                # NADA - check that the file exists and we can read it
+                pass
+
+            dest = f"/tmp/{basename}"
+            machine.conn.upload(configmap["executable"], dest)
+            cmd_str = "/bin/bash"
+            cmd_args = [dest] + configmap["exec_args"]
+
+        err = None
+        if not configmap["ssh"]["combine_stderr"]:
+            err = sys.stderr.buffer
+
+        cmdlinestr = f"{cmd_str} {' '.join(cmd_args)}"
+
+        # GitLab passes the name of the stage to the script
+        if (configmap["script"] and configmap["exec_args"][:1] == [
+                "get_sources"] and machine.record is not None and
+                mirrors.MIRROR_TAG in machine.record.get("shares", [])):
+            cmdlinestr = mirrors.wrap_get_sources(cmdlinestr,
+                                                  configmap["project_dir"])
+
+        if not joblog.enabled():
+            return machine.conn.exec(cmdlinestr, err=err)
+
+        name = machine.name
+        if configmap["script"] and configmap["exec_args"]:
+            name += f"-{configmap['exec_args'][0]}"
+
+        # the spilled output can only be uploaded as an artifact from within
+        # the job's directory
+        artifact_dir = None
+        project_dir = shared_dirs.get_host_path(machine,
+                                                configmap["project_dir"])
+        if project_dir is not None:
+            artifact_dir = (Path(project_dir, joblog.ARTIFACT_DIR),
+                            f"{configmap['project_dir']}/{joblog.ARTIFACT_DIR}")
+
+        out = joblog.JobLog(sys.stdout.buffer, name, artifact_dir)
+        if err is not None:
+            err = joblog.JobLog(err, f"{name}-stderr", artifact_dir)
+        try:
+            return machine.conn.exec(cmdlinestr, out=out, err=err)
+        finally:
+            out.close()
+            if err is not None:
+                err.close()
+
     def _action_cleanup(self):
         """Cleans up the VM (including storage) given a name."""
 
         machine_name = self._get_machine_name()
+        defer = ConfigMap()["cleanup"]["mode"] == "deferred"
         try:
-            Machine(machine_name).teardown()
-            return 0
+            Machine(machine_name).teardown(defer=defer)
         except Exception as ex:
             raise Exception(f"Failed to clean-up machine {machine_name}: {ex}")
 
+        if defer:
+            from provisioner import reaper
+
+            reaper.spawn_async()
+        return 0
+
+    def _action_save_state(self):
+        """Saves the memory states machines of a distro are restored from."""
+
+        from provisioner import hosts
+        from provisioner import profiles
+        from provisioner import saved_state
+        from provisioner.libvirt_handle import LibvirtHandle
+
+        configmap = ConfigMap()
+
+        ssh_key_path = self._get_ssh_key_path(configmap)
+        if ssh_key_path is None:
+            raise Exception("No SSH key available")
+
+        distro = configmap["distro"]
+        profile = profiles.select(distro, requested=configmap["profile"])
+
+        uris = hosts.get_hosts()
+        for uri in uris:
+            with hosts.host(uri):
+                # every hypervisor which can run the distro gets its states
+                if len(uris) > 1:
+                    try:
+                        LibvirtHandle().get_base_image(distro)
+                    except Exception as ex:
+                        log.debug(f"Skipping host '{uri}': {ex}")
+                        continue
+
+                try:
+                    saved_state.save(distro, profile, ssh_key_path)
+                except Exception as ex:
+                    raise Exception(f"Failed to save the state of '{distro}' "
+                                    f"on '{uri}': {ex}")
+        return 0
+
+    def _action_build_images(self):
+        """Turns template machines into base images concurrently."""
+
+        from provisioner import images
+
+        configmap = ConfigMap()
+
+        steps = ["shutdown", "sysprep"]
+        if configmap["images"]["sparsify"]:
+            steps.append("sparsify")
+
+        # the memory states need to be saved by the user gitlab-runner runs
+        # libvirt-gci as, which 'sudo libvirt-gci build-images' isn't
+        ssh_key_path = configmap["ssh_key_file"]
+        user = (configmap["save_state_user"] or
+                configmap["images"]["save_state_user"] or
+                os.environ.get("SUDO_USER"))
+        if user == getpass.getuser():
+            user = None
+
+        if configmap["save_state"]:
+            if user is None:
+                if os.geteuid() == 0 and configmap["state_dir"] is None:
+                    raise Exception("Memory states saved by root wouldn't be "
+                                    "found by the jobs, use "
+                                    "--save-state-user or set 'state_dir'")
+
+                ssh_key_path = self._get_ssh_key_path(configmap)
+                if ssh_key_path is None:
+                    raise Exception("No SSH key available")
+            steps.append("save-state")
+
+        workers = configmap["workers"]
+        if workers is None:
+            workers = configmap["images"]["workers"]
+
+        def report(distro, result):
+            if result["error"] is not None:
+                print(f"[FAILED] {distro}: {result['error']}")
+            else:
+                print(f"[OK] {distro}")
+
+        results = images.build_all(configmap["distros"], steps, workers,
+                                   resume=configmap["resume"],
+                                   ssh_key_path=ssh_key_path,
+                                   save_state_user=user, report=report)
+
+        print()
+        print(f"{'DISTRO':<24} " +
+              " ".join(f"{step.upper():>10}" for step in steps) +
+              f" {'TOTAL':>10}  NOTES")
+        failed = []
+        for distro, result in results.items():
+            timings = result["timings"]
+            columns = []
+            for step in steps:
+                if timings.get(step) is not None:
+                    columns.append(f"{timings[step]:>9.1f}s")
+                elif step in timings:
+                    columns.append(f"{'done':>10}")
+                else:
+                    columns.append(f"{'-':>10}")
+            total = sum(timing for timing in timings.values()
+                        if timing is not None)
+            notes = ", ".join(f"{step}: {note}"
+                              for step, note in result["notes"].items())
+            if result["error"] is not None:
+                failed.append(distro)
+                notes = "FAILED"
+            print(f"{distro:<24} {' '.join(columns)} {total:>9.1f}s  {notes}")
+
+        if failed:
+            print()
+            print(f"Re-run with --resume to continue the builds of "
+                  f"{' '.join(failed)}")
+            return -1
+        return 0
+
+    def _action_gc(self):
+        """Reaps marked machines and collects orphaned resources."""
+
+        from provisioner import reaper
+
+        stats = reaper.reap()
+        if stats is not None:
+            print(f"reaped: marked={stats['marked']} "
+                  f"expired={stats['expired']} orphans={stats['orphans']} "
+                  f"files={stats['files']}")
+        return 0
+
+    def _action_pool(self):
+        """Manages the warm pool of pre-booted machines."""
+
+        configmap = ConfigMap()
+
+        distros = configmap["pool"]["targets"].keys()
+        if configmap["distro"] is not None:
+            distros = [configmap["distro"]]
+
+        for distro in distros:
+            pool = WarmPool(distro)
+
+            if configmap["operation"] == "status":
+                stats = pool.stats()
+                print(f"{distro}: target={pool.target} "
+                      f"ready={len(pool.members())} "
+                      f"hits={stats['hits']} misses={stats['misses']}")
+            elif configmap["operation"] == "refill":
+                ssh_key_path = self._get_ssh_key_path(configmap)
+                if ssh_key_path is None:
+                    raise Exception("No SSH key available")
+
+                pool.refill(ssh_key_path)
+            elif configmap["operation"] == "drain":
+                pool.drain()
+
+        return 0
+
+    def _action_list_images(self):
+        """Lists the template base images in the image catalog."""
+
+        from provisioner import hosts
+        from provisioner.libvirt_handle import LibvirtHandle
+
+        uris = hosts.get_hosts()
+        for uri in uris:
+            images = LibvirtHandle(uri).list_base_images()
+
+            if len(uris) > 1:
+                print(f"host: {uri}")
+            print(f"{'DISTRO':<24} {'FORMAT':<8} {'CAPACITY':>10}  PATH")
+            for distro, record in sorted(images.items()):
+                capacity = f"{record['capacity'] / 1024 ** 3:.1f} GiB"
+                print(f"{distro:<24} {record['format']:<8} {capacity:>10}  "
+                      f"{record['path']}")
+            if len(uris) > 1:
+                print()
+
+        return 0
+
+    @staticmethod
+    def _print_host_status():
+        from provisioner import admission
+        from provisioner import placement
+        from provisioner import profiles
+        from provisioner.libvirt_handle import LibvirtHandle
+        from provisioner.reaper import MACHINE_PREFIX
+
+        capacity = LibvirtHandle().get_host_capacity()
+        limits = profiles.get_limits(capacity)
+        queue = admission.status()
+
+        print(f"domains: {capacity['domains']}")
+        print(f"boots:   {queue['boots']}/{queue['max_boots']} in progress "
+              f"({queue['queued']} queued)")
+        print(f"vcpus:   {capacity['committed_vcpus']}/{limits['vcpus']} "
+              f"committed ({capacity['cpus']} host CPUs)")
+        print(f"memory:  {capacity['committed_memory']}/{limits['memory']} MiB "
+              f"committed ({capacity['available_memory']} MiB available)")
+
+        usage = LibvirtHandle().get_memory_usage(MACHINE_PREFIX)
+        if usage["committed"] > 0:
+            print(f"density: {usage['committed'] / usage['memory']:.2f}x "
+                  f"overcommit, {usage['resident']} MiB resident, "
+                  f"{usage['unused']} MiB unused, "
+                  f"{usage['shared']} MiB shared by KSM")
+
+        if ConfigMap()["placement"]["mode"] == "pinned":
+            for node_id, node in sorted(placement.status().items()):
+                print(f"node {node_id}:  {node['pinned_cpus']}/{node['cpus']} "
+                      f"CPUs pinned, {node['pinned_memory']}/"
+                      f"{node['memory']} MiB bound")
+        print()
+
+        reserved = ConfigMap()["profiles"]["reserved_memory"]
+        print(f"{'PROFILE':<16} {'VCPUS':>6} {'MEMORY':>10} {'DISK':>8} "
+              f"{'FITS':>5}")
+        for name, profile in sorted(profiles.get_profiles().items()):
+            fits = min(
+                (limits["vcpus"] - capacity["committed_vcpus"]) //
+                profile["vcpus"],
+                (limits["memory"] - capacity["committed_memory"]) //
+                profile["memory"],
+                (capacity["available_memory"] - reserved) //
+                profile["memory"],
+            )
+            print(f"{name:<16} {profile['vcpus']:>6} "
+                  f"{profile['memory']:>6} MiB {profile['disk']:>5} GB "
+                  f"{max(fits, 0):>5}")
+
+    def _action_host_status(self):
+        """Shows the host capacity and how many machines of each profile fit."""
+
+        from provisioner import hosts
+
+        uris = hosts.get_hosts()
+        for index, uri in enumerate(uris):
+            with hosts.host(uri):
+                if len(uris) > 1:
+                    if index > 0:
+                        print()
+                    print(f"host:    {uri}")
+                self._print_host_status()
+
+        return 0
+
+    def _action_daemon(self):
+        """Serves actions forwarded by the libvirt-gci client."""
+
+        from provisioner.daemon import Daemon
+        from provisioner.ipc import socket_path
+
+        configmap = ConfigMap()
+
+        path = Path(socket_path())
+        if configmap["socket"] is not None:
+            path = Path(configmap["socket"])
+
+        Daemon(path).serve(debug=configmap["debug"])
+        return 0
+
     def run(self):
         """
         Application entry point.
@@ -142,5 +514,9 @@ class Application(metaclass=Singleton):
         Selects an action callback according to the CLI subcommand.
         """
 
-        cb = self.__getattribute__("_action_" + ConfigMap()["action"])
-        return cb()
+        from provisioner import metrics
+
+        action = ConfigMap()["action"]
+        cb = self.__getattribute__("_action_" + action.replace("-", "_"))
+        with metrics.collect(), metrics.span(action):
+            return cb()
@@ -0,0 +1,57 @@
+# client.py - module containing the thin daemon client
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import socket
+import sys
+
+from provisioner import ipc
+
+
+def forward(path, argv, environ, failure_code):
+    """
+    Forwards a command line to the libvirt-gci daemon.
+
+    The daemon's output is streamed back to our stdout/stderr as it comes.
+
+    :param path: path to the daemon's UNIX socket
+    :param argv: command line arguments (without the program name) as list
+    :param environ: environment of the GitLab stage as dictionary
+    :param failure_code: exit code to return when the action fails
+    :return: exit code, None if the daemon isn't accepting connections
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except (ConnectionRefusedError, FileNotFoundError):
+        # stale socket, the daemon is gone
+        sock.close()
+        return None
+
+    env = {k: v for k, v in environ.items() if k.startswith("CUSTOM_ENV_")}
+
+    with sock:
+        # the daemon resolves relative paths of the command line against it
+        ipc.send_frame(sock, ipc.REQUEST,
+                       ipc.encode_request(argv, env, os.getcwd()))
+
+        while True:
+            kind, payload = ipc.recv_frame(sock)
+            if kind == ipc.STDOUT:
+                sys.stdout.buffer.write(payload)
+                sys.stdout.buffer.flush()
+            elif kind == ipc.STDERR:
+                sys.stderr.buffer.write(payload)
+                sys.stderr.buffer.flush()
+            elif kind == ipc.EXIT:
+                failed, status = ipc.decode_exit(payload)
+                if status is not None:
+                    return status
+                return failure_code if failed else 0
+            else:
+                sys.stderr.write("[ERROR]: Lost connection to the daemon\n")
+                return failure_code
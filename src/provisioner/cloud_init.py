@@ -5,15 +5,30 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import logging
+import shutil
+import subprocess
+import time
 
+from hashlib import sha256
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from provisioner import hosts
+from provisioner import metrics
+from provisioner import state
 from provisioner.ssh import get_user_ssh_keys
 
 
 log = logging.getLogger(__name__)
 
 
-def get_user_data(hostname):
-    """Generates simple cloud-init user data."""
+def get_user_data(hostname=None):
+    """
+    Generates simple cloud-init user data.
+
+    :param hostname: FQDN to set, if None the hostname needs to be passed to
+                     cloud-init via meta data instead (see get_smbios_serial())
+    """
 
     gitlab_runner = {
         "name": "gitlab-runner",
@@ -26,11 +41,200 @@ def get_user_data(hostname):
         "expire": False,
     }
 
+    from provisioner import shared_dirs
+
     user_data = {}
     user_data["users"] = [gitlab_runner]
     user_data["chpasswd"] = chpasswd
-    user_data["fqdn"] = hostname
+    if hostname is not None:
+        user_data["fqdn"] = hostname
+
+    bootcmd = shared_dirs.get_boot_commands()
+    if bootcmd:
+        user_data["bootcmd"] = bootcmd
 
     log.debug(f"Cloud-init user data: {user_data}")
 
     return user_data
+
+
+def to_cloud_config(user_data):
+    """Serializes cloud-init user data into a #cloud-config document."""
+
+    import yaml
+
+    # nasty hack to force PyYAML not to break long lines by default
+    from math import inf
+
+    # the header needs to come first, otherwise cloud-init will ignore it
+    return "#cloud-config\n" + yaml.dump(user_data, width=inf)
+
+
+def make_seed_iso(path, user_data, meta_data):
+    """
+    Masters a NoCloud seed ISO image.
+
+    :param path: where to store the resulting image as Path
+    :param user_data: cloud-init user data as dictionary
+    :param meta_data: cloud-init meta data as dictionary
+    """
+
+    for tool in ["xorrisofs", "genisoimage", "mkisofs"]:
+        if shutil.which(tool) is not None:
+            break
+    else:
+        raise Exception("No ISO mastering tool found, "
+                        "install either xorriso or genisoimage")
+
+    with TemporaryDirectory(prefix="libvirt-gci-seed") as tmpdir:
+        with open(Path(tmpdir, "user-data"), "w") as fd:
+            fd.write(to_cloud_config(user_data))
+
+        with open(Path(tmpdir, "meta-data"), "w") as fd:
+            for key, value in meta_data.items():
+                fd.write(f"{key}: {value}\n")
+
+        cmd = [
+            tool,
+            "-output", str(path),
+            "-volid", "cidata",
+            "-joliet", "-rock",
+            tmpdir,
+        ]
+
+        log.debug(f"Creating cloud-init seed: {cmd}")
+        subprocess.run(cmd, capture_output=True, check=True)
+
+
+def get_smbios_serial(hostname):
+    """
+    Returns the SMBIOS system serial passing per-machine meta data.
+
+    cloud-init's NoCloud data source reads meta data from the system serial
+    number, values found there take precedence over the seed image's.
+
+    :param hostname: hostname of the machine as string
+    """
+
+    return f"ds=nocloud;h={hostname};i={hostname}"
+
+
+def _get_keys_fingerprint():
+    """
+    Fingerprints the user's SSH public keys without reading them.
+
+    The shared directories the seed mounts are part of the fingerprint, too.
+    """
+
+    from provisioner import shared_dirs
+
+    digest = sha256()
+    digest.update(repr(shared_dirs.get_boot_commands()).encode())
+    for entry in sorted(Path(Path.home(), ".ssh").glob("*.pub")):
+        st = entry.stat()
+        digest.update(f"{entry.name}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+@metrics.timed("seed_volume")
+def get_seed_volume(poolname="default"):
+    """
+    Returns a NoCloud seed volume shared by all machines.
+
+    The user data doesn't differ between machines, so the seed image is only
+    mastered and uploaded once per content. Seeds are tracked by the
+    fingerprint of the SSH keys they were built from, once the keys change,
+    the seeds built from the old keys are retired, running machines may still
+    have them attached though, so they're left to evict_seeds(). Every
+    hypervisor has seeds of its own.
+
+    :param poolname: libvirt storage pool holding the seed volumes
+    :return: name of the seed volume as string
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    libvirt_handle = LibvirtHandle()
+    keys_fingerprint = _get_keys_fingerprint()
+
+    index_path = state.state_path("seeds", hosts.state_key(), "index.json")
+    retired_path = state.state_path("seeds", hosts.state_key(),
+                                    "retired.json")
+    with state.locked(state.state_path("seeds", hosts.state_key(),
+                                       "index.lock")):
+        index = state.read_json(index_path, {})
+
+        volume = index.get(keys_fingerprint)
+        if volume is not None and libvirt_handle.has_volume(volume, poolname):
+            return volume
+
+        user_data = get_user_data()
+        content = to_cloud_config(user_data)
+        volume = f"libvirt-gci-seed-{sha256(content.encode()).hexdigest()[:16]}.iso"
+
+        if not libvirt_handle.has_volume(volume, poolname):
+            log.debug(f"Creating cloud-init seed volume '{volume}'")
+            with TemporaryDirectory(prefix="libvirt-gci") as tmpdir:
+                seed_path = Path(tmpdir, "seed.iso")
+                make_seed_iso(seed_path, user_data, {})
+                libvirt_handle.upload_volume(volume, seed_path, poolname)
+
+        # retire seeds built from keys which have been rotated since
+        retired = state.read_json(retired_path, {})
+        for fingerprint, old_volume in list(index.items()):
+            if fingerprint == keys_fingerprint:
+                continue
+
+            if old_volume != volume:
+                log.debug(f"Retiring cloud-init seed volume '{old_volume}'")
+                retired.setdefault(old_volume, {"pool": poolname,
+                                                "retired": time.time()})
+            del index[fingerprint]
+        retired.pop(volume, None)
+
+        index[keys_fingerprint] = volume
+        state.write_json(retired_path, retired)
+        state.write_json(index_path, index)
+
+    return volume
+
+
+def evict_seeds(host, ttl):
+    """
+    Deletes the retired seed volumes of a hypervisor no domain uses anymore.
+
+    A seed is only evicted once it has been retired for @ttl seconds, so a
+    machine which picked it up right before it was retired has had the time
+    to be created.
+
+    :param host: connection URI of the hypervisor
+    :param ttl: seconds a seed has to be retired for
+    :return: number of seeds evicted
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    retired_path = state.state_path("seeds", hosts.state_key(host),
+                                    "retired.json")
+    with state.locked(state.state_path("seeds", hosts.state_key(host),
+                                       "index.lock")):
+        retired = state.read_json(retired_path, {})
+        if not retired:
+            return 0
+
+        libvirt_handle = LibvirtHandle(host)
+        attached = libvirt_handle.list_attached_volumes()
+
+        now = time.time()
+        evicted = 0
+        for volume, record in list(retired.items()):
+            if volume in attached or now - record["retired"] < ttl:
+                continue
+
+            log.debug(f"Evicting cloud-init seed volume '{volume}'")
+            libvirt_handle.cleanup_storage(volume, record["pool"])
+            del retired[volume]
+            evicted += 1
+
+        state.write_json(retired_path, retired)
+    return evicted
@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import argparse
+import os
 
 
 class CmdLine:
@@ -26,6 +27,13 @@ class CmdLine:
             action="store_true",
         )
 
+        self._parsers["__main__"].add_argument(
+            "--config",
+            dest="config_file",
+            metavar="PATH",
+            help="path to the configuration file",
+        )
+
         subparsers = self._parsers["__main__"].add_subparsers(metavar="COMMAND",
                                                               dest="action")
         subparsers.required = True
@@ -55,6 +63,10 @@ class CmdLine:
             "-d", "--distro",
             help="what OS distro base image to use for provisioning",
         )
+        self._parsers["prepare"].add_argument(
+            "-p", "--profile",
+            help="resource profile to provision the machine with",
+        )
 
         self._parsers["run"].add_argument(
             "executable",
@@ -71,8 +83,152 @@ class CmdLine:
             help="Upload and execute a script instead of a command",
             action="store_true",
         )
+        self._parsers["run"].add_argument(
+            "--push",
+            metavar="SRC:DST",
+            action="append",
+            default=[],
+            help="copy a local directory to the machine before executing",
+        )
+        self._parsers["run"].add_argument(
+            "--pull",
+            metavar="SRC:DST",
+            action="append",
+            default=[],
+            help="copy a directory from the machine after executing",
+        )
+        self._parsers["run"].add_argument(
+            "--compress",
+            choices=["none", "gzip", "zstd"],
+            default="none",
+            help="compression to use for --push/--pull transfers",
+        )
+
+        self._parsers["pool"] = subparsers.add_parser(
+            "pool",
+            help="manage the warm pool of pre-booted machines",
+            parents=[sshkeyopt]
+        )
+        self._parsers["pool"].add_argument(
+            "operation",
+            choices=["status", "refill", "drain"],
+            help="status: show pool occupancy and hit/miss counts, "
+                 "refill: boot machines up to the configured targets, "
+                 "drain: destroy all unclaimed machines",
+        )
+        self._parsers["pool"].add_argument(
+            "-d", "--distro",
+            help="only operate on the given distro's pool",
+        )
+
+        self._parsers["save-state"] = subparsers.add_parser(
+            "save-state",
+            help="boot machines of a distro and save their memory states for "
+                 "restoring machines from",
+            parents=[sshkeyopt]
+        )
+        self._parsers["save-state"].add_argument(
+            "-d", "--distro",
+            required=True,
+            help="what OS distro base image to save the states of",
+        )
+        self._parsers["save-state"].add_argument(
+            "-p", "--profile",
+            help="resource profile to boot the machines with",
+        )
+
+        self._parsers["build-images"] = subparsers.add_parser(
+            "build-images",
+            help="turn template machines into base images",
+            parents=[sshkeyopt]
+        )
+        self._parsers["build-images"].add_argument(
+            "distros",
+            nargs="+",
+            metavar="DISTRO",
+            help="template machine named after the distro to build the base "
+                 "image of",
+        )
+        self._parsers["build-images"].add_argument(
+            "-j", "--workers",
+            type=int,
+            help="number of templates to process at a time",
+        )
+        self._parsers["build-images"].add_argument(
+            "--resume",
+            action="store_true",
+            help="skip the steps done by a previous, partially failed build",
+        )
+        self._parsers["build-images"].add_argument(
+            "--save-state",
+            action="store_true",
+            help="also save the memory states machines are restored from",
+        )
+        self._parsers["build-images"].add_argument(
+            "--save-state-user",
+            metavar="USER",
+            help="user gitlab-runner runs libvirt-gci as, who saves the "
+                 "memory states (default: the user who invoked sudo)",
+        )
+
+        self._parsers["gc"] = subparsers.add_parser(
+            "gc",
+            help="reap machines marked by deferred cleanups and remove "
+                 "orphaned machines and temporary files",
+        )
+
+        self._parsers["list-images"] = subparsers.add_parser(
+            "list-images",
+            help="list the template base images available for provisioning",
+        )
+
+        self._parsers["host-status"] = subparsers.add_parser(
+            "host-status",
+            help="show the host capacity available to resource profiles",
+        )
+
+        self._parsers["daemon"] = subparsers.add_parser(
+            "daemon",
+            help="serve actions of the libvirt-gci client over a UNIX socket",
+        )
+        self._parsers["daemon"].add_argument(
+            "--socket",
+            metavar="PATH",
+            help="path to the UNIX socket to listen on",
+        )
+
+    @staticmethod
+    def _resolve_paths(args, cwd):
+        def resolve(path):
+            return os.path.join(cwd, path) if path else path
+
+        for dest in ["config_file", "ssh_key_file"]:
+            if getattr(args, dest, None) is not None:
+                setattr(args, dest, resolve(getattr(args, dest)))
+
+        # a plain executable is a command run inside the machine
+        if getattr(args, "script", False) and args.executable is not None:
+            args.executable = resolve(args.executable)
+
+        # the local side of a transfer is the source of a push and the
+        # destination of a pull
+        if getattr(args, "push", None):
+            args.push = [resolve(src) + sep + dst for src, sep, dst in
+                         (transfer.partition(":") for transfer in args.push)]
+        if getattr(args, "pull", None):
+            args.pull = [src + sep + resolve(dst) for src, sep, dst in
+                         (transfer.partition(":") for transfer in args.pull)]
+
+    def parse(self, argv=None, cwd=None):
+        """
+        Parses the command line arguments (Argparse entry point).
 
-    def parse(self):
-        """Parses the command line arguments (Argparse entry point)."""
+        :param argv: list of arguments to parse instead of sys.argv
+        :param cwd: directory to resolve relative local paths against instead
+                    of the current one, e.g. a daemon client's one
+        """
 
-        return self._parsers["__main__"].parse_args()
+        args = self._parsers["__main__"].parse_args(argv)
+        if cwd is not None:
+            self._resolve_paths(args, cwd)
+        return args
@@ -4,12 +4,270 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import copy
+import json
 import logging
+import os
+
+from pathlib import Path
 
 from provisioner.singleton import Singleton
 
 log = logging.getLogger(__name__)
 
+# Configuration file locations searched in this order unless one is given
+# explicitly on the command line
+CONFIG_FILE_PATHS = [
+    Path(Path.home(), ".config", "libvirt-gci", "config.yml"),
+    Path("/etc/libvirt-gci/config.yml"),
+]
+
+# Parsed configuration files keyed by (path, mtime) so that a long-running
+# daemon doesn't re-parse the file for every request
+_settings_cache = {}
+
+# Parsing YAML is slow and PyYAML itself is expensive to import, so the parsed
+# contents of the configuration file are also kept in a JSON cache file which
+# is only refreshed when the configuration file changes
+CONFIG_CACHE_PATH = Path(os.environ.get("XDG_CACHE_HOME",
+                                        Path(Path.home(), ".cache")),
+                         "libvirt-gci", "config.json")
+
+# Settings which can only be tuned via the configuration file along with their
+# defaults. Dictionary sections are merged key by key with the file contents.
+DEFAULT_SETTINGS = {
+    "state_dir": None,
+    "libvirt": {
+        # connection URI of the libvirt daemon to create machines with
+        "uri": "qemu:///system",
+        # connection URIs of all hypervisors to spread machines across, e.g.
+        # 'qemu+ssh://root@host/system', only 'uri' is used if empty
+        "hosts": [],
+        # how a machine's hypervisor is selected out of 'hosts':
+        # 'least-loaded', 'bin-pack' or 'affinity'
+        "scheduler": "least-loaded",
+        # seconds between keepalive messages in daemon mode and how many of
+        # them may go unanswered before the connection is considered dead,
+        # None disables keepalive
+        "keepalive_interval": 5,
+        "keepalive_count": 3,
+    },
+    "pool": {
+        # number of booted instances to keep ready per distro
+        "targets": {},
+        # 'on-claim' spawns a background refill whenever prepare touches the
+        # pool, 'manual' leaves refilling to 'libvirt-gci pool refill'
+        "refill": "on-claim",
+    },
+    "provision": {
+        # 'native' creates domains through the libvirt API, 'virt-install'
+        # falls back to spawning the virt-install tool
+        "backend": "native",
+        # 'cold' boots every machine, 'restore' restores machines from the
+        # distro's saved memory states (see 'libvirt-gci save-state') while
+        # there's a free one
+        "boot": "cold",
+        # number of memory states 'libvirt-gci save-state' saves per distro,
+        # i.e. how many machines of a distro can be restored at a time
+        "restore_slots": 4,
+    },
+    "admission": {
+        # number of machines booting at the same time, further provisions
+        # are queued taking turns between GitLab projects
+        "max_boots": 4,
+        # number of machines (including warm pool members) existing at the
+        # same time, None means no limit
+        "max_machines": None,
+        # seconds to keep re-trying a failed domain creation
+        "retry_timeout": 120,
+    },
+    "profiles": {
+        # named resource profiles, each a dictionary with 'vcpus', 'memory'
+        # (in MiB) and 'disk' (in GB) keys, missing keys are taken from the
+        # built-in 'default' profile
+        "definitions": {},
+        # profile names to use for a given distro or GitLab project unless
+        # the job requests one explicitly
+        "distros": {},
+        "projects": {},
+        # memory in MiB that is never handed out to machines
+        "reserved_memory": 2048,
+        # number of vCPUs that may be committed per host CPU
+        "cpu_overcommit": 2.0,
+        # 'queue' makes prepare wait for capacity to free up, 'reject' makes
+        # it fail right away when the host is full
+        "when_full": "queue",
+        # seconds a queued prepare waits for capacity before failing
+        "queue_timeout": 1800,
+    },
+    "placement": {
+        # 'floating' lets vCPUs run on any host CPU, 'pinned' pins each vCPU
+        # to a free host CPU of a single NUMA node and binds the machine's
+        # memory to that node, machines which don't fit anywhere float
+        "mode": "floating",
+        # host CPUs never handed out to pinned machines
+        "reserved_cpus": [],
+        # NUMA memory binding of pinned machines, 'strict' or 'preferred'
+        "memory_mode": "strict",
+    },
+    "disks": {
+        # named disk I/O profiles in addition to the built-in 'default',
+        # 'ephemeral' and 'direct' ones, see disks.py for their settings
+        "definitions": {},
+        # disk profile of machines whose resource profile doesn't name one
+        "profile": "default",
+    },
+    "shared_dirs": {
+        # host directory holding a GitLab cache directory per project, which
+        # is shared with the project's machines through virtiofs, None keeps
+        # the cache inside the machines
+        "cache": None,
+        # where the cache directory is mounted in the guests, needs to match
+        # the runner's 'cache_dir'
+        "cache_mount": "/cache",
+        # let concurrent jobs of a project take POSIX and flock() locks on
+        # the cache directory, needs a virtiofsd supporting them
+        "cache_locking": True,
+        # host directory holding a builds directory per machine, which is
+        # shared with the machine through virtiofs and removed along with it,
+        # None keeps the builds inside the machines
+        "builds": None,
+        # where the builds directory is mounted in the guests, needs to match
+        # the runner's 'builds_dir'
+        "builds_mount": "/builds",
+    },
+    "mirrors": {
+        # host directory holding a bare git mirror per project, which is
+        # shared read-only with the project's machines through virtiofs and
+        # lends its objects to the clone of the get_sources stage, needs
+        # libvirt >= 11.0 and a virtiofsd supporting --readonly, None
+        # disables the mirrors
+        "dir": None,
+        # where the mirror is mounted in the guests
+        "mount": "/mirror",
+        # seconds within which a mirror isn't fetched again
+        "refresh_interval": 0,
+        # seconds a mirror fetch may take
+        "timeout": 600,
+    },
+    "cleanup": {
+        # 'sync' destroys the machine within the cleanup stage, 'deferred'
+        # only marks it for the reaper and returns right away
+        "mode": "sync",
+        # 'on-cleanup' spawns a background 'libvirt-gci gc' whenever cleanup
+        # marks a machine, 'manual' leaves reaping to a periodic
+        # 'libvirt-gci gc'
+        "reap": "on-cleanup",
+        # seconds a gitlab-* domain or volume nobody knows about, or a stale
+        # temporary file, is kept around before being removed
+        "orphan_ttl": 3600,
+        # seconds after which a machine is considered leaked by a job whose
+        # cleanup never ran, None disables it
+        "max_machine_age": 86400,
+    },
+    "metrics": {
+        # file the timings of the individual phases of every action are
+        # appended to as JSON lines, None disables it
+        "jsonl": None,
+        # file to export aggregated timings to in the Prometheus text format
+        # for node_exporter's textfile collector, None disables it
+        "textfile": None,
+    },
+    "readiness": {
+        # how to detect that a freshly booted machine is up, one of 'poll',
+        # 'tcp' or 'lease', see readiness.wait()
+        "strategy": "tcp",
+        # seconds to wait for the machine to accept SSH logins
+        "timeout": 60,
+    },
+    "images": {
+        # libvirt storage pool holding the <distro>.qcow2 template images
+        "pool": "default",
+        # number of templates 'libvirt-gci build-images' processes at a time
+        "workers": 4,
+        # seconds to wait for a template machine to shut down
+        "shutdown_timeout": 300,
+        # virt-sysprep operations turning a template machine into a template
+        "sysprep_operations": "defaults,-ssh-userdir",
+        # compact the template images into fresh sparse files after sysprep
+        "sparsify": True,
+        # user 'libvirt-gci build-images --save-state' saves the memory states
+        # as, i.e. the one gitlab-runner runs libvirt-gci as, None means the
+        # user who invoked sudo
+        "save_state_user": None,
+    },
+    "ssh": {
+        # keep a master SSH session per machine open in the background which
+        # the run stages of the job attach to instead of opening their own
+        "control_master": True,
+        # seconds an idle master waits for the next stage before exiting
+        "control_persist": 600,
+        # pass the job's stderr through as stderr instead of merging it into
+        # stdout
+        "combine_stderr": True,
+    },
+    "joblog": {
+        # bytes of a stage's output passed on to the job log as they come,
+        # None passes everything on
+        "head": None,
+        # bytes from the end of the output passed on once the stage ends if
+        # it exceeded 'head' or ended while throttled, None passes nothing on
+        "tail": 1048576,
+        # directory the output not passed on is spilled to as compressed
+        # <machine>-<stage>-<timestamp>.log.gz files, None uses the state
+        # directory, they're copied to .libvirt-gci-logs in the job's
+        # directory to be uploaded as artifacts only if the builds directory
+        # is shared (see 'shared_dirs.builds'), otherwise they stay on the
+        # runner host
+        "spill_dir": None,
+        # bytes and lines per second above which the output is suppressed
+        # until the rate drops again, None means no limit
+        "max_rate": None,
+        "max_line_rate": None,
+        # seconds the spilled output is kept before 'libvirt-gci gc' removes
+        # it, None keeps it forever
+        "retention": 604800,
+    },
+}
+
+
+def _parse_config_file(path):
+    mtime = path.stat().st_mtime_ns
+    key = (path, mtime)
+    data = _settings_cache.get(key)
+    if data is not None:
+        return data
+
+    try:
+        with open(CONFIG_CACHE_PATH, "r") as fd:
+            cached = json.load(fd)
+        if cached["path"] == str(path.resolve()) and cached["mtime"] == mtime:
+            data = cached["data"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if data is None:
+        import yaml
+
+        log.debug(f"Loading configuration file '{path}'")
+        with open(path, "r") as fd:
+            data = yaml.safe_load(fd) or {}
+
+        try:
+            CONFIG_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            tmp = Path(CONFIG_CACHE_PATH.parent, f".config.{os.getpid()}.tmp")
+            with open(tmp, "w") as fd:
+                json.dump({"path": str(path.resolve()),
+                           "mtime": mtime,
+                           "data": data}, fd)
+            os.replace(tmp, CONFIG_CACHE_PATH)
+        except (OSError, TypeError) as ex:
+            # not fatal, we'll just parse the YAML file again next time
+            log.debug(f"Failed to cache configuration: {ex}")
+
+    _settings_cache[key] = data
+    return data
+
 
 class ConfigMap(metaclass=Singleton):
     """
@@ -23,25 +281,73 @@ class ConfigMap(metaclass=Singleton):
     def __init__(self, **kwargs):
         opts = [
             "action",
+            "compress",
+            "config_file",
             "debug",
             "distro",
+            "distros",
             "executable",
             "exec_args",
             "machine",
+            "operation",
+            "profile",
+            "pull",
+            "push",
+            "resume",
+            "save_state",
+            "save_state_user",
             "script",
+            "served",
+            "socket",
             "ssh_key_file",
+            "workers",
         ]
 
         self._values = dict(zip(opts, [None] * len(opts)))
         self._values.update(kwargs)
+        self._settings = None
+
+    def _load_settings(self):
+        settings = copy.deepcopy(DEFAULT_SETTINGS)
+
+        paths = CONFIG_FILE_PATHS
+        if self._values["config_file"] is not None:
+            paths = [Path(self._values["config_file"])]
+
+        for path in paths:
+            if not path.exists():
+                continue
+
+            data = _parse_config_file(path)
+            for key, value in data.items():
+                if key not in settings:
+                    log.warning(f"Unknown configuration setting '{key}'")
+                    continue
+
+                if isinstance(settings[key], dict):
+                    settings[key].update(value or {})
+                else:
+                    settings[key] = value
+            break
+        else:
+            if self._values["config_file"] is not None:
+                raise Exception("Configuration file "
+                                f"'{self._values['config_file']}' not found")
+
+        self._settings = settings
 
     def __contains__(self, item):
-        return item in self._values
+        return item in self._values or item in DEFAULT_SETTINGS
 
     def __getitem__(self, key):
         if type(key) is not str:
             raise TypeError
 
+        if key not in self._values and key in DEFAULT_SETTINGS:
+            if self._settings is None:
+                self._load_settings()
+            return self._settings[key]
+
         return self._values[key]
 
     def __setitem__(self, key, value):
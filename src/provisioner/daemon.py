@@ -0,0 +1,178 @@
+# daemon.py - module containing the long-lived provisioner daemon
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+from provisioner import ipc
+from provisioner.singleton import Singleton
+
+log = logging.getLogger(__name__)
+
+# Per-thread request context, i.e. the client socket output is sent to and
+# whether the client asked for debugging output
+_request = threading.local()
+
+
+class _StreamRouter:
+    """
+    Replacement for sys.stdout/sys.stderr routing writes to the client.
+
+    Threads serving a request send everything written to the standard streams
+    to their client, any other thread writes to the original stream.
+    """
+
+    class _Buffer:
+        def __init__(self, router):
+            self._router = router
+
+        def write(self, data):
+            sock = getattr(_request, "sock", None)
+            if sock is None:
+                return self._router.orig.buffer.write(data)
+
+            ipc.send_frame(sock, self._router.kind, bytes(data))
+            return len(data)
+
+        def flush(self):
+            if getattr(_request, "sock", None) is None:
+                self._router.orig.buffer.flush()
+
+    def __init__(self, orig, kind):
+        self.orig = orig
+        self.kind = kind
+        self.buffer = self._Buffer(self)
+
+    def write(self, text):
+        self.buffer.write(text.encode())
+        return len(text)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def isatty(self):
+        return False
+
+
+class _RequestLogFilter(logging.Filter):
+    """Drops debug records unless the client asked for them."""
+
+    def __init__(self, debug):
+        super().__init__()
+        self.debug = debug
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        return getattr(_request, "debug", self.debug)
+
+
+class Daemon:
+    """
+    Long-lived process serving libvirt-gci actions over a UNIX socket.
+
+    Each invocation of the libvirt-gci binary by gitlab-runner otherwise has
+    to import all of the Python dependencies, open a libvirt connection and
+    establish an SSH session from scratch. The daemon keeps all of that warm
+    and the binary merely forwards its command line to it (see client.py).
+
+    Every request is handled in its own thread with its own set of singleton
+    instances, i.e. its own Application and ConfigMap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def _install_streams(debug):
+        sys.stdout = _StreamRouter(sys.stdout, ipc.STDOUT)
+        sys.stderr = _StreamRouter(sys.stderr, ipc.STDERR)
+
+        root = logging.getLogger()
+        for handler in root.handlers:
+            if isinstance(handler, logging.StreamHandler):
+                handler.setStream(sys.stderr)
+            handler.addFilter(_RequestLogFilter(debug))
+
+        # the filter decides per request whether debug records go through
+        root.setLevel(logging.DEBUG)
+
+    def _handle(self, sock):
+        from provisioner.application import Application
+        from provisioner.cmdline import CmdLine
+
+        status = None
+        failed = True
+        try:
+            kind, payload = ipc.recv_frame(sock)
+            if kind != ipc.REQUEST:
+                return
+
+            argv, environ, cwd = ipc.decode_request(payload)
+            _request.sock = sock
+            _request.debug = False
+
+            with Singleton.scope():
+                try:
+                    # the daemon is shared by all the clients, so it can't
+                    # change its working directory to the client's one
+                    args = CmdLine().parse(argv, cwd)
+                    _request.debug = args.debug
+
+                    cli_args = vars(args)
+                    cli_args["served"] = True
+                    log.debug(f"Cmdline args={cli_args}")
+
+                    failed = Application(cli_args, environ).run() < 0
+                except SystemExit as ex:
+                    # argparse exits on --help and on invalid arguments
+                    status = ex.code
+                except Exception as ex:
+                    if _request.debug:
+                        log.exception(ex)
+                    else:
+                        log.error(ex)
+
+            ipc.send_frame(sock, ipc.EXIT, ipc.encode_exit(failed, status))
+        except OSError as ex:
+            # the client went away
+            log.debug(f"Request aborted: {ex}")
+        finally:
+            _request.sock = None
+            sock.close()
+
+    def serve(self, debug=False):
+        """Serves requests until the process gets terminated."""
+
+        self._install_streams(debug)
+
+        # make sure the socket gets removed when the service is stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(self.path))
+        os.chmod(self.path, 0o600)
+        server.listen()
+
+        log.debug(f"Listening on '{self.path}'")
+        try:
+            while True:
+                sock, _ = server.accept()
+                threading.Thread(target=self._handle, args=(sock,),
+                                 daemon=True).start()
+        finally:
+            server.close()
+            os.unlink(self.path)
@@ -0,0 +1,100 @@
+# disks.py - module containing the disk I/O tuning profiles
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from provisioner.configmap import ConfigMap
+
+# Settings of a disk profile, profiles inherit anything they don't specify
+# from here, which leaves everything to the libvirt/QEMU defaults
+DEFAULT_DISK_PROFILE = {
+    # overlay creation options
+    "cluster_size": None,       # KiB, e.g. 64 or 2048
+    "lazy_refcounts": False,
+    "preallocation": "off",     # only 'off', see select()
+    # domain disk options
+    "cache": None,              # e.g. 'none', 'writeback' or 'unsafe'
+    "io": None,                 # 'threads', 'native' or 'io_uring'
+    "discard": None,            # 'unmap' or 'ignore'
+    "iothreads": 0,             # number of dedicated I/O threads
+}
+
+# Built-in profiles. The overlays are thrown away with the machine, so there's
+# no point in paying for crash consistency.
+BUILTIN_DISK_PROFILES = {
+    "default": {},
+    # guest flushes are ignored and writes land in the host page cache
+    "ephemeral": {
+        "lazy_refcounts": True,
+        "cache": "unsafe",
+        "io": "threads",
+        "discard": "unmap",
+        "iothreads": 1,
+    },
+    # bypasses the host page cache, for hosts short on memory
+    "direct": {
+        "lazy_refcounts": True,
+        "cache": "none",
+        "io": "native",
+        "discard": "unmap",
+        "iothreads": 1,
+    },
+}
+
+
+def get_profiles():
+    """
+    Returns all known disk profiles.
+
+    :return: dictionary of profile name -> disk profile dictionary
+    """
+
+    definitions = dict(BUILTIN_DISK_PROFILES)
+    definitions.update(ConfigMap()["disks"]["definitions"])
+
+    profiles = {}
+    for name, definition in definitions.items():
+        profile = dict(DEFAULT_DISK_PROFILE)
+        profile.update(definition or {})
+        profile["name"] = name
+        profiles[name] = profile
+    return profiles
+
+
+def select(requested=None):
+    """
+    Selects the disk profile for a machine.
+
+    :param requested: disk profile name requested by the machine's resource
+                      profile as string, the 'disks.profile' setting is used
+                      if None
+    :return: disk profile dictionary
+    """
+
+    name = requested
+    if name is None:
+        name = ConfigMap()["disks"]["profile"]
+
+    profiles = get_profiles()
+    if name not in profiles:
+        raise Exception(f"Unknown disk profile '{name}'")
+
+    profile = profiles[name]
+
+    # QEMU would only refuse to start the machine
+    if profile["io"] == "native" and profile["cache"] not in ["none",
+                                                              "directsync"]:
+        raise Exception(f"Disk profile '{name}': io 'native' requires cache "
+                        "'none' or 'directsync'")
+    # every volume is an overlay, neither libvirt nor QEMU (short of
+    # extended L2 entries) preallocate metadata of an image with a backing
+    # file
+    if profile["preallocation"] == "metadata":
+        raise Exception(f"Disk profile '{name}': preallocation 'metadata' "
+                        "isn't supported by overlays")
+    if profile["preallocation"] != "off":
+        raise Exception(f"Disk profile '{name}': unknown preallocation "
+                        f"'{profile['preallocation']}'")
+
+    return profile
@@ -0,0 +1,287 @@
+# domain_xml.py - module containing the libvirt domain XML builder
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import xml.etree.ElementTree as xmlparser
+
+from xml.etree.ElementTree import SubElement
+
+
+class DomainXML:
+    """
+    Builder of transient domain definitions.
+
+    The resulting definition mirrors what virt-install produces for the
+    provisioner's command line, i.e. a q35 KVM guest with a virtio disk and
+    network, a serial PTY console and no graphics or sound.
+
+    The usual flow of actions is as follows:
+        xml = DomainXML(name, vcpus=4, memory=8192)
+        xml.add_disk(pool, volume)
+        xml.add_cdrom(pool, seed_volume)
+        xml.add_interface("default")
+        xml.set_smbios_serial(serial)
+        conn.createXML(xml.to_string())
+    """
+
+    def __init__(self, name, vcpus, memory):
+        """
+        :param name: name of the domain as string
+        :param vcpus: number of virtual CPUs as int
+        :param memory: amount of memory in MiB as int
+        """
+
+        self.root = xmlparser.Element("domain", type="kvm")
+        SubElement(self.root, "name").text = name
+        SubElement(self.root, "memory", unit="MiB").text = str(memory)
+        SubElement(self.root, "vcpu").text = str(vcpus)
+
+        os_node = SubElement(self.root, "os")
+        SubElement(os_node, "type", arch="x86_64", machine="q35").text = "hvm"
+        SubElement(os_node, "boot", dev="hd")
+
+        features = SubElement(self.root, "features")
+        SubElement(features, "acpi")
+        SubElement(features, "apic")
+
+        SubElement(self.root, "cpu", mode="host-passthrough")
+
+        clock = SubElement(self.root, "clock", offset="utc")
+        SubElement(clock, "timer", name="rtc", tickpolicy="catchup")
+        SubElement(clock, "timer", name="pit", tickpolicy="delay")
+        SubElement(clock, "timer", name="hpet", present="no")
+
+        SubElement(self.root, "on_poweroff").text = "destroy"
+        SubElement(self.root, "on_reboot").text = "restart"
+        SubElement(self.root, "on_crash").text = "destroy"
+
+        self.devices = SubElement(self.root, "devices")
+        self._disks = 0
+
+        serial = SubElement(self.devices, "serial", type="pty")
+        SubElement(serial, "target", port="0")
+        console = SubElement(self.devices, "console", type="pty")
+        SubElement(console, "target", type="serial", port="0")
+
+        rng = SubElement(self.devices, "rng", model="virtio")
+        SubElement(rng, "backend", model="random").text = "/dev/urandom"
+
+    def add_disk(self, pool, volume, fmt="qcow2", **driver):
+        """
+        Attaches a storage volume as a virtio disk.
+
+        :param pool: name of the storage pool as string
+        :param volume: name of the volume within @pool as string
+        :param fmt: format of the volume as string
+        :param driver: additional attributes of the disk's driver element,
+                       e.g. cache or io, None values are left out
+        """
+
+        disk = SubElement(self.devices, "disk", type="volume", device="disk")
+        SubElement(disk, "driver", name="qemu", type=fmt,
+                   **{k: str(v) for k, v in driver.items() if v is not None})
+        SubElement(disk, "source", pool=pool, volume=volume)
+        SubElement(disk, "target", dev="vd" + chr(ord("a") + self._disks),
+                   bus="virtio")
+        self._disks += 1
+        return disk
+
+    def set_memory_backing(self, hugepages=False, locked=False, shared=True,
+                           hard_limit=None, memfd=False):
+        """
+        Sets how the guest memory is backed on the host.
+
+        :param hugepages: back the guest memory with huge pages
+        :param locked: keep the guest memory from being swapped out
+        :param shared: let KSM merge identical pages with other guests
+        :param hard_limit: memory limit of the whole QEMU process in MiB,
+                           QEMU requires one for locked memory
+        :param memfd: back the guest memory by a memfd accessible to other
+                      processes, which virtiofs requires
+        """
+
+        backing = SubElement(self.root, "memoryBacking")
+        if hugepages:
+            SubElement(backing, "hugepages")
+        if locked:
+            SubElement(backing, "locked")
+        if not shared:
+            SubElement(backing, "nosharepages")
+        if memfd:
+            SubElement(backing, "source", type="memfd")
+            SubElement(backing, "access", mode="shared")
+
+        if hard_limit is not None:
+            memtune = SubElement(self.root, "memtune")
+            SubElement(memtune, "hard_limit", unit="MiB").text = str(hard_limit)
+
+    def add_memballoon(self, free_page_reporting=False, stats_period=None):
+        """
+        Attaches a virtio memory balloon.
+
+        :param free_page_reporting: let the guest hand memory it frees back
+                                    to the host
+        :param stats_period: seconds between guest memory statistics updates
+        """
+
+        attrs = {"model": "virtio"}
+        if free_page_reporting:
+            attrs["freePageReporting"] = "on"
+
+        balloon = SubElement(self.devices, "memballoon", **attrs)
+        if stats_period is not None:
+            SubElement(balloon, "stats", period=str(stats_period))
+        return balloon
+
+    def add_filesystem(self, source, tag, locking=False, readonly=False):
+        """
+        Shares a host directory with the guest through virtiofs.
+
+        The guest memory needs to be backed by a memfd, see
+        set_memory_backing().
+
+        :param source: host directory to share as string
+        :param tag: tag the guest mounts the directory by as string
+        :param locking: support POSIX and flock() locks in the directory
+        :param readonly: let virtiofsd refuse any writes to the directory, so
+                         the guest can't just remount it read-write
+        """
+
+        filesystem = SubElement(self.devices, "filesystem", type="mount",
+                                accessmode="passthrough")
+        SubElement(filesystem, "driver", type="virtiofs")
+        if locking:
+            binary = SubElement(filesystem, "binary")
+            SubElement(binary, "lock", posix="on", flock="on")
+        SubElement(filesystem, "source", dir=source)
+        SubElement(filesystem, "target", dir=tag)
+        if readonly:
+            SubElement(filesystem, "readonly")
+        return filesystem
+
+    @classmethod
+    def from_string(cls, xml):
+        """Wraps an existing domain definition, e.g. a saved domain's one."""
+
+        self = cls.__new__(cls)
+        self.root = xmlparser.fromstring(xml)
+        self.devices = self.root.find("devices")
+        self._disks = len(self.devices.findall("disk[@device='disk']"))
+        return self
+
+    def set_placement(self, cpus=None, node=None, memory_mode="strict"):
+        """
+        Pins the vCPUs to host CPUs and binds the memory to a NUMA node.
+
+        Any previous placement is replaced, no @cpus let the vCPUs float.
+
+        :param cpus: list of host CPUs, one for every vCPU
+        :param node: number of the NUMA node to bind the memory to
+        :param memory_mode: 'strict' or 'preferred'
+        """
+
+        for tag in ["cputune", "numatune"]:
+            for element in self.root.findall(tag):
+                self.root.remove(element)
+
+        if cpus is None:
+            return
+
+        cputune = SubElement(self.root, "cputune")
+        for vcpu, host_cpu in enumerate(cpus):
+            SubElement(cputune, "vcpupin", vcpu=str(vcpu),
+                       cpuset=str(host_cpu))
+        SubElement(cputune, "emulatorpin",
+                   cpuset=",".join(str(host_cpu) for host_cpu in cpus))
+
+        numatune = SubElement(self.root, "numatune")
+        SubElement(numatune, "memory", mode=memory_mode, nodeset=str(node))
+
+    def set_iothreads(self, count):
+        """
+        Gives the domain dedicated I/O threads for its disks.
+
+        :param count: number of I/O threads as int
+        """
+
+        SubElement(self.root, "iothreads").text = str(count)
+
+    def add_cdrom(self, pool, volume):
+        """
+        Attaches a read-only ISO volume, e.g. a cloud-init seed.
+
+        :param pool: name of the storage pool as string
+        :param volume: name of the volume within @pool as string
+        """
+
+        disk = SubElement(self.devices, "disk", type="volume", device="cdrom")
+        SubElement(disk, "driver", name="qemu", type="raw")
+        SubElement(disk, "source", pool=pool, volume=volume)
+        SubElement(disk, "target", dev="sda", bus="sata")
+        SubElement(disk, "readonly")
+        return disk
+
+    @staticmethod
+    def _build_interface(parent, network):
+        iface = SubElement(parent, "interface", type="network")
+        SubElement(iface, "source", network=network)
+        SubElement(iface, "model", type="virtio")
+        return iface
+
+    def add_interface(self, network):
+        """
+        Attaches a virtio NIC to a libvirt virtual network.
+
+        :param network: name of the libvirt network as string
+        """
+
+        return self._build_interface(self.devices, network)
+
+    @staticmethod
+    def interface_to_string(network):
+        """
+        Returns a stand-alone NIC definition for hot-plugging.
+
+        :param network: name of the libvirt network as string
+        """
+
+        devices = xmlparser.Element("devices")
+        iface = DomainXML._build_interface(devices, network)
+        return xmlparser.tostring(iface, encoding="unicode")
+
+    def add_guest_agent(self):
+        """Attaches the virtio-serial channel of the QEMU guest agent."""
+
+        channel = SubElement(self.devices, "channel", type="unix")
+        SubElement(channel, "target", type="virtio",
+                   name="org.qemu.guest_agent.0")
+        return channel
+
+    def set_genid(self):
+        """
+        Gives the domain a VM generation ID.
+
+        Domains restored from a saved state get a new ID (see
+        saved_state.py), which tells the guest to e.g. reseed its random
+        number generator.
+        """
+
+        SubElement(self.root, "genid")
+
+    def set_smbios_serial(self, serial):
+        """
+        Sets the SMBIOS system serial number the guest sees.
+
+        :param serial: the serial number as string
+        """
+
+        SubElement(self.root.find("os"), "smbios", mode="sysinfo")
+
+        sysinfo = SubElement(self.root, "sysinfo", type="smbios")
+        system = SubElement(sysinfo, "system")
+        SubElement(system, "entry", name="serial").text = serial
+
+    def to_string(self):
+        return xmlparser.tostring(self.root, encoding="unicode")
@@ -0,0 +1,163 @@
+# hosts.py - module containing the hypervisor selection and routing
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from hashlib import sha256
+from urllib.parse import urlparse
+
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Connection URI of the hypervisor the code running in this context operates
+# on, see host() below
+_current_uri = ContextVar("libvirt_uri", default=None)
+
+
+def get_hosts():
+    """Returns the connection URIs of all configured hypervisors."""
+
+    settings = ConfigMap()["libvirt"]
+    return settings["hosts"] or [settings["uri"]]
+
+
+def current_uri():
+    """Returns the connection URI of the hypervisor to operate on."""
+
+    uri = _current_uri.get()
+    if uri is None:
+        uri = ConfigMap()["libvirt"]["uri"]
+    return uri
+
+
+@contextmanager
+def host(uri):
+    """
+    Context manager routing all libvirt operations to a hypervisor.
+
+    LibvirtHandle() and the state kept per hypervisor (e.g. seed volumes or
+    vCPU placements) refer to @uri within the block.
+
+    :param uri: connection URI of the hypervisor, None means the default one
+    """
+
+    token = _current_uri.set(uri)
+    try:
+        yield
+    finally:
+        _current_uri.reset(token)
+
+
+def is_remote(uri):
+    """Checks whether the hypervisor runs on another machine."""
+
+    return urlparse(uri).hostname not in [None, "", "localhost"]
+
+
+def state_key(uri=None):
+    """
+    Returns a file name safe key of a hypervisor for the state directory.
+
+    :param uri: connection URI of the hypervisor, the current one if None
+    """
+
+    if uri is None:
+        uri = current_uri()
+    return sha256(uri.encode()).hexdigest()[:12]
+
+
+def _count_distro_machines(uri, distro):
+    count = 0
+    for path in state.state_path("machines", "").glob("*.json"):
+        record = state.read_json(path)
+        if (record is not None and record["distro"] == distro and
+                record.get("host") == uri):
+            count += 1
+    return count
+
+
+def _get_candidate(uri, distro, profile):
+    """
+    Evaluates a hypervisor for a machine.
+
+    :return: dictionary with 'uri', 'fits' and 'load' keys or None if the
+             machine can't be placed on the hypervisor at all
+    """
+
+    from provisioner import profiles
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    with host(uri):
+        try:
+            libvirt_handle = LibvirtHandle()
+            libvirt_handle.get_base_image(distro)
+            capacity = libvirt_handle.get_host_capacity()
+        except Exception as ex:
+            log.debug(f"Host '{uri}' can't take '{distro}' machines: {ex}")
+            return None
+
+        if profiles.is_oversized(profile, capacity):
+            return None
+
+        limits = profiles.get_limits(capacity)
+        return {
+            "uri": uri,
+            "fits": profiles.check(profile, capacity) is None,
+            "load": max(capacity["committed_vcpus"] / limits["vcpus"],
+                        capacity["committed_memory"] / limits["memory"]),
+        }
+
+
+def select(distro, profile):
+    """
+    Selects the hypervisor to provision a machine on.
+
+    Only hypervisors which are reachable and have the distro's base image are
+    considered, those with enough free capacity for the machine are preferred.
+    Among those, 'libvirt.scheduler' decides:
+        least-loaded - the one with the lowest share of committed resources
+        bin-pack     - the one with the highest share of committed resources,
+                       leaving the others free for large machines
+        affinity     - the one running the most machines of the distro, whose
+                       memory KSM can share and whose base image is cached
+                       already, ties are broken by the load
+
+    :param distro: distro the machine is provisioned from as string
+    :param profile: resource profile dictionary of the machine
+    :return: connection URI of the selected hypervisor
+    """
+
+    uris = get_hosts()
+    if len(uris) == 1:
+        return uris[0]
+
+    candidates = [c for c in (_get_candidate(uri, distro, profile)
+                              for uri in uris) if c is not None]
+    if not candidates:
+        raise Exception(f"No host can provision '{distro}' machines with "
+                        f"resource profile '{profile['name']}'")
+
+    scheduler = ConfigMap()["libvirt"]["scheduler"]
+    if scheduler == "least-loaded":
+        def key(c):
+            return (not c["fits"], c["load"])
+    elif scheduler == "bin-pack":
+        def key(c):
+            return (not c["fits"], -c["load"])
+    elif scheduler == "affinity":
+        def key(c):
+            return (not c["fits"],
+                    -_count_distro_machines(c["uri"], distro), c["load"])
+    else:
+        raise Exception(f"Unknown scheduler '{scheduler}'")
+
+    selected = min(candidates, key=key)["uri"]
+    log.debug(f"Selected host '{selected}' out of {candidates}")
+    return selected
@@ -0,0 +1,250 @@
+# images.py - module containing the template base image build pipeline
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextvars
+import logging
+import os
+import subprocess
+import time
+
+from pathlib import Path
+
+from provisioner import hosts
+from provisioner import metrics
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Steps turning a template machine into a base image, in order
+STEPS = ["shutdown", "sysprep", "sparsify", "save-state"]
+
+
+def _progress_path(name="progress.json"):
+    return state.state_path("images", "build", hosts.state_key(), name)
+
+
+def _get_progress(distro):
+    return state.read_json(_progress_path(), {}).get(distro)
+
+
+def _set_progress(distro, record):
+    with state.locked(_progress_path("progress.lock")):
+        progress_path = _progress_path()
+        progress = state.read_json(progress_path, {})
+        if record is None:
+            progress.pop(distro, None)
+        else:
+            progress[distro] = record
+        state.write_json(progress_path, progress)
+
+
+def _get_allocation(path):
+    return os.stat(path).st_blocks * 512
+
+
+def _run(cmd, timeout=None):
+    log.debug(f"Running {cmd}")
+    try:
+        subprocess.run(cmd, capture_output=True, check=True, text=True,
+                       timeout=timeout)
+    except subprocess.CalledProcessError as ex:
+        # the last lines of libguestfs' output usually tell what went wrong
+        output = (ex.stderr or ex.stdout or "").strip().splitlines()
+        raise Exception(f"'{cmd[0]}' failed: {' '.join(output[-3:])}")
+
+
+def _sysprep(distro):
+    settings = ConfigMap()["images"]
+    _run(["virt-sysprep", "--quiet",
+          "--connect", hosts.current_uri(),
+          "--operations", settings["sysprep_operations"],
+          "--domain", distro])
+
+
+def _sparsify(distro):
+    """
+    Compacts a template image into a fresh, sparse qcow2 file.
+
+    Freed guest blocks are dropped and the remaining clusters are written out
+    in order, so the overlays of the machines read from a smaller, less
+    fragmented file. The image is replaced atomically, machines still running
+    on top of the old file keep using it.
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    libvirt_handle = LibvirtHandle()
+    path = Path(libvirt_handle.get_base_image(distro)["path"])
+    before = _get_allocation(path)
+
+    tmp = Path(path.parent, f".{path.name}.{os.getpid()}.tmp")
+    try:
+        _run(["virt-sparsify", "--quiet",
+              "--format", "qcow2", "--convert", "qcow2",
+              "--tmp", str(path.parent),
+              str(path), str(tmp)])
+
+        stat = path.stat()
+        os.chown(tmp, stat.st_uid, stat.st_gid)
+        os.chmod(tmp, stat.st_mode)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    libvirt_handle.refresh_pool(ConfigMap()["images"]["pool"])
+
+    after = _get_allocation(path)
+    log.debug(f"Sparsified '{path}': {before} -> {after} bytes")
+    return f"{before / 1024 ** 3:.1f} -> {after / 1024 ** 3:.1f} GiB"
+
+
+def _save_state(distro, ssh_key_path, user):
+    """
+    Saves a distro's memory states.
+
+    The states are recorded in the state directory of the user saving them,
+    which needs to be the one gitlab-runner runs libvirt-gci as, so unless
+    that's the current user, 'libvirt-gci save-state' is run as @user.
+    """
+
+    from provisioner import profiles
+    from provisioner import saved_state
+
+    if user is None:
+        saved_state.save(distro, profiles.select(distro), ssh_key_path)
+        return
+
+    configmap = ConfigMap()
+
+    cmd = ["sudo", "--non-interactive", "--user", user, "libvirt-gci"]
+    if configmap["config_file"] is not None:
+        cmd += ["--config", str(Path(configmap["config_file"]).resolve())]
+    cmd += ["save-state", "--distro", distro]
+    if ssh_key_path is not None:
+        cmd += ["--ssh-key-file", str(ssh_key_path)]
+    _run(cmd)
+
+
+def _get_mtime(distro):
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    return LibvirtHandle().get_base_image(distro)["mtime"]
+
+
+def build(distro, steps, resume=False, ssh_key_path=None,
+          save_state_user=None):
+    """
+    Turns a distro's template machine into its base image.
+
+    The template machine is named after the distro and its disk is the
+    distro's template image. Every finished step is recorded along with the
+    image's modification time, so a build resumed after a failure skips the
+    steps which were done already, unless the image changed since.
+
+    :param distro: name of the distro as string
+    :param steps: names of the steps to run as list of strings, see STEPS
+    :param resume: whether to skip the steps done by a previous build
+    :param ssh_key_path: path to the SSH key to verify the machines booted
+                         by the 'save-state' step with, None lets
+                         @save_state_user pick its own
+    :param save_state_user: user to run the 'save-state' step as, None for
+                            the current one
+    :return: dictionary with the duration in seconds (or None if skipped)
+             and a note of every step in 'timings' and 'notes' and the error
+             as string in 'error' if a step failed
+    """
+
+    settings = ConfigMap()["images"]
+
+    progress = _get_progress(distro) if resume else None
+    done = []
+    if progress is not None and progress["mtime"] == _get_mtime(distro):
+        done = progress["steps"]
+    elif not resume:
+        _set_progress(distro, None)
+
+    result = {"timings": {}, "notes": {}, "error": None}
+    for step in steps:
+        if step in done:
+            log.debug(f"Skipping '{step}' of '{distro}', done already")
+            result["timings"][step] = None
+            continue
+
+        start = time.monotonic()
+        try:
+            with metrics.span(f"build_{step.replace('-', '_')}",
+                              distro=distro):
+                if step == "shutdown":
+                    from provisioner.libvirt_handle import LibvirtHandle
+
+                    LibvirtHandle().shutdown_domain(
+                        distro, settings["shutdown_timeout"])
+                elif step == "sysprep":
+                    _sysprep(distro)
+                elif step == "sparsify":
+                    result["notes"][step] = _sparsify(distro)
+                elif step == "save-state":
+                    _save_state(distro, ssh_key_path, save_state_user)
+        except Exception as ex:
+            result["timings"][step] = time.monotonic() - start
+            result["error"] = f"{step}: {ex}"
+            return result
+
+        result["timings"][step] = time.monotonic() - start
+        done = done + [step]
+        _set_progress(distro, {"steps": done, "mtime": _get_mtime(distro)})
+
+    return result
+
+
+def build_all(distros, steps, workers, resume=False, ssh_key_path=None,
+              save_state_user=None, report=None):
+    """
+    Builds the base images of several distros concurrently.
+
+    The steps of a single distro run one after another, @workers distros are
+    processed at a time.
+
+    :param distros: names of the distros as list of strings
+    :param steps: names of the steps to run as list of strings, see STEPS
+    :param workers: number of distros processed at a time
+    :param resume: whether to skip the steps done by previous builds
+    :param ssh_key_path: see build()
+    :param save_state_user: see build()
+    :param report: callback invoked with the distro and its result (see
+                   build()) as soon as the distro is done
+    :return: dictionary of distro name -> result of build()
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if hosts.is_remote(hosts.current_uri()):
+        raise Exception("Base images can only be built on the local "
+                        "hypervisor")
+
+    def run(distro):
+        result = build(distro, steps, resume, ssh_key_path, save_state_user)
+        if report is not None:
+            report(distro, result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1),
+                            thread_name_prefix="build") as executor:
+        # every worker needs to see the scoped configuration
+        futures = {
+            distro: executor.submit(contextvars.copy_context().run, run,
+                                    distro)
+            for distro in distros
+        }
+
+    results = {}
+    for distro, future in futures.items():
+        try:
+            results[distro] = future.result()
+        except Exception as ex:
+            results[distro] = {"timings": {}, "notes": {}, "error": str(ex)}
+    return results
@@ -0,0 +1,124 @@
+# ipc.py - module containing the daemon wire protocol primitives
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import struct
+
+# Frames are a single type byte followed by a 32-bit payload length
+HEADER = struct.Struct("!cI")
+
+REQUEST = b"R"
+STDOUT = b"O"
+STDERR = b"E"
+EXIT = b"X"
+ERROR = b"!"
+
+# Exit frame payload: failed flag, status present flag, status
+EXIT_STATUS = struct.Struct("!??i")
+
+
+def socket_path():
+    """
+    Returns the path of the daemon's UNIX socket.
+
+    This is deliberately not part of the configuration file, so that the
+    client doesn't need to parse it before forwarding a request.
+
+    :return: path as string
+    """
+
+    path = os.environ.get("LIBVIRT_GCI_SOCKET")
+    if path is not None:
+        return path
+
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}")
+    return os.path.join(runtime_dir, "libvirt-gci.sock")
+
+
+def send_frame(sock, kind, payload=b""):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    """
+    Receives a single frame.
+
+    :return: tuple of (kind, payload), (None, None) once the peer hung up
+    """
+
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None, None
+
+    kind, size = HEADER.unpack(header)
+    payload = _recv_exact(sock, size)
+    if payload is None:
+        return None, None
+
+    return kind, payload
+
+
+# The messages are deliberately not JSON, the json module pulls in the regular
+# expression engine which would double the client's startup time
+
+
+def encode_request(argv, environ, cwd=""):
+    """
+    Encodes the command line, environment and working directory of a request.
+    """
+
+    # arguments may be empty strings, so they're counted rather than
+    # terminated by an empty field
+    fields = ([str(len(argv)), cwd] + list(argv) +
+              [f"{k}={v}" for k, v in environ.items()])
+    return "\0".join(fields).encode()
+
+
+def decode_request(payload):
+    """
+    Decodes a request payload.
+
+    :return: tuple of (argv list, environment dictionary, working directory
+             or None)
+    """
+
+    count, cwd, *fields = payload.decode().split("\0")
+    count = int(count)
+    environ = dict(f.split("=", 1) for f in fields[count:])
+    return fields[:count], environ, cwd or None
+
+
+def encode_exit(failed, status=None):
+    """
+    Encodes the result of a request.
+
+    :param failed: whether the action failed as bool
+    :param status: explicit exit status, e.g. when the command line couldn't be
+                   parsed, as int or None
+    """
+
+    return EXIT_STATUS.pack(failed, status is not None, status or 0)
+
+
+def decode_exit(payload):
+    """
+    Decodes the result of a request.
+
+    :return: tuple of (failed, status) where status may be None
+    """
+
+    failed, has_status, status = EXIT_STATUS.unpack(payload)
+    return failed, status if has_status else None
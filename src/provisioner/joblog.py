@@ -0,0 +1,280 @@
+# joblog.py - module containing the bounded job log output stage
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import time
+
+from pathlib import Path
+
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Prefix of the notices inserted into the job log
+NOTICE_PREFIX = b"[libvirt-gci] "
+
+# Directory within the job's CI_PROJECT_DIR the spill files are copied to, so
+# they can be uploaded as artifacts
+ARTIFACT_DIR = ".libvirt-gci-logs"
+
+
+def enabled():
+    """Checks whether any limit is imposed on the job log."""
+
+    settings = ConfigMap()["joblog"]
+    return any(settings[key] is not None
+               for key in ["head", "max_rate", "max_line_rate"])
+
+
+def _spill_dir():
+    spill_dir = ConfigMap()["joblog"]["spill_dir"]
+    if spill_dir is None:
+        return state.state_path("logs", "")
+    return Path(spill_dir)
+
+
+class JobLog:
+    """
+    Binary stream passing a command's output on to the job log within limits.
+
+    Only the first 'joblog.head' bytes of the output are passed on as they
+    come, of the rest only the last 'joblog.tail' bytes are kept and passed on
+    once the output ends. While the output exceeds 'joblog.max_rate' bytes or
+    'joblog.max_line_rate' lines per second, it's suppressed until the rate
+    drops again, when a summary of what was suppressed is passed on. If the
+    output ends while suppressed, the summary is followed by the tail too.
+
+    Whatever isn't passed on right away is spilled to a gzip compressed file
+    in 'joblog.spill_dir', so the memory used doesn't depend on the amount of
+    output. The spill file is on the runner host, where the job's artifact
+    upload can't reach it, unless it's copied into the job's directory.
+    """
+
+    def __init__(self, out, name, artifact_dir=None):
+        """
+        :param out: binary stream the job log is written to
+        :param name: name of the spill file, without extension and timestamp,
+                     as string
+        :param artifact_dir: tuple of (host Path, path inside the machine as
+                             string) of a directory shared with the machine
+                             to copy the spill file to once the output ends,
+                             None keeps it on the runner host only
+        """
+
+        settings = ConfigMap()["joblog"]
+
+        self.out = out
+        self.name = name
+        self.artifact_dir = artifact_dir
+        self.head = settings["head"]
+        self.tail = settings["tail"] or 0
+        self.max_rate = settings["max_rate"]
+        self.max_line_rate = settings["max_line_rate"]
+
+        self.total = 0
+        self.passed = 0
+        self.overflow = 0
+        self.kept = 0
+        self.spilled = 0
+        self.spill_path = None
+        self._spill = None
+        self._tail = bytearray()
+        self._newline = True
+
+        # rate limiting state, counted over one second windows
+        self._window = time.monotonic()
+        self._window_bytes = 0
+        self._window_lines = 0
+        self._throttled = None
+        self._suppressed_bytes = 0
+        self._suppressed_lines = 0
+
+    def _pass(self, data):
+        self.out.write(data)
+        self.passed += len(data)
+        self._newline = data.endswith(b"\n")
+
+    def _notice(self, message):
+        notice = NOTICE_PREFIX + message.encode() + b"\n"
+        if not self._newline:
+            notice = b"\n" + notice
+        self.out.write(notice)
+        self._newline = True
+
+    def _spill_data(self, data):
+        if self._spill is None:
+            import gzip
+
+            spill_dir = _spill_dir()
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            # a re-run of the stage must not overwrite the earlier spill
+            self.spill_path = Path(spill_dir,
+                                   f"{self.name}-{time.time_ns()}.log.gz")
+            log.debug(f"Spilling job log to '{self.spill_path}'")
+
+            # the fastest level keeps up with a runaway producer
+            self._spill = gzip.open(self.spill_path, "wb", compresslevel=1)
+
+        self._spill.write(data)
+        self.spilled += len(data)
+
+    def _location(self):
+        """Returns where the spilled output can be found as string."""
+
+        if self.artifact_dir is not None:
+            return f"{self.artifact_dir[1]}/{self.spill_path.name}"
+        return f"{self.spill_path} on the runner host"
+
+    def _publish(self):
+        import shutil
+
+        host_dir = self.artifact_dir[0]
+        try:
+            host_dir.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self.spill_path, Path(host_dir,
+                                                  self.spill_path.name))
+        except OSError as ex:
+            log.debug(f"Failed to copy '{self.spill_path}' to '{host_dir}': "
+                      f"{ex}")
+            self.artifact_dir = None
+
+    def _keep(self, data):
+        """Keeps data which isn't passed on right away for the tail."""
+
+        self.kept += len(data)
+        self._tail += data
+        if len(self._tail) > 2 * self.tail:
+            del self._tail[:len(self._tail) - self.tail]
+
+    def _end_throttling(self, now):
+        self._notice(f"output throttled for {now - self._throttled:.0f}s, "
+                     f"suppressed {self._suppressed_lines} lines "
+                     f"({self._suppressed_bytes} bytes), see "
+                     f"{self._location()}")
+        self._throttled = None
+        self._suppressed_bytes = 0
+        self._suppressed_lines = 0
+
+        # the output goes on live, the suppressed part's tail is of no use
+        if self.overflow == 0:
+            self._tail.clear()
+            self.kept = 0
+
+    def _is_throttled(self, data):
+        if self.max_rate is None and self.max_line_rate is None:
+            return False
+
+        now = time.monotonic()
+        if now - self._window >= 1:
+            if (self._throttled is not None and
+                    (self.max_rate is None or
+                     self._window_bytes <= self.max_rate) and
+                    (self.max_line_rate is None or
+                     self._window_lines <= self.max_line_rate)):
+                self._end_throttling(now)
+
+            self._window = now
+            self._window_bytes = 0
+            self._window_lines = 0
+
+        self._window_bytes += len(data)
+        self._window_lines += data.count(b"\n")
+
+        if self._throttled is None and (
+                self.max_rate is not None and
+                self._window_bytes > self.max_rate or
+                self.max_line_rate is not None and
+                self._window_lines > self.max_line_rate):
+            self._throttled = now
+        return self._throttled is not None
+
+    def write(self, data):
+        size = len(data)
+        self.total += size
+
+        if self.head is not None and self.passed + len(data) > self.head:
+            # pass on what still fits, the rest only makes it into the tail
+            room = max(self.head - self.passed, 0)
+            if room > 0 and self._throttled is None:
+                self._pass(data[:room])
+                data = data[room:]
+
+            self._spill_data(data)
+            self.overflow += len(data)
+            self._keep(data)
+        elif self._is_throttled(data):
+            self._spill_data(data)
+            self._suppressed_bytes += len(data)
+            self._suppressed_lines += data.count(b"\n")
+            self._keep(data)
+        else:
+            self._pass(data)
+
+        # everything was accepted, even what only made it into the tail
+        return size
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        """Passes the tail of the output on and finishes the spill file."""
+
+        if self._spill is None:
+            self.out.flush()
+            return
+
+        self._spill.close()
+        if self.artifact_dir is not None:
+            self._publish()
+
+        # the last lines usually tell how the stage went, keep them even if
+        # the output ended while throttled
+        tail = bytes(self._tail[len(self._tail) - self.tail:])
+        if len(tail) < self.kept and b"\n" in tail[:-1]:
+            # don't start the tail in the middle of a line
+            tail = tail[tail.index(b"\n") + 1:]
+
+        if self._throttled is not None:
+            self._end_throttling(time.monotonic())
+
+        if self.overflow > 0:
+            self._notice(f"output exceeded {self.head} bytes, "
+                         f"{self.kept - len(tail)} bytes omitted, see "
+                         f"{self._location()}")
+        elif tail:
+            self._notice(f"last {len(tail)} bytes of the suppressed output:")
+        if tail:
+            self._pass(tail)
+        self.out.flush()
+
+        log.debug(f"Job log: total={self.total},passed={self.passed},"
+                  f"spilled={self.spilled}")
+
+
+def remove_expired():
+    """
+    Removes spill files older than 'joblog.retention' seconds.
+
+    :return: number of files removed
+    """
+
+    retention = ConfigMap()["joblog"]["retention"]
+    spill_dir = _spill_dir()
+    if retention is None or not spill_dir.exists():
+        return 0
+
+    now = time.time()
+    removed = 0
+    for path in spill_dir.glob("*.log.gz"):
+        try:
+            if now - path.stat().st_mtime >= retention:
+                log.debug(f"Removing expired job log '{path}'")
+                path.unlink()
+                removed += 1
+        except OSError as ex:
+            log.debug(f"Failed to remove '{path}': {ex}")
+    return removed
@@ -6,60 +6,295 @@
 
 import libvirt
 import logging
+import os
+import threading
 import xml.etree.ElementTree as xmlparser
 
+from provisioner import hosts
+from provisioner import metrics
+from provisioner import state
+from provisioner.configmap import ConfigMap
 
 log = logging.getLogger(__name__)
 
+# KSM only merges base pages
+KSM_PAGE_SIZE = 4096
+
+# Thread dispatching libvirt's default event loop, which keepalive depends on
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def _start_event_loop():
+    """Starts libvirt's default event loop in a background thread."""
+
+    global _event_loop
+
+    with _event_loop_lock:
+        if _event_loop is not None:
+            return
+
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_loop = threading.Thread(target=run, name="libvirt-events",
+                                       daemon=True)
+        _event_loop.start()
+
 
 class LibvirtHandle:
-    """Convenience wrapper for the libvirt library."""
+    """
+    Convenience wrapper for the libvirt library.
+
+    There's a single instance per hypervisor, which is the one selected by
+    hosts.host() unless @uri is given. It holds a single connection to the
+    hypervisor for the lifetime of the process, which is opened on first use
+    and transparently reopened once the daemon has gone away, e.g. because it
+    got restarted.
+
+    In daemon mode, libvirt keepalive messages are exchanged on the
+    connection, so that a dead daemon is noticed before the connection is
+    used rather than when a request to it times out.
+    """
+
+    __instances = {}
+    __instances_lock = threading.Lock()
+
+    def __new__(cls, uri=None):
+        if uri is None:
+            uri = hosts.current_uri()
+
+        with cls.__instances_lock:
+            instance = cls.__instances.get(uri)
+            if instance is None:
+                instance = super(LibvirtHandle, cls).__new__(cls)
+                instance._setup(uri)
+                cls.__instances[uri] = instance
+        return instance
+
+    def _setup(self, uri):
+        self.uri = uri
+        self.remote = hosts.is_remote(uri)
+        self._conn = None
+        self._conn_lock = threading.RLock()
+        self._topology = None
+
+        # handles looked up through the current connection
+        self._pools = {}
+        self._volumes = {}
+
+    @property
+    def conn(self):
+        """The libvirt connection, (re)opened on demand."""
+
+        with self._conn_lock:
+            if self._conn is not None and not self._is_alive():
+                log.debug(f"Connection to '{self.uri}' lost, reconnecting")
+                self._disconnect()
+
+            if self._conn is None:
+                self._connect()
+            return self._conn
+
+    def _is_alive(self):
+        try:
+            return self._conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
 
-    __instance = None
+    def _connect(self):
+        settings = ConfigMap()["libvirt"]
+        keepalive = (ConfigMap()["served"] and
+                     settings["keepalive_interval"] is not None)
 
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(LibvirtHandle, cls).__new__(cls)
-        return cls.__instance
+        # keepalive needs an event loop registered before connecting
+        if keepalive:
+            _start_event_loop()
 
-    def __init__(self, uri="qemu:///system"):
         def nop_error_handler(_T, iterable):
             return None
 
         # Disable libvirt's default console error logging
         libvirt.registerErrorHandler(nop_error_handler, None)
-        self.conn = libvirt.open(uri)
 
-    def __del__(self):
-        self.conn.close()
+        log.debug(f"Connecting to '{self.uri}'")
+        self._conn = libvirt.open(self.uri)
+
+        # drivers running in-process (e.g. test:///) have no daemon to lose
+        # and don't support keepalive
+        if keepalive:
+            try:
+                self._conn.setKeepAlive(settings["keepalive_interval"],
+                                        settings["keepalive_count"])
+            except libvirt.libvirtError as ex:
+                log.debug(f"Keepalive not available on '{self.uri}': {ex}")
+
+    def _disconnect(self):
+        self._pools.clear()
+        self._volumes.clear()
+        try:
+            self._conn.close()
+        except libvirt.libvirtError:
+            pass
+        self._conn = None
+
+    def _get_pool(self, poolname):
+        """Returns the (cached) handle of storage pool @poolname."""
+
+        with self._conn_lock:
+            conn = self.conn
+            pool = self._pools.get(poolname)
+            if pool is None:
+                pool = conn.storagePoolLookupByName(poolname)
+                self._pools[poolname] = pool
+            return pool
 
     def _get_base_image(self, name, poolname):
         """
         Looks up the template base image.
 
+        Template volumes are long-lived, so their handles are cached.
+
         :param name: Name of the base image template as string
         :param poolname: Name of the storage pool to search as string
         """
 
-        log.debug(f"Looking up base image: name={name},poolname={poolname}")
-
-        pool = self.conn.storagePoolLookupByName(poolname)
-        vol = None
-        for vol in pool.listAllVolumes():
-            if name == vol.name():
+        with self._conn_lock:
+            pool = self._get_pool(poolname)
+            vol = self._volumes.get((poolname, name))
+            if vol is not None:
                 return vol
+
+            log.debug(f"Looking up base image: name={name},"
+                      f"poolname={poolname}")
+
+            try:
+                vol = pool.storageVolLookupByName(name)
+            except libvirt.libvirtError as ex:
+                if ex.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                    raise
+                raise Exception(f"Base image '{name}' not found")
+
+            self._volumes[(poolname, name)] = vol
+            return vol
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _get_image_record(self, vol):
+        # parse the base image volume to extract data we'll need to fill in
+        # the backing store XML element
+        xml_root_node = xmlparser.fromstring(vol.XMLDesc())
+        target_node = xml_root_node.find("target")
+
+        # the image file of a remote hypervisor can't be stat'ed, libvirt
+        # reports its modification time as "<seconds>.<nanoseconds>"
+        if self.remote:
+            mtime = target_node.findtext("timestamps/mtime")
+            if mtime is not None:
+                seconds, _, nanoseconds = mtime.partition(".")
+                mtime = int(seconds) * 10**9 + int(nanoseconds.ljust(9, "0"))
         else:
-            raise Exception(f"Base image '{name}' not found")
+            mtime = self._get_mtime(vol.path())
+
+        return {
+            "name": vol.name(),
+            "path": target_node.find("path").text,
+            "format": target_node.find("format").get("type"),
+            "capacity": vol.info()[1],
+            "mtime": mtime,
+        }
+
+    @metrics.timed("base_image_lookup")
+    def get_base_image(self, distro):
+        """
+        Returns the catalog record of a distro's template base image.
+
+        Records are kept in the state directory and are only refreshed from
+        libvirt when the image file has changed since it was recorded. Images
+        of remote hypervisors are always looked up.
 
-    def create_volume(self, volname, size, distro, poolname="default"):
+        :param distro: which distro template image to look for as string
+        :return: dictionary with 'name', 'path', 'format', 'capacity' (in
+                 bytes) and 'mtime' of the image
+        """
+
+        poolname = ConfigMap()["images"]["pool"]
+        name = distro + ".qcow2"
+        key = f"{self.uri} {poolname}/{name}"
+
+        catalog_path = state.state_path("images", "catalog.json")
+        record = state.read_json(catalog_path, {}).get(key)
+        if (record is not None and not self.remote and
+                record["mtime"] is not None and
+                record["mtime"] == self._get_mtime(record["path"])):
+            return record
+
+        try:
+            record = self._get_image_record(self._get_base_image(name,
+                                                                 poolname))
+        except libvirt.libvirtError:
+            # the template got deleted since its handle was cached, look it
+            # up again
+            self._volumes.pop((poolname, name), None)
+            record = self._get_image_record(self._get_base_image(name,
+                                                                 poolname))
+        with state.locked(state.state_path("images", "catalog.lock")):
+            catalog = state.read_json(catalog_path, {})
+            catalog[key] = record
+            state.write_json(catalog_path, catalog)
+
+        return record
+
+    def list_base_images(self):
+        """
+        Lists all template base images, refreshing the catalog.
+
+        :return: dictionary of distro name -> catalog record
+        """
+
+        poolname = ConfigMap()["images"]["pool"]
+        pool = self._get_pool(poolname)
+
+        images = {}
+        for vol in pool.listAllVolumes():
+            if vol.name().endswith(".qcow2"):
+                distro = vol.name()[:-len(".qcow2")]
+                images[distro] = self._get_image_record(vol)
+
+        with state.locked(state.state_path("images", "catalog.lock")):
+            catalog_path = state.state_path("images", "catalog.json")
+            catalog = {k: v for k, v in state.read_json(catalog_path,
+                                                        {}).items()
+                       if not k.startswith(f"{self.uri} {poolname}/")}
+            for record in images.values():
+                catalog[f"{self.uri} {poolname}/{record['name']}"] = record
+            state.write_json(catalog_path, catalog)
+
+        return images
+
+    @metrics.timed("create_volume")
+    def create_volume(self, volname, size, distro, poolname="default",
+                      disk_profile=None, backing=None):
         """
         Creates an overlay volume for the given machine.
 
         :param volname: name of the volume to be created as string
         :param size: capacity of the volume as string/int
         :param distro: which distro template image to look for as string
-        :param poolname: which libvirt storage pool to search for the template
-                         image as string
+        :param poolname: which libvirt storage pool to create the volume in
+                         as string
+        :param disk_profile: disk profile dictionary (see disks.select())
+                             with the overlay creation options
+        :param backing: name of a volume in @poolname to create the overlay
+                        on top of instead of the distro's base image
         """
 
         log.debug(f"Creating overlay volume: poolname={poolname},"
@@ -71,6 +306,7 @@ class LibvirtHandle:
           <capacity unit='G'>{size}</capacity>
           <target>
             <format type='qcow2'/>
+            {options}
           </target>
           <backingStore>
             <path>{backing_vol_path}</path>
@@ -79,23 +315,428 @@ class LibvirtHandle:
         </volume>
         """
 
-        # get the base image for the volume
-        base_img_name = distro + ".qcow2"
-        base_image_vol = self._get_base_image(base_img_name, "default")
+        options = ""
+        if disk_profile is not None:
+            if disk_profile["cluster_size"] is not None:
+                options += ("<clusterSize unit='KiB'>"
+                            f"{disk_profile['cluster_size']}</clusterSize>")
+            if disk_profile["lazy_refcounts"]:
+                options += ("<compat>1.1</compat>"
+                            "<features><lazy_refcounts/></features>")
 
-        # parse the base image volume to extract data we'll need to fill in
-        # the backing store XML element
-        xml_root_node = xmlparser.fromstring(base_image_vol.XMLDesc())
-        target_node = xml_root_node.find("target")
-        backing_vol_format = target_node.find("format").get("type")
-        backing_vol_path = target_node.find("path").text
+        pool = self._get_pool(poolname)
+
+        # get the base image for the volume
+        if backing is not None:
+            base_image = self._get_image_record(
+                pool.storageVolLookupByName(backing))
+        else:
+            base_image = self.get_base_image(distro)
 
         # finally create the overlay storage volume
-        pool = self.conn.storagePoolLookupByName(poolname)
         pool.createXML(template.format(name=volname, size=size,
-                                       backing_vol_path=backing_vol_path,
-                                       backing_vol_format=backing_vol_format))
+                                       options=options,
+                                       backing_vol_path=base_image["path"],
+                                       backing_vol_format=base_image["format"]))
+
+    @metrics.timed("upload_volume")
+    def upload_volume(self, volname, path, poolname="default"):
+        """
+        Creates a raw volume with the contents of a local file.
+
+        The data is streamed through the libvirt connection, so the local file
+        doesn't need to be accessible by the hypervisor.
+
+        :param volname: name of the volume to be created as string
+        :param path: path to the local file as Path
+        :param poolname: which libvirt storage pool to create the volume in
+        """
+
+        log.debug(f"Uploading '{path}' to volume '{poolname}/{volname}'")
+
+        template = """
+        <volume>
+          <name>{name}</name>
+          <capacity unit='B'>{size}</capacity>
+          <target>
+            <format type='raw'/>
+          </target>
+        </volume>
+        """
+
+        size = os.path.getsize(path)
+        pool = self._get_pool(poolname)
+        vol = pool.createXML(template.format(name=volname, size=size))
+
+        def _read(_stream, nbytes, fd):
+            return fd.read(nbytes)
+
+        stream = self.conn.newStream(0)
+        try:
+            vol.upload(stream, 0, size, 0)
+            with open(path, "rb") as fd:
+                stream.sendAll(_read, fd)
+            stream.finish()
+        except Exception:
+            stream.abort()
+            vol.delete()
+            raise
+
+    def has_volume(self, volname, poolname="default"):
+        """Checks whether volume @volname exists in pool @poolname."""
+
+        pool = self._get_pool(poolname)
+        try:
+            pool.storageVolLookupByName(volname)
+            return True
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                raise
+            return False
+
+    def list_domain_names(self, prefix=""):
+        """Lists the names of all domains starting with @prefix."""
+
+        return sorted(domain.name() for domain in self.conn.listAllDomains()
+                      if domain.name().startswith(prefix))
+
+    def list_attached_volumes(self):
+        """
+        Lists the volumes attached to any domain, running or not.
+
+        Volumes attached by path, e.g. by virt-install, are listed by their
+        file name.
+
+        :return: set of volume names
+        """
+
+        names = set()
+        for domain in self.conn.listAllDomains():
+            xml = xmlparser.fromstring(domain.XMLDesc(0))
+            for source in xml.findall("devices/disk/source"):
+                if source.get("volume") is not None:
+                    names.add(source.get("volume"))
+                if source.get("file") is not None:
+                    names.add(os.path.basename(source.get("file")))
+        return names
+
+    def list_volume_names(self, prefix="", poolname="default"):
+        """Lists the names of all volumes in @poolname starting with @prefix."""
+
+        pool = self._get_pool(poolname)
+        return sorted(vol.name() for vol in pool.listAllVolumes()
+                      if vol.name().startswith(prefix))
+
+    def get_host_capacity(self):
+        """
+        Queries the host's resources and how much of them domains hold.
+
+        :return: dictionary with 'cpus', 'memory' (in MiB), 'available_memory'
+                 (in MiB, including reclaimable caches), 'committed_vcpus',
+                 'committed_memory' (in MiB) and 'domains' keys
+        """
+
+        info = self.conn.getInfo()
+        try:
+            stats = self.conn.getMemoryStats(
+                libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS)
+            available = sum(stats.get(k, 0)
+                            for k in ["free", "buffers", "cached"])
+        except libvirt.libvirtError as ex:
+            # not every driver reports memory stats
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                raise
+            available = self.conn.getFreeMemory() // 1024
+
+        committed_vcpus = 0
+        committed_memory = 0
+        domains = self.conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        for domain in domains:
+            try:
+                _, max_memory, _, vcpus, _ = domain.info()
+            except libvirt.libvirtError as ex:
+                # the domain went away in the meantime
+                if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                continue
+
+            committed_vcpus += vcpus
+            committed_memory += max_memory // 1024
+
+        return {
+            "cpus": info[2],
+            "memory": info[1],
+            "available_memory": available // 1024,
+            "committed_vcpus": committed_vcpus,
+            "committed_memory": committed_memory,
+            "domains": len(domains),
+        }
+
+    def get_host_topology(self):
+        """
+        Returns the NUMA topology of the host.
+
+        :return: dictionary of node number -> dictionary with 'cpus' (list of
+                 dictionaries with the 'id' of a host CPU and the 'siblings'
+                 it shares a core with) and 'memory' (in MiB) keys
+        """
+
+        if self._topology is not None:
+            return self._topology
+
+        caps = xmlparser.fromstring(self.conn.getCapabilities())
+
+        topology = {}
+        for cell in caps.findall("host/topology/cells/cell"):
+            cpus = [{"id": int(cpu.get("id")),
+                     "siblings": cpu.get("siblings", cpu.get("id"))}
+                    for cpu in cell.findall("cpus/cpu")]
+
+            topology[int(cell.get("id"))] = {
+                "cpus": cpus,
+                "memory": int(cell.find("memory").text) // 1024,
+            }
+
+        self._topology = topology
+        return topology
+
+    def get_memory_usage(self, prefix=""):
+        """
+        Queries how densely guests are packed into the host's memory.
+
+        The guests' resident memory is what their QEMU processes actually
+        occupy, which is less than their committed memory as long as guests
+        haven't touched all of it yet or hand freed memory back through free
+        page reporting. KSM merges identical pages on top of that.
+
+        :param prefix: only account for domains whose name starts with it
+        :return: dictionary with 'memory' (host memory), 'committed',
+                 'resident', 'unused' (as reported by the guests' memory
+                 balloons) and 'shared' (saved by KSM) keys, all in MiB
+        """
+
+        info = self.conn.getInfo()
+        usage = {
+            "memory": info[1],
+            "committed": 0,
+            "resident": 0,
+            "unused": 0,
+            "shared": 0,
+        }
+
+        domains = self.conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        for domain in domains:
+            if not domain.name().startswith(prefix):
+                continue
+
+            try:
+                max_memory = domain.info()[1]
+                stats = domain.memoryStats()
+            except libvirt.libvirtError as ex:
+                # the domain went away in the meantime
+                if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                continue
+
+            usage["committed"] += max_memory // 1024
+            usage["resident"] += stats.get("rss", max_memory) // 1024
+            usage["unused"] += stats.get("unused", 0) // 1024
+
+        try:
+            params = self.conn.getMemoryParameters()
+            usage["shared"] = (params.get("shm_pages_sharing", 0) *
+                               KSM_PAGE_SIZE // 1024 ** 2)
+        except libvirt.libvirtError as ex:
+            # not every driver reports KSM statistics
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                raise
+
+        return usage
+
+    @metrics.timed("create_domain")
+    def create_domain(self, xml):
+        """
+        Creates and starts a transient domain.
+
+        :param xml: domain definition as string
+        """
+
+        log.debug(f"Creating domain: {xml}")
+        self.conn.createXML(xml, 0)
+
+    def get_pool_path(self, poolname="default"):
+        """Returns the target directory of a storage pool as string."""
+
+        pool = self._get_pool(poolname)
+        return xmlparser.fromstring(pool.XMLDesc()).find("target/path").text
+
+    def refresh_pool(self, poolname="default"):
+        """Makes a storage pool pick up files created behind its back."""
+
+        self._get_pool(poolname).refresh(0)
+
+    def get_domain_uuid(self, name):
+        return self.conn.lookupByName(name).UUIDString()
+
+    def is_uuid_in_use(self, uuid):
+        """Checks whether a domain with @uuid exists."""
+
+        try:
+            self.conn.lookupByUUIDString(uuid)
+            return True
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            return False
+
+    def detach_interfaces(self, name, timeout=30):
+        """
+        Unplugs all network interfaces of a running domain.
+
+        :param name: name of the domain as string
+        :param timeout: seconds to wait for the guest to release the devices
+        """
+
+        from provisioner.readiness import Backoff
+
+        domain = self.conn.lookupByName(name)
+        root = xmlparser.fromstring(domain.XMLDesc())
+        for iface in root.findall("devices/interface"):
+            domain.detachDeviceFlags(xmlparser.tostring(iface,
+                                                        encoding="unicode"),
+                                     libvirt.VIR_DOMAIN_AFFECT_LIVE)
+
+        # the guest needs to acknowledge the unplug first
+        backoff = Backoff(timeout)
+        while backoff.wait():
+            root = xmlparser.fromstring(domain.XMLDesc())
+            if root.find("devices/interface") is None:
+                return
+
+        raise Exception(f"Domain '{name}' didn't release its interfaces")
+
+    def attach_interface(self, name, network):
+        """
+        Hot-plugs a virtio NIC with a fresh MAC address to a running domain.
+
+        :param name: name of the domain as string
+        :param network: name of the libvirt network as string
+        """
+
+        from provisioner.domain_xml import DomainXML
+
+        xml = DomainXML.interface_to_string(network)
+        self.conn.lookupByName(name).attachDeviceFlags(
+            xml, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+
+    def shutdown_domain(self, name, timeout=300):
+        """
+        Asks a domain's guest to power off and waits until it's shut off.
+
+        :param name: name of the domain as string
+        :param timeout: seconds to wait for the guest to power off
+        """
+
+        from provisioner.readiness import Backoff
+
+        domain = self.conn.lookupByName(name)
+        if domain.isActive():
+            log.debug(f"Shutting down domain '{name}'")
+            domain.shutdown()
+
+        backoff = Backoff(timeout)
+        while backoff.wait():
+            try:
+                if not domain.isActive():
+                    return
+            except libvirt.libvirtError as ex:
+                # a transient domain is gone once it's shut off
+                if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                return
+
+        raise Exception(f"Domain '{name}' didn't shut down within "
+                        f"{timeout} seconds")
+
+    @metrics.timed("save_domain")
+    def save_domain(self, name, path):
+        """
+        Saves the memory state of a running domain, which stops it.
+
+        :param name: name of the domain as string
+        :param path: path of the state file on the hypervisor as string
+        """
+
+        log.debug(f"Saving domain '{name}' to '{path}'")
+        self.conn.lookupByName(name).save(path)
+
+    def get_saved_domain_xml(self, path):
+        """Returns the domain definition stored in a state file."""
+
+        return self.conn.saveImageGetXMLDesc(path, 0)
+
+    @metrics.timed("restore_domain")
+    def restore_domain(self, path, xml):
+        """
+        Restores a transient domain from a state file.
+
+        :param path: path of the state file on the hypervisor as string
+        :param xml: domain definition to restore with as string, it may only
+                    differ from the saved one in host specific parts, e.g.
+                    the domain name or the disk sources
+        """
+
+        log.debug(f"Restoring domain from '{path}': {xml}")
+        self.conn.restoreFlags(path, xml, libvirt.VIR_DOMAIN_SAVE_RUNNING)
+
+    def set_domain_time(self, name):
+        """Sets the guest clock of a domain to the host's time."""
+
+        import time
+
+        now = time.time_ns()
+        self.conn.lookupByName(name).setTime({
+            "seconds": now // 10 ** 9,
+            "nseconds": now % 10 ** 9,
+        })
+
+    def guest_exec(self, name, argv, timeout=30):
+        """
+        Executes a command in a domain through the QEMU guest agent.
+
+        :param name: name of the domain as string
+        :param argv: command and its arguments as list of strings
+        :param timeout: seconds to wait for the command to finish
+        :return: exit code of the command
+        """
+
+        import json
+        import libvirt_qemu
+
+        from provisioner.readiness import Backoff
+
+        domain = self.conn.lookupByName(name)
+
+        def agent_command(command, **arguments):
+            reply = libvirt_qemu.qemuAgentCommand(
+                domain, json.dumps({"execute": command,
+                                    "arguments": arguments}), timeout, 0)
+            return json.loads(reply)["return"]
+
+        log.debug(f"Executing {argv} in '{name}' through the guest agent")
+        pid = agent_command("guest-exec", path=argv[0], arg=argv[1:])["pid"]
+
+        backoff = Backoff(timeout)
+        while backoff.wait():
+            status = agent_command("guest-exec-status", pid=pid)
+            if status["exited"]:
+                return status.get("exitcode", -1)
+
+        raise Exception(f"Command {argv} in '{name}' timed out")
 
+    @metrics.timed("cleanup_machine")
     def cleanup_machine(self, name):
         """
         Destroy a libvirt machine.
@@ -115,7 +756,8 @@ class LibvirtHandle:
             if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
                 raise
 
-    def cleanup_storage(self, name):
+    @metrics.timed("cleanup_storage")
+    def cleanup_storage(self, name, poolname="default"):
         """
         Clean up overlay storage for a machine.
 
@@ -124,12 +766,14 @@ class LibvirtHandle:
 
         :param name: name of the machine storage needs to be cleanup up for as
                      string
+        :param poolname: which libvirt storage pool the storage lives in
         """
 
-        pool_default = self.conn.storagePoolLookupByName("default")
+        pool_default = self._get_pool(poolname)
         try:
             log.debug("Destroying storage for '{name}'")
 
+            self._volumes.pop((poolname, name), None)
             volume = pool_default.storageVolLookupByName(name)
             volume.delete()
         except libvirt.libvirtError as ex:
@@ -4,23 +4,27 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-import errno
 import logging
-import os
-import subprocess
-import yaml
 
-from tempfile import NamedTemporaryFile
-from time import sleep
+from contextlib import ExitStack, nullcontext
+from time import time
 
-from provisioner import cloud_init
+from provisioner import hosts
+from provisioner import metrics
+from provisioner import state
 from provisioner.configmap import ConfigMap
-from provisioner.libvirt_handle import LibvirtHandle
-from provisioner.ssh import SSHConn
 
 
 log = logging.getLogger(__name__)
 
+# SSH connections by domain name. They outlive Machine instances, so that a
+# daemon process can serve all the run stages of a job over a single session.
+_ssh_conns = {}
+
+# Seconds between guest memory statistics updates of the memory balloon, see
+# LibvirtHandle.get_memory_usage()
+BALLOON_STATS_PERIOD = 10
+
 
 class Machine:
     """
@@ -41,101 +45,179 @@ class Machine:
     @property
     def conn(self):
         if self._conn is None:
-            self._conn = SSHConn(self.name)
+            from provisioner.ssh import SSHConn
+
+            self._conn = _ssh_conns.get(self.domain)
+            if self._conn is None:
+                settings = ConfigMap()["ssh"]
+
+                # a daemon keeps the connections itself, see _ssh_conns
+                control_path = None
+                if settings["control_master"] and not ConfigMap()["served"]:
+                    control_path = self._control_path()
+
+                conn = SSHConn(self.address, control_path,
+                               settings["control_persist"])
+                self._conn = _ssh_conns.setdefault(self.domain, conn)
         return self._conn
 
     def __init__(self, name):
         self.name = name
         self._conn = None
 
-    def connect(self, ssh_key_path):
+        # a machine claimed from the warm pool keeps its original domain name
+        self.record = state.get_machine_record(name)
+        self.domain = name
+        self.host = None
+        if self.record is not None:
+            self.domain = self.record["domain"]
+            self.host = self.record.get("host")
+            metrics.label("disk_profile", self.record.get("disk_profile"))
+
+    @property
+    def address(self):
         """
-        Opens an SSH channel to the VM.
+        Host name or IP address the VM is reachable at.
 
-        :param ssh_key_path: path to the SSH key to be used (as string)
+        The domain name resolves through libvirt's NSS module for machines of
+        the local hypervisor, machines of remote ones are reached at the
+        address of their DHCP lease (see set_address()).
         """
 
-        if ssh_key_path is None:
-            raise ValueError(f"Failed to connect to {self.name}: "
-                             "No SSH key specified")
+        if self.record is not None and self.record.get("address"):
+            return self.record["address"]
+        return self.domain
 
-        self.conn.connect(key_filepath=ssh_key_path,
-                          username="root")
+    def set_address(self, address):
+        """Records the address of the VM's DHCP lease."""
 
-    def _dump_user_data(self, user_data):
-        tempfile = NamedTemporaryFile(delete=False,
-                                      prefix=(self.name + "-cloud-config"))
+        self.record["address"] = address
+        state.set_machine_record(self.name, self.record)
 
-        with open(tempfile.name, "w") as fd:
-            # nasty hack to force PyYAML not to break long lines by default
-            from math import inf
+    def _control_path(self):
+        from hashlib import sha256
 
-            # write the header first, otherwise cloud-init will ignore the file
-            fd.write("#cloud-config\n")
-            fd.write(yaml.dump(user_data, width=inf))
-        return tempfile.name
+        # UNIX socket paths are limited to ~100 characters
+        digest = sha256(self.domain.encode()).hexdigest()[:16]
+        return state.state_path("ssh", f"{digest}.sock")
 
-    def _ssh_wait(self, ssh_key_path):
-        from paramiko import ssh_exception
-        from socket import EAI_NONAME
-
-        # we need to give the machine a head start (up to timeout seconds)
-        # to get an IP lease first and only then we can try SSHing into the
-        # machine (wait in 2s increments)
-        timeout = 60
-        seconds = 2
-        for _ in range(timeout // seconds):
-            sleep(seconds)
-            try:
-                self.connect(ssh_key_path)
-                return
-            except ssh_exception.NoValidConnectionsError as ex:
-                # NoValidConnectionsError is a subclass of various socket
-                # errors which in turn is a subclass of OSError. We're
-                # specifically interested in EHOSTUNREACH and ECONNREFUSED
-                # errnos which we can ignore for the duration of the timeout
-                # period
-                for error in ex.errors.values():
-                    if isinstance(error, OSError):
-                        if error.errno == errno.EHOSTUNREACH or error.errno == errno.ECONNREFUSED:
-                            break
-                else:
-                    raise ex
-            except OSError as ex:
-                if ex.errno == EAI_NONAME:  # Name or service not known
-                    continue
-                raise ex
-
-        raise Exception(f"Failed to connect to {self.name}: timeout reached")
-
-    def provision(self, distro, ssh_key_path, size=50):
+    def connect(self, ssh_key_path, **kwargs):
         """
-        Provisions a new transient VM instance from an existing base image.
-
-        The instance is created with a virtio UNIX channel so that @wait can
-        block until the VM is online.
+        Opens an SSH channel to the VM.
 
-        :param distro: which distro template to use as string
-        :param size: capacity of the underlying storage in GB, default is 50
+        :param ssh_key_path: path to the SSH key to be used (as string)
+        :param kwargs: extra arguments passed to SSHConn.connect()
         """
 
-        log.debug(f"Provisioning machine '{self.name}'")
+        if ssh_key_path is None:
+            raise ValueError(f"Failed to connect to {self.name}: "
+                             "No SSH key specified")
 
-        # create the storage for the VM first
-        libvirt_handle = LibvirtHandle()
-        libvirt_handle.create_volume(self.name, size, distro)
+        if self.conn.is_connected():
+            return
 
-        user_data = cloud_init.get_user_data(self.name)
-        user_data_file = self._dump_user_data(user_data)
+        self.conn.connect(key_filepath=ssh_key_path,
+                          username="root",
+                          **kwargs)
 
+    def disconnect(self):
+        """Closes the SSH session to the VM, including its control master."""
+
+        from provisioner.ssh import stop_master
+
+        conn = _ssh_conns.pop(self.domain, None)
+        if conn is not None:
+            conn.close()
+        self._conn = None
+        stop_master(self._control_path())
+
+    def _ssh_wait(self, ssh_key_path):
+        from provisioner import readiness
+
+        with metrics.span("ssh_wait"):
+            readiness.wait(self, ssh_key_path)
+
+    def _create_domain_native(self, seed_volume, profile, disk_profile,
+                              shares):
+        """Defines and starts the domain through the libvirt API directly."""
+
+        from provisioner import cloud_init
+        from provisioner import placement
+        from provisioner.domain_xml import DomainXML
+        from provisioner.libvirt_handle import LibvirtHandle
+        from provisioner.profiles import QEMU_MEMORY_OVERHEAD
+
+        xml = DomainXML(self.name, profile["vcpus"], profile["memory"])
+
+        allocation = placement.allocate(self.name, profile["vcpus"],
+                                        profile["memory"])
+        if allocation is not None:
+            xml.set_placement(allocation["cpus"], allocation["node"],
+                              ConfigMap()["placement"]["memory_mode"])
+
+        hard_limit = None
+        if profile["lock_memory"]:
+            hard_limit = profile["memory"] + QEMU_MEMORY_OVERHEAD
+        xml.set_memory_backing(hugepages=profile["hugepages"],
+                               locked=profile["lock_memory"],
+                               shared=profile["memory_sharing"],
+                               hard_limit=hard_limit,
+                               memfd=bool(shares))
+        xml.add_memballoon(profile["free_page_reporting"],
+                           stats_period=BALLOON_STATS_PERIOD)
+
+        iothread = None
+        if disk_profile["iothreads"] > 0:
+            xml.set_iothreads(disk_profile["iothreads"])
+            iothread = 1
+        xml.add_disk("default", self.name,
+                     cache=disk_profile["cache"],
+                     io=disk_profile["io"],
+                     discard=disk_profile["discard"],
+                     iothread=iothread)
+        xml.add_cdrom("default", seed_volume)
+        for share in shares:
+            xml.add_filesystem(share["source"], share["tag"],
+                               locking=share["locking"],
+                               readonly=share["readonly"])
+        xml.add_interface("default")
+        xml.add_guest_agent()
+        xml.set_genid()
+        xml.set_smbios_serial(cloud_init.get_smbios_serial(self.name))
+
+        LibvirtHandle().create_domain(xml.to_string())
+
+    def _create_domain_virt_install(self, seed_volume, profile, disk_profile,
+                                    shares):
+        """Defines and starts the domain using the virt-install tool."""
+
+        import itertools
+        import subprocess
+
+        from time import monotonic, sleep
+
+        from provisioner import admission
+        from provisioner import cloud_init
+        from provisioner import placement
+        from provisioner.profiles import QEMU_MEMORY_OVERHEAD
+
+        disk = f"vol=default/{self.name},bus=virtio"
+        for option in ["cache", "io", "discard"]:
+            if disk_profile[option] is not None:
+                disk += f",{option}={disk_profile[option]}"
+        if disk_profile["iothreads"] > 0:
+            disk += ",driver.iothread=1"
+
+        serial = cloud_init.get_smbios_serial(self.name)
         cmd = [
             "virt-install",
-            "--connect", "qemu:///system",
+            "--connect", hosts.current_uri(),
             "--os-variant", "unknown",
             "--name", self.name,
-            "--disk", f"vol=default/{self.name},bus=virtio",
-            "--vcpus", "4",
-            "--ram", "8192",
+            "--disk", disk,
+            "--disk", f"vol=default/{seed_volume},device=cdrom",
+            "--vcpus", str(profile["vcpus"]),
+            "--ram", str(profile["memory"]),
             "--machine", "q35",
             "--network", "network=default,model=virtio",
             "--graphics", "none",
@@ -143,44 +225,204 @@ class Machine:
             "--transient",
             "--console", "pty",
             "--noautoconsole",
-            "--cloud-init", f"user-data={user_data_file}",
+            "--sysinfo", f"system.serial={serial}",
             "--import"
         ]
 
+        if disk_profile["iothreads"] > 0:
+            cmd.extend(["--iothreads", str(disk_profile["iothreads"])])
+
+        backing = []
+        if profile["hugepages"]:
+            backing.append("hugepages=on")
+        if profile["lock_memory"]:
+            backing.append("locked=on")
+            cmd.extend(["--memtune", "hard_limit="
+                        f"{(profile['memory'] + QEMU_MEMORY_OVERHEAD) * 1024}"])
+        if not profile["memory_sharing"]:
+            backing.append("nosharepages=on")
+        if shares:
+            backing.extend(["source.type=memfd", "access.mode=shared"])
+        if backing:
+            cmd.extend(["--memorybacking", ",".join(backing)])
+
+        for share in shares:
+            filesystem = (f"source.dir={share['source']},"
+                          f"target.dir={share['tag']},driver.type=virtiofs")
+            if share["locking"]:
+                filesystem += ",binary.lock.posix=on,binary.lock.flock=on"
+            if share["readonly"]:
+                filesystem += ",readonly=on"
+            cmd.extend(["--filesystem", filesystem])
+
+        balloon = f"model=virtio,stats.period={BALLOON_STATS_PERIOD}"
+        if profile["free_page_reporting"]:
+            balloon += ",freePageReporting=on"
+        cmd.extend(["--memballoon", balloon])
+
+        allocation = placement.allocate(self.name, profile["vcpus"],
+                                        profile["memory"])
+        if allocation is not None:
+            cputune = [f"vcpupin{vcpu}.vcpu={vcpu},vcpupin{vcpu}.cpuset={cpu}"
+                       for vcpu, cpu in enumerate(allocation["cpus"])]
+            cmd.extend(["--cputune", ",".join(cputune),
+                        "--numatune", f"{allocation['node']},mode="
+                        f"{ConfigMap()['placement']['memory_mode']}"])
+
         if not ConfigMap()["debug"]:
             cmd.append("--quiet")
 
         # virt-install may fail for various reasons, e.g. if too many
-        # concurrent instances are trying to refresh its own created
-        # 'boot-scratch' storage pool to store user cloud-init configs.
-        # So, since we have no control over this, let's give virt-install a few
-        # re-tries before failing fatally with the last active exception
-        save_ex = None
-        for retry in range(3):
+        # concurrent instances are trying to refresh the storage pool at the
+        # same time. So, since we have no control over this, let's keep
+        # re-trying until the deadline, backing off the longer the more boots
+        # are in progress, before failing fatally with the last exception
+        deadline = monotonic() + ConfigMap()["admission"]["retry_timeout"]
+        for attempt in itertools.count(1):
             try:
-                subprocess.run(cmd, capture_output=True, check=True)
-                break
+                with metrics.span("virt_install", attempt=attempt):
+                    subprocess.run(cmd, capture_output=True, check=True)
+                return
             except subprocess.CalledProcessError as ex:
                 log.debug(f"{ex}")
-                log.debug(f"Re-trying command '{cmd}'")
-                save_ex = ex
-                continue
-        else:
-            log.debug("Provision re-try limit reached")
-            raise save_ex
 
-        try:
-            self._ssh_wait(ssh_key_path)
-        except Exception as ex:
-            raise ex
-        finally:
-            os.unlink(user_data_file)
+                delay = admission.retry_delay()
+                if monotonic() + delay >= deadline:
+                    log.debug("Provision re-try limit reached")
+                    raise
+
+                log.debug(f"Re-trying command '{cmd}' in {delay}s")
+                sleep(delay)
+
+    def provision(self, distro, ssh_key_path, profile=None, cold=False,
+                  host=None):
+        """
+        Provisions a new transient VM instance from an existing base image.
 
-    def teardown(self):
-        """Cleans up the VM instance along with its block storage overlay."""
+        The instance is created with a virtio UNIX channel so that @wait can
+        block until the VM is online. If configured, the instance is restored
+        from a saved memory state of the distro instead of booting it.
+
+        :param distro: which distro template to use as string
+        :param profile: resource profile dictionary (see profiles.select()),
+                        default is the distro's profile
+        :param cold: always boot the instance, even if it could be restored
+        :param host: connection URI of the hypervisor to create the instance
+                     on, default is the one hosts.select() picks
+        """
+
+        from provisioner import admission
+        from provisioner import cloud_init
+        from provisioner import disks
+        from provisioner import placement
+        from provisioner import profiles
+        from provisioner import saved_state
+        from provisioner import shared_dirs
+        from provisioner.libvirt_handle import LibvirtHandle
+
+        if profile is None:
+            profile = profiles.select(distro)
+        disk_profile = disks.select(profile["disk_profile"])
+        metrics.label("disk_profile", disk_profile["name"])
+
+        backend = ConfigMap()["provision"]["backend"]
+        if backend == "native":
+            create_domain = self._create_domain_native
+        elif backend == "virt-install":
+            create_domain = self._create_domain_virt_install
+        else:
+            raise Exception(f"Unknown provisioning backend '{backend}'")
+
+        if host is None:
+            host = hosts.select(distro, profile)
+        self.host = host
+
+        log.debug(f"Provisioning machine '{self.name}' on '{host}' with "
+                  f"resource profile '{profile['name']}'")
+
+        with hosts.host(host), ExitStack() as reservation:
+            # waiting for capacity must not hold up the boots of machines
+            # which fit, so the boot slot is only taken once admitted
+            reservation.enter_context(profiles.admit(profile))
+
+            with admission.boot_slot(ConfigMap()["project"], self.name):
+                shares = shared_dirs.get_shares(self.name)
+
+                self.record = {
+                    "domain": self.name,
+                    "distro": distro,
+                    "profile": profile["name"],
+                    "disk_profile": disk_profile["name"],
+                    "created": time(),
+                    "host": host,
+                    "shares": [share["tag"] for share in shares],
+                }
+                state.set_machine_record(self.name, self.record)
+
+                seed_volume = cloud_init.get_seed_volume()
+
+                restore_slot = saved_state.slot(distro, profile, seed_volume)
+                if cold:
+                    restore_slot = nullcontext()
+
+                with restore_slot as saved:
+                    # create the storage for the VM first
+                    libvirt_handle = LibvirtHandle()
+                    libvirt_handle.create_volume(
+                        self.name, profile["disk"], distro,
+                        disk_profile=disk_profile,
+                        backing=saved["volume"] if saved is not None else None)
+
+                    try:
+                        if saved is not None:
+                            saved_state.restore(self, saved)
+                        else:
+                            create_domain(seed_volume, profile, disk_profile,
+                                          shares)
+                    except Exception:
+                        # don't leave the pinned CPUs and the overlay taken
+                        # until the job's cleanup stage, if it ever runs
+                        try:
+                            libvirt_handle.cleanup_machine(self.name)
+                            placement.release(self.name)
+                            libvirt_handle.cleanup_storage(self.name)
+                        except Exception as ex:
+                            log.debug(f"Failed to clean up '{self.name}': "
+                                      f"{ex}")
+                        raise
+
+                # the domain counts towards the host's capacity now
+                reservation.close()
+
+                self._ssh_wait(ssh_key_path)
+
+    def teardown(self, defer=False):
+        """
+        Cleans up the VM instance along with its block storage overlay.
+
+        :param defer: only mark the instance for the reaper (see reaper.py)
+                      instead of destroying it right away
+        """
 
         log.debug(f"Cleaning up '{self.name}' resources")
 
-        libvirt_handle = LibvirtHandle()
-        libvirt_handle.cleanup_machine(self.name)
-        libvirt_handle.cleanup_storage(self.name)
+        self.disconnect()
+
+        if defer:
+            from provisioner import reaper
+
+            reaper.mark(self.domain, self.host)
+            state.del_machine_record(self.name)
+            return
+
+        from provisioner import placement
+        from provisioner import shared_dirs
+        from provisioner.libvirt_handle import LibvirtHandle
+
+        with hosts.host(self.host):
+            libvirt_handle = LibvirtHandle()
+            libvirt_handle.cleanup_machine(self.domain)
+            placement.release(self.domain)
+            libvirt_handle.cleanup_storage(self.domain)
+            shared_dirs.release(self.domain)
+        state.del_machine_record(self.name)
@@ -0,0 +1,239 @@
+# metrics.py - module containing the phase timing instrumentation
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import functools
+import json
+import logging
+import os
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Recorder collecting the spans of the action being run in this context, spans
+# outside of metrics.collect() (e.g. in the SSH control master, whose work is
+# accounted for by the client it serves) are not recorded at all
+_recorder = ContextVar("metrics_recorder", default=None)
+
+METRIC_NAME = "libvirt_gci_phase_duration_seconds"
+
+# Labels of the Prometheus metric. The job id isn't one of them, it would
+# create a new time series with every job, it's only part of the JSON lines.
+PROMETHEUS_LABELS = ["phase", "project", "distro", "disk_profile", "status"]
+
+
+class Recorder:
+    """Collects the spans of a single action until they're flushed."""
+
+    def __init__(self, labels):
+        """
+        :param labels: dictionary of labels common to all spans
+        """
+
+        self.labels = labels
+        self.spans = []
+
+    def add(self, phase, start, duration, status, attrs):
+        log.debug(f"Phase '{phase}' took {duration:.3f}s ({status})")
+
+        span = {
+            "time": start,
+            "phase": phase,
+            "duration": duration,
+            "status": status,
+        }
+        span.update(self.labels)
+        span.update(attrs)
+        self.spans.append(span)
+
+    def set_label(self, name, value):
+        """Sets a label of all spans, including those recorded already."""
+
+        self.labels[name] = value
+        for span in self.spans:
+            span[name] = value
+
+    def _write_jsonl(self, path):
+        lines = "".join(json.dumps(span) + "\n" for span in self.spans)
+
+        # a single write of an O_APPEND file doesn't interleave with writes
+        # of other processes
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
+
+    def _write_textfile(self, path):
+        with state.locked(state.state_path("metrics", "aggregate.lock")):
+            aggregate_path = state.state_path("metrics", "aggregate.json")
+            aggregate = state.read_json(aggregate_path, {})
+
+            # series aggregated before the set of labels changed can't be
+            # told apart anymore, start them over
+            aggregate = {k: v for k, v in aggregate.items()
+                         if len(json.loads(k)) == len(PROMETHEUS_LABELS)}
+
+            for span in self.spans:
+                key = json.dumps([span.get(label) or ""
+                                  for label in PROMETHEUS_LABELS])
+                series = aggregate.setdefault(key, {"count": 0, "sum": 0})
+                series["count"] += 1
+                series["sum"] += span["duration"]
+
+            state.write_json(aggregate_path, aggregate)
+
+            lines = [
+                f"# HELP {METRIC_NAME} Time spent in libvirt-gci phases.",
+                f"# TYPE {METRIC_NAME} summary",
+            ]
+            for key, series in sorted(aggregate.items()):
+                labels = ",".join(f'{label}="{_escape(value)}"'
+                                  for label, value in
+                                  zip(PROMETHEUS_LABELS, json.loads(key)))
+                lines.append(f"{METRIC_NAME}_sum{{{labels}}} "
+                             f"{series['sum']:.6f}")
+                lines.append(f"{METRIC_NAME}_count{{{labels}}} "
+                             f"{series['count']}")
+
+            # the textfile collector may read the file at any time
+            path = Path(path)
+            tmp = Path(path.parent, f".{path.name}.{os.getpid()}.tmp")
+            tmp.write_text("\n".join(lines) + "\n")
+            os.replace(tmp, path)
+
+    def flush(self, settings):
+        """
+        Writes the collected spans out.
+
+        :param settings: the 'metrics' configuration section
+        """
+
+        if not self.spans:
+            return
+
+        try:
+            if settings["jsonl"] is not None:
+                self._write_jsonl(settings["jsonl"])
+            if settings["textfile"] is not None:
+                self._write_textfile(settings["textfile"])
+        except OSError as ex:
+            # metrics are nice to have, they must never fail the job
+            log.warning(f"Failed to write metrics: {ex}")
+
+        self.spans = []
+
+
+def _escape(value):
+    return (value.replace("\\", "\\\\")
+                 .replace('"', '\\"')
+                 .replace("\n", "\\n"))
+
+
+@contextmanager
+def collect():
+    """
+    Context manager recording the spans of an action.
+
+    The spans are labeled with the GitLab project, distro and job id and
+    written out once the action finishes. Nothing is recorded unless a
+    metrics destination is configured.
+    """
+
+    configmap = ConfigMap()
+    settings = configmap["metrics"]
+    if settings["jsonl"] is None and settings["textfile"] is None:
+        yield
+        return
+
+    recorder = Recorder({
+        "project": configmap["project"],
+        "distro": configmap["distro"],
+        "job": configmap["job_id"],
+        "disk_profile": None,
+    })
+
+    token = _recorder.set(recorder)
+    try:
+        yield
+    finally:
+        _recorder.reset(token)
+        recorder.flush(settings)
+
+
+def record(phase, duration, status="ok", **attrs):
+    """
+    Records a phase which has already finished.
+
+    :param phase: name of the phase as string
+    :param duration: how long the phase took in seconds
+    :param status: 'ok' or 'error'
+    :param attrs: additional attributes of the span
+    """
+
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.add(phase, time.time() - duration, duration, status, attrs)
+
+
+def label(name, value):
+    """
+    Labels all spans of the action being run, e.g. with the machine's disk
+    profile once it's known.
+
+    :param name: name of the label as string
+    :param value: value of the label as string
+    """
+
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.set_label(name, value)
+
+
+@contextmanager
+def span(phase, **attrs):
+    """
+    Context manager timing a phase.
+
+    The span's status is 'error' if the phase raises an exception.
+
+    :param phase: name of the phase as string
+    :param attrs: additional attributes of the span, e.g. the attempt number
+    """
+
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+
+    start = time.time()
+    begin = time.monotonic()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        recorder.add(phase, start, time.monotonic() - begin, status, attrs)
+
+
+def timed(phase):
+    """Decorator timing every call of a function as a span of @phase."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
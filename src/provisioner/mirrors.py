@@ -0,0 +1,162 @@
+# mirrors.py - module containing the host-side git mirrors of the projects
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextvars
+import logging
+import shlex
+import subprocess
+import threading
+import time
+
+from pathlib import Path
+
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# virtiofs tag the mirror of the job's project is exposed to the guest under
+MIRROR_TAG = "gitlab-mirror"
+
+# File in a mirror whose modification time tells when it was last fetched
+STAMP_FILE = "libvirt-gci-fetched"
+
+# libvirt version which can share a directory read-only through virtiofs,
+# encoded as major * 1000000 + minor * 1000 + release
+READONLY_LIBVIRT_VERSION = 11000000
+
+
+def enabled():
+    """Checks whether the projects' git repositories are mirrored."""
+
+    return ConfigMap()["mirrors"]["dir"] is not None
+
+
+def get_mirror_path(project_id):
+    """
+    Returns the path to a project's bare mirror on the host.
+
+    The mirror is named after the project's ID, as project names are only
+    unique within a namespace and the mirror may hold a private repository.
+
+    :param project_id: ID of the GitLab project as string
+    :return: Path or None if mirrors are disabled or the project ID isn't
+             known
+    """
+
+    root = ConfigMap()["mirrors"]["dir"]
+    if root is None or project_id is None:
+        return None
+
+    # the mirror must not escape the mirrors directory
+    if not project_id.isdigit():
+        return None
+    return Path(root, f"{project_id}.git")
+
+
+def refresh(project_id, url):
+    """
+    Creates or incrementally updates a project's bare mirror.
+
+    Only branches and tags are mirrored. Refreshes are deduplicated across
+    concurrent jobs: a job which had to wait for another job's refresh of the
+    mirror doesn't fetch again, neither does one finding the mirror fetched
+    less than 'mirrors.refresh_interval' seconds ago.
+
+    :param project_id: ID of the GitLab project as string
+    :param url: URL to fetch from, e.g. the job's CI_REPOSITORY_URL, which
+                is never stored in the mirror as it carries the job token
+    """
+
+    settings = ConfigMap()["mirrors"]
+
+    path = get_mirror_path(project_id)
+    if path is None or url is None:
+        return
+
+    requested = time.time()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with state.locked(Path(path.parent, f".{path.name}.lock")):
+        stamp = Path(path, STAMP_FILE)
+        try:
+            fetched = stamp.stat().st_mtime
+        except OSError:
+            fetched = None
+
+        if fetched is not None and (
+                fetched >= requested or
+                requested - fetched < settings["refresh_interval"]):
+            log.debug(f"Mirror '{path}' is fresh already")
+            return
+
+        if not Path(path, "HEAD").exists():
+            log.debug(f"Creating mirror '{path}'")
+            path.mkdir(exist_ok=True)
+            subprocess.run(["git", "init", "--quiet", "--bare", str(path)],
+                           capture_output=True, check=True)
+
+        log.debug(f"Refreshing mirror '{path}'")
+        cmd = [
+            "git", "-C", str(path),
+            # objects borrowed by the guests must never be pruned
+            "-c", "gc.auto=0",
+            "fetch", "--quiet", "--prune", url,
+            "+refs/heads/*:refs/heads/*",
+            "+refs/tags/*:refs/tags/*",
+        ]
+        subprocess.run(cmd, capture_output=True, check=True,
+                       timeout=settings["timeout"])
+        stamp.touch()
+
+
+def refresh_async(project_id, url):
+    """
+    Refreshes a project's mirror in a background thread.
+
+    A failed refresh isn't fatal, the guest just fetches more objects itself.
+
+    :return: the thread, which needs to be joined before the job's sources
+             are fetched
+    """
+
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            context.run(refresh, project_id, url)
+        except Exception as ex:
+            log.debug(f"Failed to refresh the mirror of project {project_id}: "
+                      f"{ex}")
+
+    thread = threading.Thread(target=run, name=f"mirror-{project_id}",
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def wrap_get_sources(cmdline, project_dir):
+    """
+    Lets GitLab's get_sources stage borrow objects from the mirror.
+
+    The mirror's objects are made available to git through the environment
+    while the sources are fetched, so only objects missing in the mirror are
+    transferred. Afterwards the mirror is added to the alternates of the
+    cloned repository, which keeps depending on it in the later stages.
+
+    :param cmdline: command line of the stage as string
+    :param project_dir: the job's CI_PROJECT_DIR as string or None
+    :return: command line as string
+    """
+
+    objects = shlex.quote(f"{ConfigMap()['mirrors']['mount']}/objects")
+
+    wrapped = f"GIT_ALTERNATE_OBJECT_DIRECTORIES={objects} {cmdline}; rc=$?"
+    if project_dir is not None:
+        info = shlex.quote(f"{project_dir}/.git/objects/info")
+        wrapped += (f"; [ $rc -ne 0 ] || [ ! -d {info} ] || "
+                    f"grep -qsxF {objects} {info}/alternates || "
+                    f"echo {objects} >> {info}/alternates")
+    return wrapped + "; exit $rc"
@@ -0,0 +1,165 @@
+# placement.py - module containing the NUMA aware vCPU placement
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import time
+
+from provisioner import hosts
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Seconds an allocation of a domain which isn't running is kept, so that
+# allocations of machines which are still being created aren't released
+PENDING_TTL = 600
+
+
+def _allocations_path(name="allocations.json"):
+    return state.state_path("placement", hosts.state_key(), name)
+
+
+def _get_free_cpus(node, allocated, reserved):
+    """
+    Lists the free host CPUs of a NUMA node, whole cores first.
+
+    :param node: dictionary as returned by LibvirtHandle.get_host_topology()
+    :param allocated: set of host CPUs allocated to machines
+    :param reserved: set of host CPUs never allocated
+    :return: list of host CPU numbers
+    """
+
+    cores = {}
+    for cpu in node["cpus"]:
+        cores.setdefault(cpu["siblings"], []).append(cpu["id"])
+
+    whole = []
+    partial = []
+    for cpus in sorted(cores.values()):
+        free = [cpu for cpu in cpus
+                if cpu not in allocated and cpu not in reserved]
+        if len(free) == len(cpus):
+            whole.extend(free)
+        else:
+            partial.extend(free)
+    return whole + partial
+
+
+def _prune(allocations, libvirt_handle):
+    """Drops allocations of domains which are gone."""
+
+    active = set(libvirt_handle.list_domain_names())
+    now = time.time()
+    for domain, allocation in list(allocations.items()):
+        if domain not in active and now - allocation["time"] > PENDING_TTL:
+            log.debug(f"Releasing stale placement of '{domain}'")
+            del allocations[domain]
+
+
+def allocate(domain, vcpus, memory):
+    """
+    Allocates free host CPUs of a single NUMA node to a machine.
+
+    Each vCPU gets a host CPU of its own, threads of whole free cores are
+    preferred, so that machines don't share cores with each other. The node
+    with the most free CPUs which also has enough unallocated memory is
+    chosen.
+
+    :param domain: name of the machine's domain as string
+    :param vcpus: number of vCPUs of the machine as int
+    :param memory: memory of the machine in MiB as int
+    :return: dictionary with 'node' and 'cpus' (one host CPU per vCPU) keys
+             or None if the machine should float, either because pinning
+             isn't configured or the host is saturated
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    settings = ConfigMap()["placement"]
+    if settings["mode"] != "pinned":
+        return None
+
+    libvirt_handle = LibvirtHandle()
+    topology = libvirt_handle.get_host_topology()
+    reserved = set(settings["reserved_cpus"])
+
+    with state.locked(_allocations_path("allocations.lock")):
+        allocations = state.read_json(_allocations_path(), {})
+        _prune(allocations, libvirt_handle)
+
+        allocated = set()
+        committed = {}
+        for allocation in allocations.values():
+            allocated.update(allocation["cpus"])
+            committed[allocation["node"]] = (
+                committed.get(allocation["node"], 0) + allocation["memory"])
+
+        best = None
+        for node_id, node in topology.items():
+            if committed.get(node_id, 0) + memory > node["memory"]:
+                continue
+
+            free = _get_free_cpus(node, allocated, reserved)
+            if len(free) >= vcpus and (best is None or
+                                       len(free) > len(best[1])):
+                best = (node_id, free)
+
+        if best is None:
+            log.debug(f"No NUMA node has {vcpus} free CPUs and {memory} MiB "
+                      f"for '{domain}', letting it float")
+            return None
+
+        allocation = {
+            "node": best[0],
+            "cpus": best[1][:vcpus],
+            "memory": memory,
+            "time": time.time(),
+        }
+        allocations[domain] = allocation
+        state.write_json(_allocations_path(), allocations)
+
+    log.debug(f"Placing '{domain}' on NUMA node {allocation['node']}, "
+              f"host CPUs {allocation['cpus']}")
+    return allocation
+
+
+def release(domain):
+    """Releases the host CPUs allocated to a machine, if any."""
+
+    with state.locked(_allocations_path("allocations.lock")):
+        allocations = state.read_json(_allocations_path(), {})
+        if allocations.pop(domain, None) is not None:
+            log.debug(f"Releasing placement of '{domain}'")
+            state.write_json(_allocations_path(), allocations)
+
+
+def status():
+    """
+    Returns how much of each NUMA node is allocated to pinned machines.
+
+    :return: dictionary of node number -> dictionary with 'cpus',
+             'pinned_cpus', 'memory' and 'pinned_memory' (in MiB) keys
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    topology = LibvirtHandle().get_host_topology()
+    allocations = state.read_json(_allocations_path(), {})
+
+    nodes = {}
+    for node_id, node in topology.items():
+        nodes[node_id] = {
+            "cpus": len(node["cpus"]),
+            "pinned_cpus": 0,
+            "memory": node["memory"],
+            "pinned_memory": 0,
+        }
+    for allocation in allocations.values():
+        node = nodes.get(allocation["node"])
+        if node is not None:
+            node["pinned_cpus"] += len(allocation["cpus"])
+            node["pinned_memory"] += allocation["memory"]
+    return nodes
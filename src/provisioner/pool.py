@@ -0,0 +1,181 @@
+# pool.py - module containing the warm pool of pre-booted machines
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import sys
+import time
+
+from provisioner import state
+from provisioner.configmap import ConfigMap
+from provisioner.machine import Machine
+
+log = logging.getLogger(__name__)
+
+
+class WarmPool:
+    """
+    A pool of booted, SSH-reachable machines of a single distro.
+
+    Pool members are regular transient machines which are provisioned ahead of
+    time. Once a member is ready, a state file is published for it in the
+    pool's directory. Claiming a member means atomically moving its state file
+    to the machine records directory under the GitLab job machine name, so
+    that any concurrent prepare process can only ever claim it once.
+
+    The usual flow of actions is as follows:
+        pool = WarmPool(distro)
+        if pool.claim(name, ssh_key_file) is None:
+            # pool is empty, fall back to cold provisioning
+        pool.refill(ssh_key_file)
+    """
+
+    def __init__(self, distro):
+        self.distro = distro
+
+    @property
+    def target(self):
+        return int(ConfigMap()["pool"]["targets"].get(self.distro, 0))
+
+    def _member_path(self, member=""):
+        return state.state_path("pool", self.distro, member)
+
+    def members(self):
+        """Lists names of the members ready to be claimed."""
+
+        pool_dir = self._member_path()
+        if not pool_dir.exists():
+            return []
+
+        return sorted(p.stem for p in pool_dir.glob("*.json"))
+
+    def _count(self, counter):
+        with state.locked(state.state_path("pool", "stats.lock")):
+            stats_path = state.state_path("pool", "stats.json")
+            stats = state.read_json(stats_path, {})
+            distro_stats = stats.setdefault(self.distro, {"hits": 0,
+                                                          "misses": 0})
+            distro_stats[counter] += 1
+            state.write_json(stats_path, stats)
+
+        log.debug(f"Warm pool '{self.distro}': {distro_stats}")
+
+    def stats(self):
+        stats = state.read_json(state.state_path("pool", "stats.json"), {})
+        return stats.get(self.distro, {"hits": 0, "misses": 0})
+
+    def claim(self, name, ssh_key_path):
+        """
+        Claims a ready member of the pool for machine @name.
+
+        :param name: name the machine will be known as from now on as string
+        :param ssh_key_path: path to the SSH key to verify the member with
+        :return: Machine instance or None if the pool had no usable member
+        """
+
+        for member in self.members():
+            try:
+                os.rename(self._member_path(f"{member}.json"),
+                          state.state_path("machines", f"{name}.json"))
+            except FileNotFoundError:
+                # somebody else was faster
+                continue
+
+            log.debug(f"Claimed warm pool member '{member}' as '{name}'")
+
+            # the machine's age counts from the claim, see reaper.py
+            machine = Machine(name)
+            machine.record["created"] = time.time()
+            state.set_machine_record(name, machine.record)
+
+            # the member might have died while waiting in the pool
+            try:
+                machine.connect(ssh_key_path)
+            except Exception as ex:
+                log.debug(f"Warm pool member '{member}' unusable: {ex}")
+                machine.teardown()
+                continue
+
+            self._count("hits")
+            return machine
+
+        self._count("misses")
+        return None
+
+    def refill(self, ssh_key_path):
+        """
+        Provisions new members until the pool reaches its target size.
+
+        Only a single refill runs for a distro at a time, any concurrent
+        attempt returns immediately.
+        """
+
+        with state.locked(state.state_path("pool", f"{self.distro}.lock"),
+                          blocking=False) as acquired:
+            if not acquired:
+                log.debug(f"Warm pool '{self.distro}' refill already running")
+                return
+
+            while len(self.members()) < self.target:
+                import random
+                from string import ascii_lowercase
+
+                randstr = "".join(random.sample(ascii_lowercase, 8))
+                member = f"gitlab-pool-{self.distro}-{randstr}"
+
+                log.debug(f"Adding '{member}' to warm pool '{self.distro}'")
+                machine = Machine(member)
+                try:
+                    machine.provision(self.distro, ssh_key_path)
+                except Exception:
+                    machine.teardown()
+                    raise
+
+                # publish the member only once it's ready
+                os.rename(state.state_path("machines", f"{member}.json"),
+                          self._member_path(f"{member}.json"))
+
+    def refill_async(self):
+        """Spawns a detached 'libvirt-gci pool refill' for this distro."""
+
+        import subprocess
+
+        if ConfigMap()["pool"]["refill"] != "on-claim" or self.target == 0:
+            return
+
+        cmd = [sys.executable, "-m", "provisioner", "pool", "refill",
+               "--distro", self.distro]
+
+        configmap = ConfigMap()
+        if configmap["config_file"] is not None:
+            cmd[3:3] = ["--config", str(configmap["config_file"])]
+        if configmap["ssh_key_file"] is not None:
+            cmd.extend(["--ssh-key-file", str(configmap["ssh_key_file"])])
+
+        # don't let the job environment leak into the refill process
+        env = {k: v for k, v in os.environ.items()
+               if not k.startswith("CUSTOM_ENV_")}
+
+        log.debug(f"Spawning warm pool refill: {cmd}")
+        subprocess.Popen(cmd, env=env, start_new_session=True,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+
+    def drain(self):
+        """Destroys all members which haven't been claimed yet."""
+
+        for member in self.members():
+            # the teardown needs the member's record to find its host
+            try:
+                os.rename(self._member_path(f"{member}.json"),
+                          state.state_path("machines", f"{member}.json"))
+            except FileNotFoundError:
+                # claimed meanwhile
+                continue
+
+            log.debug(f"Removing '{member}' from warm pool '{self.distro}'")
+            Machine(member).teardown()
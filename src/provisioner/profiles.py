@@ -0,0 +1,236 @@
+# profiles.py - module containing machine resource profiles and admission
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import threading
+
+from contextlib import ExitStack, contextmanager
+from time import monotonic, time_ns
+
+from provisioner import hosts
+from provisioner import metrics
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Resources of the built-in 'default' profile, profiles defined in the
+# configuration file inherit anything they don't specify from it
+DEFAULT_PROFILE = {
+    "vcpus": 4,
+    "memory": 8192,  # MiB
+    "disk": 50,      # GB
+    "disk_profile": None,  # see disks.py, None means 'disks.profile'
+    # memory density options
+    "free_page_reporting": False,  # hand memory freed by the guest back
+    "memory_sharing": True,        # let KSM merge identical pages
+    "hugepages": False,            # back the memory with huge pages
+    "lock_memory": False,          # never swap the memory out
+}
+
+# Memory of the QEMU process on top of the guest memory, QEMU needs a limit
+# covering both to lock the guest memory
+QEMU_MEMORY_OVERHEAD = 1024  # MiB
+
+
+def get_profiles():
+    """
+    Returns all known profiles.
+
+    :return: dictionary of profile name -> profile dictionary
+    """
+
+    definitions = {"default": {}}
+    definitions.update(ConfigMap()["profiles"]["definitions"])
+
+    profiles = {}
+    for name, definition in definitions.items():
+        profile = dict(DEFAULT_PROFILE)
+        profile.update(definition or {})
+        profile["name"] = name
+        profiles[name] = profile
+    return profiles
+
+
+def select(distro, project=None, requested=None):
+    """
+    Selects the resource profile for a machine.
+
+    An explicitly requested profile takes precedence over the project's
+    profile which in turn takes precedence over the distro's profile. If none
+    of them is configured, the 'default' profile is used.
+
+    :param distro: distro the machine is provisioned from as string
+    :param project: name of the GitLab project as string
+    :param requested: profile name requested by the job as string
+    :return: profile dictionary with 'name', 'vcpus', 'memory' (in MiB) and
+             'disk' (in GB) keys
+    """
+
+    settings = ConfigMap()["profiles"]
+
+    name = requested
+    if name is None and project is not None:
+        name = settings["projects"].get(project)
+    if name is None:
+        name = settings["distros"].get(distro, "default")
+
+    profiles = get_profiles()
+    if name not in profiles:
+        raise Exception(f"Unknown resource profile '{name}'")
+
+    profile = profiles[name]
+
+    # locked memory can't be handed back to the host
+    if profile["lock_memory"] and profile["free_page_reporting"]:
+        raise Exception(f"Resource profile '{name}': lock_memory and "
+                        "free_page_reporting are mutually exclusive")
+
+    return profile
+
+
+def get_limits(capacity):
+    """
+    Computes how much of the host can be handed out to machines.
+
+    :param capacity: dictionary returned by LibvirtHandle.get_host_capacity()
+    :return: dictionary with 'vcpus' and 'memory' (in MiB) keys
+    """
+
+    settings = ConfigMap()["profiles"]
+
+    return {
+        "vcpus": int(capacity["cpus"] * settings["cpu_overcommit"]),
+        "memory": capacity["memory"] - settings["reserved_memory"],
+    }
+
+
+def check(profile, capacity):
+    """
+    Checks whether a machine of @profile fits on the host right now.
+
+    Both the resources committed to running domains and the memory actually
+    available on the host are considered. Freshly booted guests haven't
+    touched most of their memory yet, so the available memory alone would
+    let the host be overcommitted.
+
+    :param profile: profile dictionary as returned by select()
+    :param capacity: dictionary returned by LibvirtHandle.get_host_capacity()
+    :return: None if the machine fits, otherwise the reason as string
+    """
+
+    limits = get_limits(capacity)
+    reserved = ConfigMap()["profiles"]["reserved_memory"]
+
+    if capacity["committed_vcpus"] + profile["vcpus"] > limits["vcpus"]:
+        return (f"{capacity['committed_vcpus']} of {limits['vcpus']} vCPUs "
+                "committed")
+
+    if capacity["committed_memory"] + profile["memory"] > limits["memory"]:
+        return (f"{capacity['committed_memory']} of {limits['memory']} MiB "
+                "committed")
+
+    if capacity["available_memory"] - reserved < profile["memory"]:
+        return f"only {capacity['available_memory']} MiB available"
+
+    return None
+
+
+def is_oversized(profile, capacity):
+    """Checks whether a machine of @profile can never fit on the host."""
+
+    limits = get_limits(capacity)
+    return (profile["vcpus"] > min(capacity["cpus"], limits["vcpus"]) or
+            profile["memory"] > limits["memory"])
+
+
+def _reserve(capacity, key):
+    """
+    Adds the resources of machines admitted onto a host to @capacity.
+
+    The domains of admitted machines may not exist yet, so they're accounted
+    for through the reservation files admit() holds locked until the domain
+    is created. Reservations of processes which died in the meantime are
+    removed. The capacity lock needs to be held.
+
+    :param capacity: dictionary returned by LibvirtHandle.get_host_capacity()
+    :param key: state key of the host, see hosts.state_key()
+    """
+
+    for path in state.state_path("capacity", key, "").glob("*.json"):
+        with state.locked(path, blocking=False) as held:
+            if held:
+                log.debug(f"Removing stale reservation '{path.name}'")
+                path.unlink()
+                continue
+
+        reservation = state.read_json(path, {"vcpus": 0, "memory": 0})
+        capacity["committed_vcpus"] += reservation["vcpus"]
+        capacity["committed_memory"] += reservation["memory"]
+        capacity["available_memory"] -= reservation["memory"]
+
+
+@contextmanager
+def admit(profile):
+    """
+    Context manager admitting a machine of @profile onto the host selected
+    by hosts.host().
+
+    The capacity checks of concurrent libvirt-gci processes are serialized,
+    the resources of an admitted machine are reserved until the body, which
+    should create the domain, finishes. If the machine doesn't fit, it either
+    waits for capacity to free up or fails right away, depending on the
+    'profiles.when_full' setting.
+
+    :param profile: profile dictionary as returned by select()
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+    from provisioner.readiness import Backoff
+
+    settings = ConfigMap()["profiles"]
+    key = hosts.state_key()
+    lock_path = state.state_path("capacity", f"{key}.lock")
+
+    ticket = f"{time_ns():020d}-{os.getpid()}-{threading.get_ident()}"
+    reservation_path = state.state_path("capacity", key, f"{ticket}.json")
+
+    with ExitStack() as stack:
+        begin = monotonic()
+        backoff = Backoff(settings["queue_timeout"], initial=1, maximum=10)
+        while backoff.wait():
+            with state.locked(lock_path):
+                capacity = LibvirtHandle().get_host_capacity()
+                if is_oversized(profile, capacity):
+                    raise Exception(f"Resource profile '{profile['name']}' "
+                                    "exceeds the host capacity")
+
+                _reserve(capacity, key)
+                reason = check(profile, capacity)
+                if reason is None:
+                    # the lock tells the reservation from a stale one
+                    state.write_json(reservation_path, {
+                        "vcpus": profile["vcpus"],
+                        "memory": profile["memory"],
+                    })
+                    stack.enter_context(state.locked(reservation_path))
+                    stack.callback(reservation_path.unlink)
+                    break
+
+            if settings["when_full"] != "queue":
+                raise Exception(f"Host is full for resource profile "
+                                f"'{profile['name']}': {reason}")
+
+            log.debug(f"Waiting for capacity for resource profile "
+                      f"'{profile['name']}': {reason}")
+        else:
+            raise Exception(f"Timed out waiting for capacity for resource "
+                            f"profile '{profile['name']}': {reason}")
+
+        metrics.record("capacity_wait", monotonic() - begin,
+                       profile=profile["name"])
+        yield
@@ -0,0 +1,233 @@
+# readiness.py - module containing guest readiness detection strategies
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import errno
+import logging
+import socket
+
+from time import monotonic, sleep
+
+from provisioner import metrics
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# errnos we expect while the guest is still booting
+TRANSIENT_ERRNOS = [
+    errno.EHOSTUNREACH,
+    errno.ECONNREFUSED,
+    errno.ECONNRESET,
+    errno.ETIMEDOUT,
+]
+
+# paramiko errors we expect while sshd is still starting up, they're told
+# apart from e.g. an unreadable key only by their messages
+TRANSIENT_SSH_ERRORS = [
+    "Error reading SSH protocol banner",
+    "Indecipherable protocol version",
+    "Negotiation failed",
+    "No existing session",
+    "SSH session not active",
+    "Unable to connect to",
+]
+
+
+class Backoff:
+    """
+    Exponential backoff bounded by a deadline.
+
+    The usual flow of actions is as follows:
+        backoff = Backoff(timeout)
+        while backoff.wait():
+            if attempt():
+                break
+    """
+
+    def __init__(self, timeout, initial=0.05, maximum=1.0):
+        """
+        :param timeout: overall time budget in seconds
+        :param initial: first delay in seconds
+        :param maximum: upper bound of a single delay in seconds
+        """
+
+        self.deadline = monotonic() + timeout
+        self.delay = initial
+        self.maximum = maximum
+        self._first = True
+
+    def expired(self):
+        return monotonic() >= self.deadline
+
+    def wait(self):
+        """Sleeps before the next attempt, returns False once out of time."""
+
+        if self._first:
+            self._first = False
+            return True
+
+        remaining = self.deadline - monotonic()
+        if remaining <= 0:
+            return False
+
+        sleep(min(self.delay, remaining))
+        self.delay = min(self.delay * 2, self.maximum)
+        return True
+
+
+def _is_transient(ex):
+    """Checks whether a connection error means 'not booted yet'."""
+
+    from paramiko import ssh_exception
+
+    if isinstance(ex, ssh_exception.NoValidConnectionsError):
+        # NoValidConnectionsError is a subclass of various socket errors
+        # which in turn is a subclass of OSError, it aggregates the errors of
+        # all the addresses that were tried
+        return all(_is_transient(e) for e in ex.errors.values())
+
+    # an encrypted key won't get any more usable
+    if isinstance(ex, ssh_exception.PasswordRequiredException):
+        return False
+
+    # sshd is up, but cloud-init hasn't installed the keys yet
+    if isinstance(ex, ssh_exception.AuthenticationException):
+        return True
+
+    # sshd is starting up or the connection dropped during the handshake,
+    # anything else, e.g. a key which can't be loaded, won't go away
+    if isinstance(ex, ssh_exception.SSHException):
+        return any(str(ex).startswith(message)
+                   for message in TRANSIENT_SSH_ERRORS)
+
+    if isinstance(ex, EOFError):
+        return True
+
+    if isinstance(ex, socket.gaierror):
+        # Name or service not known, i.e. no DHCP lease yet
+        return ex.errno in [socket.EAI_NONAME, socket.EAI_AGAIN]
+
+    if isinstance(ex, socket.timeout):
+        return True
+
+    if isinstance(ex, OSError):
+        return ex.errno in TRANSIENT_ERRNOS
+
+    return False
+
+
+def _wait_ssh(machine, ssh_key_path, backoff):
+    """Confirms readiness by logging in over SSH."""
+
+    attempt = 0
+    while backoff.wait():
+        attempt += 1
+        try:
+            with metrics.span("ssh_attempt", attempt=attempt):
+                machine.connect(ssh_key_path, timeout=5)
+            return
+        except Exception as ex:
+            if not _is_transient(ex):
+                raise ex
+            log.debug(f"SSH to '{machine.domain}' not ready yet: {ex}")
+
+    raise Exception(f"Failed to connect to {machine.name}: timeout reached")
+
+
+def _wait_tcp(host, backoff, port=22):
+    """Waits until @host accepts TCP connections on @port."""
+
+    while backoff.wait():
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                log.debug(f"'{host}:{port}' accepts connections")
+                return
+        except OSError as ex:
+            if not _is_transient(ex):
+                raise ex
+
+    raise Exception(f"Failed to connect to {host}: timeout reached")
+
+
+def _wait_lease(machine, backoff):
+    """
+    Waits for the domain to obtain a DHCP lease, returns the leased address.
+
+    Fails immediately if the domain stops running in the meantime instead of
+    waiting for the timeout to expire.
+    """
+
+    import libvirt
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    domain = LibvirtHandle().conn.lookupByName(machine.domain)
+    src = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE
+    while backoff.wait():
+        if not domain.isActive():
+            raise Exception(f"Machine '{machine.name}' stopped while booting")
+
+        for iface in (domain.interfaceAddresses(src) or {}).values():
+            for addr in iface.get("addrs") or []:
+                if addr["type"] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                    log.debug(f"'{machine.domain}' leased {addr['addr']}")
+                    return addr["addr"]
+
+    raise Exception(f"Machine '{machine.name}' got no DHCP lease: "
+                    "timeout reached")
+
+
+def wait(machine, ssh_key_path):
+    """
+    Blocks until the machine can be logged into over SSH.
+
+    The way the readiness is detected is selected by the 'readiness' section
+    of the configuration:
+        poll  - try logging in over SSH every 2 seconds
+        tcp   - probe the SSH port with a millisecond granularity backoff
+        lease - wait for a DHCP lease on the libvirt network first, then
+                probe the leased address' SSH port
+
+    All of the strategies confirm the readiness by logging in over SSH.
+    Machines of remote hypervisors aren't known to libvirt's NSS module, they
+    always wait for a lease and are reached at the leased address from then
+    on.
+
+    :param machine: Machine instance to wait for
+    :param ssh_key_path: path to the SSH key to be used (as string)
+    """
+
+    from provisioner import hosts
+
+    settings = ConfigMap()["readiness"]
+    strategy = settings["strategy"]
+    timeout = settings["timeout"]
+    if hosts.is_remote(hosts.current_uri()):
+        strategy = "lease"
+
+    log.debug(f"Waiting for '{machine.name}' to become ready: "
+              f"strategy={strategy},timeout={timeout}")
+
+    if strategy == "poll":
+        # we need to give the machine a head start to get an IP lease first
+        # and only then we can try SSHing into the machine
+        sleep(2)
+        return _wait_ssh(machine, ssh_key_path,
+                         Backoff(timeout, initial=2, maximum=2))
+
+    backoff = Backoff(timeout)
+    if strategy == "tcp":
+        _wait_tcp(machine.domain, backoff)
+    elif strategy == "lease":
+        address = _wait_lease(machine, backoff)
+        machine.set_address(address)
+        _wait_tcp(address, backoff)
+    else:
+        raise Exception(f"Unknown readiness strategy '{strategy}'")
+
+    # sshd accepting connections doesn't mean cloud-init is done, keep a short
+    # backoff for the login itself
+    _wait_ssh(machine, ssh_key_path,
+              Backoff(max(backoff.deadline - monotonic(), 1), initial=0.2))
@@ -0,0 +1,315 @@
+# reaper.py - module containing deferred teardown and garbage collection
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from provisioner import hosts
+from provisioner import joblog
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Prefix of the domains and overlay volumes of all machines libvirt-gci
+# provisions for GitLab, including warm pool members
+MACHINE_PREFIX = "gitlab-"
+
+# Prefix of the temporary files and directories libvirt-gci creates
+TEMP_PREFIX = "libvirt-gci"
+
+
+def _marker_path(domain=""):
+    return state.state_path("reap", f"{domain}.json" if domain else "")
+
+
+def markers():
+    """Lists the domains marked for reaping."""
+
+    reap_dir = _marker_path()
+    if not reap_dir.exists():
+        return []
+
+    return sorted(p.stem for p in reap_dir.glob("*.json"))
+
+
+def mark(domain, host=None):
+    """
+    Marks a machine's domain and overlay volume for reaping.
+
+    The machine must have been forgotten already, i.e. nothing can claim or
+    connect to it anymore. It keeps holding the host's resources until the
+    reaper destroys it, so marked domains count towards
+    'admission.max_machines'.
+
+    :param domain: name of the machine's domain as string
+    :param host: connection URI of the machine's hypervisor, None means the
+                 default one
+    """
+
+    log.debug(f"Marking '{domain}' for reaping")
+    state.write_json(_marker_path(domain), {"domain": domain,
+                                            "host": host,
+                                            "time": time.time()})
+
+
+def spawn_async():
+    """Spawns a detached 'libvirt-gci gc' reaping the marked machines."""
+
+    import subprocess
+
+    if ConfigMap()["cleanup"]["reap"] != "on-cleanup":
+        return
+
+    cmd = [sys.executable, "-m", "provisioner", "gc"]
+
+    configmap = ConfigMap()
+    if configmap["config_file"] is not None:
+        cmd[3:3] = ["--config", str(configmap["config_file"])]
+
+    # don't let the job environment leak into the reaper process
+    env = {k: v for k, v in os.environ.items()
+           if not k.startswith("CUSTOM_ENV_")}
+
+    log.debug(f"Spawning reaper: {cmd}")
+    subprocess.Popen(cmd, env=env, start_new_session=True,
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL)
+
+
+def _destroy(host, domains):
+    """
+    Destroys a batch of domains first and deletes their volumes afterwards.
+
+    Destroying all of the domains first hands their vCPUs and memory back to
+    the host as early as possible, the slow storage deletion comes last.
+
+    :param host: connection URI of the domains' hypervisor, None means the
+                 default one
+    :param domains: list of domain names
+    """
+
+    from provisioner import placement
+    from provisioner import shared_dirs
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    with hosts.host(host):
+        libvirt_handle = LibvirtHandle()
+        for domain in domains:
+            libvirt_handle.cleanup_machine(domain)
+            placement.release(domain)
+        for domain in domains:
+            libvirt_handle.cleanup_storage(domain)
+            shared_dirs.release(domain)
+
+
+def _reap_marked():
+    """
+    Reaps the machines marked by deferred cleanups.
+
+    :return: number of machines reaped
+    """
+
+    reaped = 0
+    batch = markers()
+    while batch:
+        by_host = {}
+        for domain in batch:
+            marker = state.read_json(_marker_path(domain), {})
+            by_host.setdefault(marker.get("host"), []).append(domain)
+
+        for host, domains in by_host.items():
+            _destroy(host, domains)
+        for domain in batch:
+            _marker_path(domain).unlink(missing_ok=True)
+        reaped += len(batch)
+
+        # cleanups which finished in the meantime
+        batch = markers()
+    return reaped
+
+
+def _get_age(path, record):
+    created = record.get("created")
+    if created is None:
+        created = path.stat().st_mtime
+    return time.time() - created
+
+
+def _reap_expired_records():
+    """
+    Reaps machines which outlived 'cleanup.max_machine_age'.
+
+    Such machines belong to jobs whose cleanup stage never ran, e.g. because
+    gitlab-runner got killed.
+
+    :return: number of machines reaped
+    """
+
+    max_age = ConfigMap()["cleanup"]["max_machine_age"]
+    if max_age is None:
+        return 0
+
+    reaped = 0
+    for path in sorted(state.state_path("machines", "").glob("*.json")):
+        record = state.read_json(path)
+        if record is None or _get_age(path, record) < max_age:
+            continue
+
+        log.debug(f"Machine '{path.stem}' exceeded the maximum age")
+        state.del_machine_record(path.stem)
+        _destroy(record.get("host"), [record["domain"]])
+        reaped += 1
+    return reaped
+
+
+def _get_known_domains():
+    """Returns the domains any libvirt-gci process still knows about."""
+
+    known = set(markers())
+    for path in state.state_path("machines", "").glob("*.json"):
+        record = state.read_json(path)
+        if record is not None:
+            known.add(record["domain"])
+    for path in state.state_path("pool", "").glob("*/*.json"):
+        known.add(path.stem)
+    return known
+
+
+def _reap_orphans(host):
+    """
+    Reaps machine domains and volumes of a hypervisor nobody knows about
+    anymore.
+
+    Neither libvirt nor the storage pool tell how old a domain or a volume
+    is, so an unknown name is only reaped once it has been seen for longer
+    than 'cleanup.orphan_ttl', which also covers any race with a machine
+    being provisioned or torn down right now.
+
+    :param host: connection URI of the hypervisor
+    :return: number of orphans reaped
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    ttl = ConfigMap()["cleanup"]["orphan_ttl"]
+
+    try:
+        libvirt_handle = LibvirtHandle(host)
+        names = set(libvirt_handle.list_domain_names(MACHINE_PREFIX))
+        names.update(libvirt_handle.list_volume_names(MACHINE_PREFIX))
+    except Exception as ex:
+        log.debug(f"Skipping orphans of unreachable host '{host}': {ex}")
+        return 0
+    names -= _get_known_domains()
+
+    now = time.time()
+    seen_path = state.state_path("reap", "orphans",
+                                 f"{hosts.state_key(host)}.json")
+    seen = state.read_json(seen_path, {})
+    seen = {name: seen.get(name, now) for name in names}
+
+    orphans = sorted(name for name, first_seen in seen.items()
+                     if now - first_seen >= ttl)
+    if orphans:
+        log.debug(f"Reaping orphans: {orphans}")
+        _destroy(host, orphans)
+        for name in orphans:
+            del seen[name]
+
+    state.write_json(seen_path, seen)
+    return len(orphans)
+
+
+def _evict_seeds(host):
+    """Evicts the retired cloud-init seeds of a hypervisor, see cloud_init.py."""
+
+    from provisioner import cloud_init
+
+    try:
+        return cloud_init.evict_seeds(host,
+                                      ConfigMap()["cleanup"]["orphan_ttl"])
+    except Exception as ex:
+        log.debug(f"Skipping seeds of unreachable host '{host}': {ex}")
+        return 0
+
+
+def _remove_stale_files():
+    """
+    Removes temporary files left behind by killed libvirt-gci processes.
+
+    These are the cloud-init seed staging directories and the temporary files
+    the state directory is updated through.
+
+    :return: number of files and directories removed
+    """
+
+    ttl = ConfigMap()["cleanup"]["orphan_ttl"]
+    now = time.time()
+
+    candidates = list(Path(tempfile.gettempdir()).glob(f"{TEMP_PREFIX}*"))
+    candidates.extend(state.state_path().rglob(".*.tmp"))
+
+    removed = 0
+    for path in candidates:
+        try:
+            if now - path.lstat().st_mtime < ttl:
+                continue
+
+            log.debug(f"Removing stale temporary file '{path}'")
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+            removed += 1
+        except OSError as ex:
+            log.debug(f"Failed to remove '{path}': {ex}")
+    return removed
+
+
+def reap():
+    """
+    Reaps marked machines and garbage collects orphaned resources.
+
+    Only a single reaper runs at a time, any concurrent attempt returns
+    immediately.
+
+    :return: dictionary with the number of 'marked', 'expired' and 'orphans'
+             machines reaped and stale or expired 'files' removed, None if
+             another reaper is running
+    """
+
+    lock_path = state.state_path("reap.lock")
+
+    stats = None
+    while True:
+        with state.locked(lock_path, blocking=False) as acquired:
+            if not acquired:
+                log.debug("Reaper already running")
+                return stats
+
+            if stats is None:
+                stats = {
+                    "marked": 0,
+                    "expired": _reap_expired_records(),
+                    "orphans": sum(_reap_orphans(host) + _evict_seeds(host)
+                                   for host in hosts.get_hosts()),
+                    "files": (_remove_stale_files() +
+                              joblog.remove_expired()),
+                }
+            stats["marked"] += _reap_marked()
+
+        # a reaper spawned while we held the lock gave up on it, take over
+        # the machines it was spawned for
+        if not markers():
+            return stats
@@ -0,0 +1,285 @@
+# saved_state.py - module containing the save/restore based instant start
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import uuid
+
+from contextlib import contextmanager
+
+from provisioner import hosts
+from provisioner import metrics
+from provisioner import state
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# Prefix of the machines the memory states are saved from, their overlay
+# volumes and state files. It differs from reaper.MACHINE_PREFIX on purpose,
+# the volumes need to outlive the machines.
+STATE_PREFIX = "libvirt-gci-state-"
+
+# Makes a restored guest its own machine, the new hostname is passed as $1
+FIXUP_SCRIPT = """
+hostnamectl set-hostname "$1" 2>/dev/null || hostname "$1"
+rm -f /etc/ssh/ssh_host_*
+ssh-keygen -A
+systemctl restart sshd 2>/dev/null || systemctl restart ssh 2>/dev/null ||
+    service sshd restart
+"""
+
+
+def _states_path(name="states.json"):
+    return state.state_path("images", "states", hosts.state_key(), name)
+
+
+def _get_states():
+    return state.read_json(_states_path(), {})
+
+
+def _set_state(distro, record):
+    with state.locked(_states_path("states.lock")):
+        states_path = _states_path()
+        states = state.read_json(states_path, {})
+        if record is None:
+            states.pop(distro, None)
+        else:
+            states[distro] = record
+        state.write_json(states_path, states)
+
+
+def _is_current(record, profile, seed_volume):
+    """Checks whether a saved state still matches what a job would boot."""
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    if record["profile"] != [profile["name"], profile["vcpus"],
+                             profile["memory"]]:
+        return False
+
+    if record["seed"] != seed_volume:
+        return False
+
+    base_image = LibvirtHandle().get_base_image(record["distro"])
+    return record["base_mtime"] == base_image["mtime"]
+
+
+@contextmanager
+def slot(distro, profile, seed_volume):
+    """
+    Context manager picking a saved state to restore a machine from.
+
+    Every saved state of a distro is a slot which a single machine can be
+    restored from at a time: the restored machine inherits the saved domain's
+    UUID and libvirt doesn't allow two domains with the same UUID. A slot is
+    free once the machine restored from it has been destroyed.
+
+    :param distro: distro the machine is provisioned from as string
+    :param profile: resource profile dictionary of the machine
+    :param seed_volume: name of the cloud-init seed volume the machine would
+                        be cold booted with as string
+    :return: the slot's dictionary with 'uuid', 'volume' and 'file' keys or
+             None if the machine needs to be cold booted
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    from provisioner import shared_dirs
+
+    record = _get_states().get(distro)
+    if ConfigMap()["provision"]["boot"] != "restore" or record is None:
+        yield None
+        return
+
+    # virtiofs devices can neither be saved nor plugged into a restored guest
+    if shared_dirs.enabled():
+        log.debug("Not restoring, directories are shared with the machines")
+        yield None
+        return
+
+    if not _is_current(record, profile, seed_volume):
+        log.debug(f"Saved state of '{distro}' is stale, "
+                  "run 'libvirt-gci save-state' to refresh it")
+        yield None
+        return
+
+    libvirt_handle = LibvirtHandle()
+    for candidate in record["slots"]:
+        lock_path = _states_path(f"{candidate['volume']}.lock")
+        with state.locked(lock_path, blocking=False) as acquired:
+            if not acquired or libvirt_handle.is_uuid_in_use(
+                    candidate["uuid"]):
+                continue
+
+            log.debug(f"Restoring from saved state '{candidate['volume']}'")
+            yield candidate
+            return
+
+    log.debug(f"All saved states of '{distro}' are in use")
+    yield None
+
+
+def _get_restore_xml(machine, saved):
+    """
+    Adjusts the saved domain definition for a new machine.
+
+    Only host specific parts of the definition may change, the guest has to
+    find its hardware exactly the way it was when the state was saved.
+    """
+
+    from provisioner import placement
+    from provisioner.domain_xml import DomainXML
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    xml = DomainXML.from_string(
+        LibvirtHandle().get_saved_domain_xml(saved["file"]))
+
+    xml.root.find("name").text = machine.name
+    for source in xml.root.findall("devices/disk[@device='disk']/source"):
+        if source.get("volume") == saved["volume"]:
+            source.set("volume", machine.name)
+
+    genid = xml.root.find("genid")
+    if genid is not None:
+        genid.text = str(uuid.uuid4())
+
+    # the saved machine's own placement doesn't apply anymore
+    vcpus = int(xml.root.find("vcpu").text)
+    memory = int(xml.root.find("memory").text) // 1024
+    allocation = placement.allocate(machine.name, vcpus, memory)
+    if allocation is not None:
+        xml.set_placement(allocation["cpus"], allocation["node"],
+                          ConfigMap()["placement"]["memory_mode"])
+    else:
+        xml.set_placement()
+
+    return xml.to_string()
+
+
+def restore(machine, saved):
+    """
+    Restores a machine from a saved state.
+
+    The machine's overlay volume needs to be created on top of the saved
+    state's volume already. The restored guest has no NIC, it gets its
+    hostname, SSH host keys and clock fixed up through the QEMU guest agent
+    before a NIC with a fresh MAC address is plugged in, so it requests its
+    DHCP lease under its own name.
+
+    :param machine: Machine instance to restore
+    :param saved: slot dictionary as returned by slot()
+    """
+
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    libvirt_handle = LibvirtHandle()
+    libvirt_handle.restore_domain(saved["file"],
+                                  _get_restore_xml(machine, saved))
+
+    with metrics.span("identity_fixup"):
+        libvirt_handle.set_domain_time(machine.name)
+        ret = libvirt_handle.guest_exec(machine.name,
+                                        ["/bin/sh", "-c", FIXUP_SCRIPT,
+                                         "sh", machine.name])
+        if ret != 0:
+            raise Exception(f"Failed to fix up the identity of "
+                            f"'{machine.name}': exit code {ret}")
+
+        libvirt_handle.attach_interface(machine.name, "default")
+
+
+def _delete_slots(record):
+    from provisioner.libvirt_handle import LibvirtHandle
+
+    libvirt_handle = LibvirtHandle()
+    libvirt_handle.refresh_pool()
+    for saved in record["slots"]:
+        libvirt_handle.cleanup_storage(saved["volume"])
+        libvirt_handle.cleanup_storage(saved["file"].rsplit("/", 1)[-1])
+
+
+def save(distro, profile, ssh_key_path):
+    """
+    Boots a distro's machines and saves their memory states.
+
+    The state files are kept in the 'default' storage pool along with the
+    overlay volumes of the machines they were saved from. Those volumes are
+    frozen from then on, machines restored from a state get an overlay on top
+    of them. Existing states of the distro are replaced. The states
+    are saved on the hypervisor selected by hosts.host().
+
+    :param distro: which distro template to use as string
+    :param profile: resource profile dictionary to boot the machines with
+    :param ssh_key_path: path to the SSH key to verify the machines with
+    """
+
+    from provisioner import cloud_init
+    from provisioner import placement
+    from provisioner import shared_dirs
+    from provisioner.libvirt_handle import LibvirtHandle
+    from provisioner.machine import Machine
+
+    if shared_dirs.enabled():
+        raise Exception("Machines with shared directories can't be saved, "
+                        "unset 'shared_dirs'")
+
+    libvirt_handle = LibvirtHandle()
+
+    old = _get_states().get(distro)
+    if old is not None:
+        busy = [saved["volume"] for saved in old["slots"]
+                if libvirt_handle.is_uuid_in_use(saved["uuid"])]
+        if busy:
+            raise Exception(f"Saved states {busy} are in use by machines")
+
+        _set_state(distro, None)
+        _delete_slots(old)
+
+    pool_path = libvirt_handle.get_pool_path()
+    record = {
+        "distro": distro,
+        "profile": [profile["name"], profile["vcpus"], profile["memory"]],
+        "seed": cloud_init.get_seed_volume(),
+        "base_mtime": libvirt_handle.get_base_image(distro)["mtime"],
+        "slots": [],
+    }
+
+    try:
+        for index in range(ConfigMap()["provision"]["restore_slots"]):
+            name = f"{STATE_PREFIX}{distro}-{index}"
+            log.debug(f"Saving memory state '{name}'")
+
+            machine = Machine(name)
+            try:
+                machine.provision(distro, ssh_key_path, profile, cold=True,
+                                  host=hosts.current_uri())
+
+                # the guest's page cache has to match the frozen volume
+                machine.conn.exec("sync")
+                machine.disconnect()
+
+                libvirt_handle.detach_interfaces(name)
+                saved = {
+                    "uuid": libvirt_handle.get_domain_uuid(name),
+                    "volume": name,
+                    "file": f"{pool_path}/{name}.save",
+                }
+                libvirt_handle.save_domain(name, saved["file"])
+                placement.release(name)
+            except Exception:
+                machine.teardown()
+                raise
+
+            state.del_machine_record(name)
+            record["slots"].append(saved)
+    except Exception:
+        _delete_slots(record)
+        raise
+
+    # make the state files visible as volumes, so they can be deleted
+    # through libvirt later
+    libvirt_handle.refresh_pool()
+
+    _set_state(distro, record)
@@ -0,0 +1,187 @@
+# shared_dirs.py - module containing the virtiofs shared cache and builds dirs
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import shlex
+import shutil
+
+from pathlib import Path, PurePosixPath
+
+from provisioner import hosts
+from provisioner import mirrors
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+# virtiofs tags the shared directories are exposed to the guests under
+CACHE_TAG = "gitlab-cache"
+BUILDS_TAG = "gitlab-builds"
+
+
+def enabled():
+    """Checks whether any host directory is shared with the machines."""
+
+    settings = ConfigMap()["shared_dirs"]
+    return (settings["cache"] is not None or settings["builds"] is not None or
+            mirrors.enabled())
+
+
+def get_boot_commands():
+    """
+    Returns cloud-init bootcmd entries mounting the shared directories.
+
+    The commands run on every boot and don't fail if a directory isn't
+    shared with the particular machine, e.g. because it runs on a remote
+    hypervisor, so the job falls back to a directory inside the machine.
+
+    :return: list of commands as lists of strings
+    """
+
+    settings = ConfigMap()["shared_dirs"]
+
+    mounts = []
+    if settings["cache"] is not None:
+        mounts.append((CACHE_TAG, settings["cache_mount"], "rw"))
+    if settings["builds"] is not None:
+        mounts.append((BUILDS_TAG, settings["builds_mount"], "rw"))
+    if mirrors.enabled():
+        mounts.append((mirrors.MIRROR_TAG, ConfigMap()["mirrors"]["mount"],
+                       "ro"))
+
+    commands = []
+    for tag, mount, mode in mounts:
+        mount = shlex.quote(mount)
+        commands.append(["sh", "-c",
+                         f"mkdir -p {mount} && "
+                         f"{{ mountpoint -q {mount} || "
+                         f"mount -t virtiofs -o {mode} {tag} {mount}; }} "
+                         "2>/dev/null || true"])
+    return commands
+
+
+def _get_project_dir(root, project_id):
+    # project names are only unique within a namespace, so the directory is
+    # keyed by the numeric project ID, which also can't escape the cache root
+    if project_id is None or not project_id.isdigit():
+        return None
+    return Path(root, project_id)
+
+
+def get_shares(domain):
+    """
+    Returns the host directories to share with a machine, creating them.
+
+    The cache directory and the git mirror are shared by all the jobs of a
+    project, the builds directory belongs to the machine alone and is removed
+    along with it (see release()). The directories need to exist on the
+    hypervisor when the machine starts, so nothing is shared with machines of
+    remote hypervisors.
+
+    :param domain: name of the machine's domain as string
+    :return: list of dictionaries with 'source' (host directory), 'tag',
+             'locking' and 'readonly' keys
+    """
+
+    settings = ConfigMap()["shared_dirs"]
+    if not enabled():
+        return []
+
+    uri = hosts.current_uri()
+    if hosts.is_remote(uri):
+        log.debug(f"Not sharing directories with '{domain}' on '{uri}'")
+        return []
+
+    shares = []
+    if settings["cache"] is not None:
+        path = _get_project_dir(settings["cache"], ConfigMap()["project_id"])
+        if path is None:
+            log.debug(f"Not sharing a cache directory with '{domain}', the "
+                      "project ID is unknown")
+        else:
+            path.mkdir(parents=True, exist_ok=True)
+            shares.append({
+                "source": str(path),
+                "tag": CACHE_TAG,
+                "locking": settings["cache_locking"],
+                "readonly": False,
+            })
+
+    if settings["builds"] is not None:
+        path = Path(settings["builds"], domain)
+        path.mkdir(parents=True, exist_ok=True)
+        shares.append({
+            "source": str(path),
+            "tag": BUILDS_TAG,
+            "locking": False,
+            "readonly": False,
+        })
+
+    # the mirror gets populated by mirrors.refresh() before the job's
+    # get_sources stage
+    path = mirrors.get_mirror_path(ConfigMap()["project_id"])
+    if path is not None:
+        from provisioner.libvirt_handle import LibvirtHandle
+
+        # a mirror the job could write to would let it plant objects in the
+        # clones of later jobs
+        version = LibvirtHandle().conn.getLibVersion()
+        if version < mirrors.READONLY_LIBVIRT_VERSION:
+            raise Exception("The git mirrors can't be shared read-only with "
+                            f"libvirt {version // 1000000}."
+                            f"{version // 1000 % 1000}, unset 'mirrors.dir' "
+                            "or upgrade to libvirt 11.0")
+
+        path.mkdir(parents=True, exist_ok=True)
+        shares.append({
+            "source": str(path),
+            "tag": mirrors.MIRROR_TAG,
+            "locking": False,
+            # the guest's read-only mount alone could be undone by the job
+            "readonly": True,
+        })
+
+    log.debug(f"Sharing directories with '{domain}': {shares}")
+    return shares
+
+
+def get_host_path(machine, path):
+    """
+    Returns where a path within a machine's shared builds directory is on
+    the host.
+
+    :param machine: Machine instance
+    :param path: absolute path inside the machine as string
+    :return: Path or None if @path isn't within a builds directory shared
+             with the machine
+    """
+
+    settings = ConfigMap()["shared_dirs"]
+    if (path is None or machine.record is None or
+            BUILDS_TAG not in machine.record.get("shares", [])):
+        return None
+
+    try:
+        relative = PurePosixPath(path).relative_to(settings["builds_mount"])
+    except ValueError:
+        return None
+
+    # the path comes from the job, it must not escape the builds directory
+    if ".." in relative.parts:
+        return None
+    return Path(settings["builds"], machine.domain, relative)
+
+
+def release(domain):
+    """Removes the builds directory of a destroyed machine, if any."""
+
+    builds = ConfigMap()["shared_dirs"]["builds"]
+    if builds is None or hosts.is_remote(hosts.current_uri()):
+        return
+
+    path = Path(builds, domain)
+    if path.exists():
+        log.debug(f"Removing builds directory '{path}'")
+        shutil.rmtree(path, ignore_errors=True)
@@ -4,11 +4,38 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Instances created within a Singleton.scope() block, see below
+_scoped_instances = ContextVar("scoped_instances", default=None)
+
+
 class Singleton(type):
     _instances = {}
 
     def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
+        instances = _scoped_instances.get()
+        if instances is None:
+            instances = cls._instances
+
+        if cls not in instances:
             instance = super(Singleton, cls).__call__(*args, **kwargs)
-            cls._instances[cls] = instance
-        return cls._instances[cls]
+            instances[cls] = instance
+        return instances[cls]
+
+    @staticmethod
+    @contextmanager
+    def scope():
+        """
+        Context manager providing a fresh set of singleton instances.
+
+        The daemon serves each request in its own scope, so that requests
+        handled concurrently don't share their Application and ConfigMap.
+        """
+
+        token = _scoped_instances.set({})
+        try:
+            yield
+        finally:
+            _scoped_instances.reset(token)
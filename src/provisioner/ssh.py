@@ -5,12 +5,24 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import logging
-import paramiko
+import select
+import sys
+
 from pathlib import Path
 
+from provisioner import metrics
+
 
 log = logging.getLogger(__name__)
 
+# Bounds of the adaptive read size used when streaming command output
+RECV_SIZE_MIN = 4 * 1024
+RECV_SIZE_MAX = 1024 * 1024
+
+# Paramiko's default 2 MiB channel window stalls high-volume output on the
+# remote side long before the local side can't keep up
+CHANNEL_WINDOW_SIZE = 16 * 1024 * 1024
+
 
 def get_user_ssh_keys():
     """List all SSH keys for the current user."""
@@ -25,6 +37,43 @@ def get_user_ssh_keys():
     return pubkeys
 
 
+def get_master_lock_path(control_path):
+    """Returns the path of the lock held by the master of @control_path."""
+
+    return Path(control_path.parent, f"{control_path.name}.lock")
+
+
+def stop_master(control_path):
+    """
+    Asks a control master process to close its connection and exit.
+
+    :param control_path: path to the master's UNIX socket as Path
+    """
+
+    import socket
+
+    from provisioner import ipc
+
+    # no master gets spawned for the machine anymore
+    get_master_lock_path(control_path).unlink(missing_ok=True)
+
+    if not control_path.exists():
+        return
+
+    log.debug(f"Stopping SSH control master '{control_path}'")
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(control_path))
+        ipc.send_frame(sock, ipc.REQUEST, ipc.encode_request(["exit"], {}))
+        ipc.recv_frame(sock)
+    except OSError:
+        # the master is gone already
+        control_path.unlink(missing_ok=True)
+    finally:
+        sock.close()
+
+
 class SSHConn:
     """
     Wrapper class over the Paramiko library.
@@ -32,19 +81,117 @@ class SSHConn:
     A simple wrapper implementing a few basic & common operations with the
     Paramiko library. If, for some reason, you need to work directly with
     Paramiko, use the self._client attribute.
+
+    Similarly to OpenSSH's ControlMaster, if a @control_path is given, the
+    first connection spawns a master process (see ssh_master.py) holding an
+    SSH session to the host open. Any SSHConn instance created later for the
+    same @control_path, even in a different process, attaches to the master
+    and sends its uploads and commands over the master's session instead of
+    negotiating a new one.
     """
 
-    class _IgnorePolicy(paramiko.MissingHostKeyPolicy):
-        def missing_host_key(self, client, hostname, key):
-            return
+    def __init__(self, hostname, control_path=None, control_persist=600):
+        """
+        :param hostname: host to connect to as string
+        :param control_path: path to the control master's socket as Path
+        :param control_persist: seconds the master stays around while idle
+        """
 
-    def __init__(self, hostname):
         self.hostname = hostname
-        self._client = paramiko.SSHClient()
-        self._client.load_system_host_keys()
-        self._client.set_missing_host_key_policy(self._IgnorePolicy)
+        self.control_path = control_path
+        self.control_persist = control_persist
+        self._client = None
+        self._sftp = None
+        self._attached = False
+
+    def _new_client(self):
+        # paramiko pulls in the whole cryptography stack, so only import it
+        # once an SSH connection is actually needed
+        import paramiko
+
+        class _IgnorePolicy(paramiko.MissingHostKeyPolicy):
+            def missing_host_key(self, client, hostname, key):
+                return
+
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(_IgnorePolicy)
+        return client
+
+    def _mux_request(self, *fields, out=None, err=None):
+        """
+        Sends a request to the control master.
+
+        :param fields: operation followed by its arguments
+        :param out: binary stream the remote output is written to
+        :param err: binary stream the remote stderr is written to
+        :return: the operation's status as int
+        """
+
+        import socket
+
+        from provisioner import ipc
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with sock:
+            sock.connect(str(self.control_path))
+            ipc.send_frame(sock, ipc.REQUEST, ipc.encode_request(fields, {}))
+
+            errors = []
+            while True:
+                kind, payload = ipc.recv_frame(sock)
+                if kind == ipc.STDOUT:
+                    out.write(payload)
+                    out.flush()
+                elif kind == ipc.STDERR:
+                    err.write(payload)
+                    err.flush()
+                elif kind == ipc.ERROR:
+                    errors.append(payload.decode())
+                elif kind == ipc.EXIT:
+                    failed, status = ipc.decode_exit(payload)
+                    if failed:
+                        raise Exception("".join(errors))
+                    return status
+                else:
+                    raise Exception("Lost connection to the SSH control "
+                                    "master")
+
+    def _attach(self):
+        """Tries to attach to a running control master."""
+
+        if self.control_path is None or not self.control_path.exists():
+            return False
+
+        try:
+            self._mux_request("ping")
+        except Exception as ex:
+            log.debug(f"SSH control master '{self.control_path}' "
+                      f"unusable: {ex}")
+            return False
+
+        log.debug(f"Attached to SSH control master '{self.control_path}'")
+        self._attached = True
+        return True
+
+    def _spawn_master(self, key_filepath):
+        import subprocess
+        import sys
+
+        cmd = [sys.executable, "-m", "provisioner.ssh_master",
+               self.hostname, key_filepath, str(self.control_path),
+               str(self.control_persist)]
+
+        log.debug(f"Spawning SSH control master: {cmd}")
+        subprocess.Popen(cmd, start_new_session=True,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
 
     def connect(self, key_filepath, **kwargs):
+        if self._attach():
+            return
+
         log.debug("Establishing SSH connection: "
                   f"hostname={self.hostname},key_filepath={key_filepath}")
 
@@ -52,28 +199,251 @@ class SSHConn:
         if isinstance(key_filepath, Path):
             ssh_key_path = key_filepath.as_posix()
 
+        if self._client is None:
+            self._client = self._new_client()
+
         self._client.connect(self.hostname,
                              key_filename=ssh_key_path,
                              **kwargs)
 
+        if self.control_path is not None:
+            self._spawn_master(ssh_key_path)
+
+    def is_connected(self):
+        if self._attached:
+            return True
+
+        if self._client is None:
+            return False
+
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        self._attached = False
+
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+
+        if self._client is not None:
+            self._client.close()
+
+    @metrics.timed("upload")
     def upload(self, src, dst):
         """
         Uploads a file to the remote location using SFTP.
 
+        The SFTP session is opened on first use and reused for any subsequent
+        uploads over the same connection.
+
         :param src: source path as string
         :param dst: destination path as string
         """
 
         log.debug(f"Uploading '{src}' to '{dst}'")
 
+        if self._attached:
+            self._mux_request("upload", str(Path(src).absolute()), dst)
+            return
+
         try:
-            sftp = self._client.open_sftp()
-            sftp.put(src, dst)
-            sftp.close()
+            if self._sftp is None:
+                self._sftp = self._client.open_sftp()
+            self._sftp.put(src, dst)
         except Exception as ex:
             raise Exception(f"Failed to upload script over SSH: {ex}")
 
-    def exec(self, cmdline):
+    def _open_command(self, cmdline):
+        try:
+            transport = self._client.get_transport()
+            channel = transport.open_session(window_size=CHANNEL_WINDOW_SIZE)
+
+            log.debug(f"Executing '{cmdline}' on '{self.hostname}'")
+            channel.exec_command(cmdline)
+            return channel
+        except Exception as ex:
+            raise Exception(f"SSH channel error: {ex}")
+
+    @staticmethod
+    def _finish_command(channel, what):
+        errors = b""
+        data = channel.recv_stderr(RECV_SIZE_MIN)
+        while data:
+            errors += data
+            data = channel.recv_stderr(RECV_SIZE_MIN)
+
+        rc = channel.recv_exit_status()
+        if rc != 0:
+            raise Exception(f"{what} failed with exit code {rc}: "
+                            f"{errors.decode(errors='replace').strip()}")
+
+    @metrics.timed("push")
+    def push(self, src, dst, compression="none", out=None):
+        """
+        Copies a local directory tree to the remote side.
+
+        The tree is streamed as a single tar archive over one SSH channel
+        rather than transferred file by file. File permissions are preserved.
+
+        :param src: local directory path as string
+        :param dst: remote directory path as string, created if missing
+        :param compression: one of transfer.COMPRESSION_METHODS
+        :param out: binary stream progress is reported to, defaults to
+                    sys.stdout.buffer
+        """
+
+        from shlex import quote
+
+        from provisioner import transfer
+
+        if out is None:
+            out = sys.stdout.buffer
+
+        src = str(Path(src).absolute())
+        if self._attached:
+            self._mux_request("push", src, dst, compression, out=out)
+            return
+
+        log.debug(f"Pushing '{src}' to '{dst}': compression={compression}")
+
+        if not Path(src).is_dir():
+            raise Exception(f"Failed to push '{src}': not a directory")
+
+        flags = transfer.REMOTE_TAR_FLAGS[compression]
+        channel = self._open_command(
+            f"mkdir -p {quote(dst)} && "
+            f"tar -x {flags} --no-same-owner -C {quote(dst)} -f -"
+        )
+
+        progress = transfer.Progress(f"Pushed {src}", out)
+        try:
+            try:
+                transfer.write_archive(
+                    transfer.ChannelWriter(channel, progress),
+                    Path(src), compression)
+                channel.shutdown_write()
+            except OSError:
+                # the remote side hung up, its error output tells why
+                self._finish_command(channel, f"Pushing '{src}'")
+                raise
+            self._finish_command(channel, f"Pushing '{src}'")
+        finally:
+            channel.close()
+        progress.finish()
+
+    @metrics.timed("pull")
+    def pull(self, src, dst, compression="none", out=None):
+        """
+        Copies a remote directory tree to the local side.
+
+        The counterpart of SSHConn.push().
+
+        :param src: remote directory path as string
+        :param dst: local directory path as string, created if missing
+        :param compression: one of transfer.COMPRESSION_METHODS
+        :param out: binary stream progress is reported to, defaults to
+                    sys.stdout.buffer
+        """
+
+        from shlex import quote
+
+        from provisioner import transfer
+
+        if out is None:
+            out = sys.stdout.buffer
+
+        dst = str(Path(dst).absolute())
+        if self._attached:
+            self._mux_request("pull", src, dst, compression, out=out)
+            return
+
+        log.debug(f"Pulling '{src}' to '{dst}': compression={compression}")
+
+        flags = transfer.REMOTE_TAR_FLAGS[compression]
+        channel = self._open_command(
+            f"tar -c {flags} -C {quote(src)} -f - ."
+        )
+
+        progress = transfer.Progress(f"Pulled {src}", out)
+        try:
+            try:
+                transfer.extract_archive(
+                    transfer.ChannelReader(channel, progress),
+                    Path(dst), compression)
+            except Exception:
+                # a broken archive is most likely caused by a remote error
+                self._finish_command(channel, f"Pulling '{src}'")
+                raise
+            self._finish_command(channel, f"Pulling '{src}'")
+        finally:
+            channel.close()
+        progress.finish()
+
+    @staticmethod
+    def _pump(channel, out, err=None):
+        """
+        Copies the output of a remote command to local binary streams.
+
+        The data is passed through as raw bytes, so multibyte characters split
+        between two reads can't get garbled. The read size adapts to the rate
+        the remote side produces output at and the local streams are only
+        flushed once there's no more output immediately available.
+
+        :param channel: Paramiko channel the command runs on
+        :param out: binary stream the remote stdout is written to
+        :param err: binary stream the remote stderr is written to, if None the
+                    remote stderr is expected to be combined with stdout
+        """
+
+        bufsize = RECV_SIZE_MIN
+        total = 0
+        while True:
+            if err is not None:
+                # both streams are multiplexed over the channel, so we can't
+                # block in recv() on either one of them
+                if not channel.recv_ready() and not channel.recv_stderr_ready():
+                    select.select([channel], [], [], 1)
+
+                if channel.recv_stderr_ready():
+                    err.write(channel.recv_stderr(bufsize))
+                    if not channel.recv_stderr_ready():
+                        err.flush()
+
+                if not channel.recv_ready() and not channel.eof_received:
+                    continue
+
+            data = channel.recv(bufsize)
+            if not data:
+                break
+
+            out.write(data)
+            total += len(data)
+
+            # grow the reads while the remote side keeps them full and shrink
+            # them back once it slows down
+            if len(data) == bufsize:
+                bufsize = min(bufsize * 2, RECV_SIZE_MAX)
+            elif len(data) < bufsize // 4:
+                bufsize = max(bufsize // 2, RECV_SIZE_MIN)
+
+            if not channel.recv_ready():
+                out.flush()
+
+        out.flush()
+
+        if err is not None:
+            # EOF applies to both streams, drain whatever stderr is left
+            data = channel.recv_stderr(bufsize)
+            while data:
+                err.write(data)
+                data = channel.recv_stderr(bufsize)
+            err.flush()
+
+        return total
+
+    @metrics.timed("exec")
+    def exec(self, cmdline, out=None, err=None):
         """
         Executes a command on the remote side over SSH.
 
@@ -82,8 +452,20 @@ class SSHConn:
 
         :param cmdline: full command line (including arguments) to be executed
                         on the remote side as string
+        :param out: binary stream to write the command output to, defaults to
+                    sys.stdout.buffer
+        :param err: binary stream to write the command's stderr to, by default
+                    stderr is combined with stdout
         """
 
+        if out is None:
+            out = sys.stdout.buffer
+
+        if self._attached:
+            return -self._mux_request("exec", cmdline,
+                                      "separate" if err else "combined",
+                                      out=out, err=err)
+
         # Paramiko is particularly bad at running long-lasting command in a
         # shell environment, e.g. the 'exec_command' method is always
         # non-blocking and the channel is closed immediately so the script
@@ -95,18 +477,15 @@ class SSHConn:
 
         try:
             transport = self._client.get_transport()
-            channel = transport.open_session()
-            channel.set_combine_stderr(True)
+            channel = transport.open_session(window_size=CHANNEL_WINDOW_SIZE)
+            channel.set_combine_stderr(err is None)
 
             log.debug(f"Executing '{cmdline}' on '{self.hostname}'")
             channel.exec_command(cmdline)
         except Exception as ex:
             raise Exception(f"SSH channel error: {ex}")
 
-        data = channel.recv(1024)
-        while data:
-            print(data.decode(), end="", flush=True)
-            data = channel.recv(1024)
+        self._pump(channel, out, err)
 
         rc = channel.recv_exit_status()
         return -rc
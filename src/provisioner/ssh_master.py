@@ -0,0 +1,142 @@
+# ssh_master.py - module containing the SSH control master process
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import socket
+import sys
+
+from pathlib import Path
+
+from provisioner import ipc
+from provisioner import state
+from provisioner.ssh import SSHConn
+from provisioner.ssh import get_master_lock_path
+
+log = logging.getLogger(__name__)
+
+
+class _FrameWriter:
+    """Binary stream sending everything written to it as frames of @kind."""
+
+    def __init__(self, sock, kind):
+        self._sock = sock
+        self._kind = kind
+
+    def write(self, data):
+        ipc.send_frame(self._sock, self._kind, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class SSHMaster:
+    """
+    Process holding a single SSH session to a machine open.
+
+    The master serves uploads and command executions to SSHConn instances
+    attached to its UNIX socket until it's told to exit, its SSH session
+    breaks or it stays idle for longer than @persist seconds.
+
+    Only a single master runs per control path, it holds a lock on
+    <control_path>.lock for its whole lifetime. A master spawned while
+    another one is still starting up or serving exits right away, rather
+    than replacing the other one's socket and leaving it unreachable.
+    """
+
+    def __init__(self, hostname, key_filepath, control_path, persist):
+        self.control_path = Path(control_path)
+        self.persist = persist
+        self.conn = SSHConn(hostname)
+        self.key_filepath = key_filepath
+
+    def _handle(self, sock):
+        kind, payload = ipc.recv_frame(sock)
+        if kind != ipc.REQUEST:
+            return True
+
+        fields, _, _ = ipc.decode_request(payload)
+        op = fields[0]
+
+        status = 0
+        failed = False
+        try:
+            if op == "exec":
+                err = None
+                if fields[2] == "separate":
+                    err = _FrameWriter(sock, ipc.STDERR)
+
+                status = -self.conn.exec(fields[1],
+                                         out=_FrameWriter(sock, ipc.STDOUT),
+                                         err=err)
+            elif op == "upload":
+                self.conn.upload(fields[1], fields[2])
+            elif op in ["push", "pull"]:
+                transfer = getattr(self.conn, op)
+                transfer(fields[1], fields[2], fields[3],
+                         out=_FrameWriter(sock, ipc.STDOUT))
+            elif op not in ["ping", "exit"]:
+                raise Exception(f"Unknown operation '{op}'")
+        except Exception as ex:
+            failed = True
+            ipc.send_frame(sock, ipc.ERROR, str(ex).encode())
+
+        ipc.send_frame(sock, ipc.EXIT, ipc.encode_exit(failed, status))
+        return op != "exit"
+
+    def serve(self):
+        with state.locked(get_master_lock_path(self.control_path),
+                          blocking=False) as acquired:
+            if not acquired:
+                log.debug(f"SSH control master '{self.control_path}' is "
+                          "running already")
+                return
+
+            self._serve()
+
+    def _serve(self):
+        self.conn.connect(self.key_filepath, username="root")
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        tmp_path = Path(self.control_path.parent,
+                        f".{self.control_path.name}.{os.getpid()}")
+        server.bind(str(tmp_path))
+        os.chmod(tmp_path, 0o600)
+        server.listen()
+        server.settimeout(self.persist)
+
+        # only publish the socket once it's ready to serve requests
+        os.replace(tmp_path, self.control_path)
+
+        try:
+            running = True
+            while running and self.conn.is_connected():
+                try:
+                    sock, _ = server.accept()
+                except socket.timeout:
+                    log.debug("Idle timeout reached")
+                    break
+
+                with sock:
+                    sock.settimeout(None)
+                    try:
+                        running = self._handle(sock)
+                    except OSError as ex:
+                        log.debug(f"Request aborted: {ex}")
+        finally:
+            server.close()
+            self.control_path.unlink(missing_ok=True)
+            self.conn.close()
+
+
+def main():
+    hostname, key_filepath, control_path, persist = sys.argv[1:]
+    SSHMaster(hostname, key_filepath, control_path, int(persist)).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# state.py - module containing the on-disk state store primitives
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import fcntl
+import json
+import logging
+import os
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from provisioner.configmap import ConfigMap
+
+log = logging.getLogger(__name__)
+
+
+def state_path(*parts):
+    """
+    Returns a path inside the application state directory.
+
+    The state directory is shared by all libvirt-gci processes running on the
+    host under the same user, so it serves as the communication medium
+    between the separate prepare/run/cleanup invocations GitLab makes.
+
+    :param parts: path components relative to the state directory
+    :return: Path object, parent directories are created on demand
+    """
+
+    state_dir = ConfigMap()["state_dir"]
+    if state_dir is None:
+        xdg_state_home = os.environ.get("XDG_STATE_HOME",
+                                        Path(Path.home(), ".local", "state"))
+        state_dir = Path(xdg_state_home, "libvirt-gci")
+
+    path = Path(state_dir, *parts)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@contextmanager
+def locked(path, blocking=True):
+    """
+    Context manager holding an exclusive advisory lock on a lock file.
+
+    :param path: path to the lock file as Path
+    :param blocking: whether to wait for the lock, if False and the lock is
+                     held by someone else, the context manager yields False
+    """
+
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+
+    with open(path, "a") as fd:
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def read_json(path, default=None):
+    """Loads a JSON document from @path, returns @default if there's none."""
+
+    try:
+        with open(path, "r") as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return default
+
+
+def write_json(path, data):
+    """Atomically replaces @path with the JSON serialized @data."""
+
+    tmp = Path(path.parent, f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w") as fd:
+        json.dump(data, fd, indent=2)
+    os.replace(tmp, path)
+
+
+def get_machine_record(name):
+    """
+    Returns the state record of machine @name or None if there isn't any.
+
+    Machines provisioned directly under their GitLab name don't necessarily
+    have a record, in which case the machine name is also its domain name.
+    """
+
+    return read_json(state_path("machines", f"{name}.json"))
+
+
+def set_machine_record(name, record):
+    log.debug(f"Saving state record for '{name}': {record}")
+    write_json(state_path("machines", f"{name}.json"), record)
+
+
+def del_machine_record(name):
+    try:
+        os.unlink(state_path("machines", f"{name}.json"))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,197 @@
+# transfer.py - module containing the bulk tar transfer primitives
+#
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import tarfile
+
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+COMPRESSION_METHODS = ["none", "gzip", "zstd"]
+
+# tar flags the remote side needs for a given compression method
+REMOTE_TAR_FLAGS = {
+    "none": "",
+    "gzip": "-z",
+    "zstd": "--zstd",
+}
+
+# Size of the chunks the archive is written/read in
+BUFSIZE = 1024 * 1024
+
+
+class Progress:
+    """
+    Transfer progress reporter.
+
+    Reports the amount of data transferred along with the throughput to a
+    binary stream at most every @interval seconds and once more when the
+    transfer finishes.
+    """
+
+    def __init__(self, label, out, interval=5):
+        self.label = label
+        self.out = out
+        self.interval = interval
+        self.total = 0
+        self.start = monotonic()
+        self._last = self.start
+
+    def _report(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        mib = self.total / 1024 / 1024
+        self.out.write(f"{self.label}: {mib:.1f} MiB "
+                       f"({mib / elapsed:.1f} MiB/s)\n".encode())
+        self.out.flush()
+
+    def update(self, nbytes):
+        self.total += nbytes
+
+        now = monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._report(now)
+
+    def finish(self):
+        self._report(monotonic())
+
+
+class ChannelWriter:
+    """Binary stream writing to the stdin of a remote command."""
+
+    def __init__(self, channel, progress):
+        self.channel = channel
+        self.progress = progress
+
+    def write(self, data):
+        self.channel.sendall(data)
+        self.progress.update(len(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class ChannelReader:
+    """Binary stream reading the stdout of a remote command."""
+
+    def __init__(self, channel, progress):
+        self.channel = channel
+        self.progress = progress
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = BUFSIZE
+
+        data = self.channel.recv(size)
+        self.progress.update(len(data))
+        return data
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("zstd compression needs the 'zstandard' Python module")
+    return zstandard
+
+
+def compress(fileobj, method):
+    """
+    Wraps @fileobj in a stream compressing everything written to it.
+
+    :param fileobj: binary stream to write the compressed data to
+    :param method: one of COMPRESSION_METHODS
+    :return: binary stream, None if no compression is needed
+    """
+
+    if method == "gzip":
+        import gzip
+
+        # the default level 9 can't keep up with a local network
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=1)
+    elif method == "zstd":
+        return _zstandard().ZstdCompressor().stream_writer(fileobj,
+                                                           closefd=False)
+    return None
+
+
+def decompress(fileobj, method):
+    """
+    Wraps @fileobj in a stream decompressing everything read from it.
+
+    :param fileobj: binary stream to read the compressed data from
+    :param method: one of COMPRESSION_METHODS
+    :return: binary stream, None if no decompression is needed
+    """
+
+    if method == "gzip":
+        import gzip
+
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    elif method == "zstd":
+        return _zstandard().ZstdDecompressor().stream_reader(fileobj,
+                                                             closefd=False)
+    return None
+
+
+def write_archive(fileobj, src, method):
+    """
+    Writes a tar archive of the directory @src to @fileobj.
+
+    :param fileobj: binary stream to write the archive to
+    :param src: local directory as Path
+    :param method: one of COMPRESSION_METHODS
+    """
+
+    stream = compress(fileobj, method)
+    with tarfile.open(fileobj=stream or fileobj, mode="w|",
+                      bufsize=BUFSIZE) as tar:
+        for entry in sorted(src.iterdir()):
+            tar.add(entry, arcname=entry.name)
+
+    if stream is not None:
+        stream.close()
+
+
+def extract_archive(fileobj, dst, method):
+    """
+    Extracts a tar archive read from @fileobj into the directory @dst.
+
+    The archive comes from the guest, so members trying to escape @dst are
+    refused, but file permissions are preserved.
+
+    :param fileobj: binary stream to read the archive from
+    :param dst: local directory as Path
+    :param method: one of COMPRESSION_METHODS
+    """
+
+    dst.mkdir(parents=True, exist_ok=True)
+    stream = decompress(fileobj, method)
+    with tarfile.open(fileobj=stream or fileobj, mode="r|",
+                      bufsize=BUFSIZE) as tar:
+        if hasattr(tarfile, "tar_filter"):
+            tar.extractall(dst, filter="tar")
+        else:
+            root = dst.resolve()
+            for member in tar:
+                target = (root / member.name).resolve()
+                if root != target and root not in target.parents:
+                    raise Exception(f"Refusing to extract '{member.name}' "
+                                    "outside of the destination")
+                if member.issym() or member.islnk():
+                    # hard link targets are relative to the archive root
+                    base = root if member.islnk() else target.parent
+                    link = (base / member.linkname).resolve()
+                    if root != link and root not in link.parents:
+                        raise Exception(f"Refusing to extract link "
+                                        f"'{member.name}' pointing outside "
+                                        "of the destination")
+                tar.extract(member, dst)
+
+    if stream is not None:
+        stream.close()